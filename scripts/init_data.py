@@ -980,48 +980,40 @@ def init_permissions():
     # Quản lý - toàn quyền tất cả chức năng
     if quan_ly:
         print(f"\n   Nhóm: {quan_ly.user_group_name}")
-        for func in Function.objects.all():
-            perm, created = Permission.objects.get_or_create(
-                user_group=quan_ly,
-                function=func,
-                defaults={
-                    'can_view': True,
-                    'can_add': True,
-                    'can_edit': True,
-                    'can_delete': True
-                }
-            )
-            if created:
-                created_count += 1
-                print(f"      [OK] {func.function_name} - Toàn quyền")
+        matrix = {
+            func_id: permissions_config['Quản lý']['all']
+            for func_id in Function.objects.values_list('id', flat=True)
+        }
+        # Chỉ tạo quyền còn thiếu, không ghi đè quyền đã chỉnh sửa
+        created, _ = Permission.apply_matrix(quan_ly, matrix, overwrite=False)
+        created_count += created
+        if created:
+            print(f"      [OK] {created} chức năng - Toàn quyền")
     
     # Thủ thư - quyền hạn chế
     if thu_thu:
         print(f"\n   Nhóm: {thu_thu.user_group_name}")
-        for func_name, perm_data in permissions_config['Thủ thư'].items():
-            func = Function.objects.filter(function_name=func_name).first()
-            if not func:
+        config = permissions_config['Thủ thư']
+        functions = Function.objects.filter(function_name__in=list(config.keys()))
+        matrix = {func.id: config[func.function_name] for func in functions}
+        # Quyền đã có (giữ nguyên) -> không in lại
+        existing = set(
+            Permission.objects.filter(user_group=thu_thu, function_id__in=list(matrix.keys()))
+            .values_list('function_id', flat=True)
+        )
+        
+        created, _ = Permission.apply_matrix(thu_thu, matrix, overwrite=False)
+        created_count += created
+        for func in functions:
+            if func.id in existing:
                 continue
-            
-            perm, created = Permission.objects.get_or_create(
-                user_group=thu_thu,
-                function=func,
-                defaults={
-                    'can_view': perm_data['view'],
-                    'can_add': perm_data['add'],
-                    'can_edit': perm_data['edit'],
-                    'can_delete': perm_data['delete']
-                }
-            )
-            
-            if created:
-                created_count += 1
-                perms_str = []
-                if perm_data['view']: perms_str.append('Xem')
-                if perm_data['add']: perms_str.append('Thêm')
-                if perm_data['edit']: perms_str.append('Sửa')
-                if perm_data['delete']: perms_str.append('Xóa')
-                print(f"      [OK] {func.function_name} - {', '.join(perms_str)}")
+            perm_data = config[func.function_name]
+            perms_str = []
+            if perm_data['view']: perms_str.append('Xem')
+            if perm_data['add']: perms_str.append('Thêm')
+            if perm_data['edit']: perms_str.append('Sửa')
+            if perm_data['delete']: perms_str.append('Xóa')
+            print(f"      [OK] {func.function_name} - {', '.join(perms_str)}")
     
     print(f"\nTổng: {created_count} quyền mới / {Permission.objects.count()} quyền")
 
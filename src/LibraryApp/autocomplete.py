@@ -0,0 +1,277 @@
+"""
+Gợi ý (autocomplete) cho ô chọn độc giả và sách khi lập phiếu mượn.
+
+Mỗi đối tượng được tách thành các token trong bảng AutocompleteToken
+(chuỗi đã chuẩn hóa bằng fold_text). Gợi ý được tìm theo 3 tầng, dừng khi đủ N:
+1. Tiền tố cả chuỗi (tên / email độc giả, tên sách / tên tác giả bắt đầu bằng chuỗi nhập)
+2. Tiền tố từng từ (mọi từ nhập là tiền tố của 1 từ trong tên, tên tác giả)
+3. Chuỗi con của tên (chứa các trigram phủ kín chuỗi nhập, chuỗi nhập từ 3 ký tự,
+   đối chiếu lại trên chuỗi đầy đủ)
+Tầng 1, 2 là range scan trên index; tầng 3 là seek index theo từng trigram.
+Mỗi tầng đọc ứng viên theo trang limit * CANDIDATE_FACTOR, đọc tiếp trang sau tới khi
+đủ limit đối tượng thỏa queryset của người gọi hoặc đã đọc SCAN_LIMIT dòng.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .search import fold_text
+
+SUGGESTION_LIMIT = 20
+CANDIDATE_FACTOR = 5
+# Chặn trên số dòng token đọc ở mỗi tầng
+SCAN_LIMIT = 5000
+BATCH_SIZE = 2000
+
+# Cận trên của khoảng tiền tố: token trong [prefix, prefix + PREFIX_END)
+PREFIX_END = '\U0010ffff'
+TOKEN_MAX_LENGTH = 255
+# Chặn trên khi đếm số đối tượng của 1 trigram (chỉ cần so sánh độ hiếm)
+TRIGRAM_COUNT_CAP = 1000
+
+
+def trigrams(text):
+    """Các cụm 3 ký tự liên tiếp của chuỗi"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def covering_trigrams(text):
+    """Các trigram không chồng nhau (và trigram cuối) phủ kín chuỗi: 'nguyen' -> ['ngu', 'yen']"""
+    if len(text) < 3:
+        return []
+    starts = list(range(0, len(text) - 2, 3))
+    if starts[-1] != len(text) - 3:
+        starts.append(len(text) - 3)
+    return list(dict.fromkeys(text[i:i + 3] for i in starts))
+
+
+def _reader_documents(object_ids=None):
+    """
+    (id, keys, words, trigram_texts) của độc giả.
+    Email chỉ khớp tiền tố (không tạo trigram để bảng token không phình to).
+    """
+    from .models import Reader
+
+    rows = Reader.objects.order_by().values_list('id', 'reader_name', 'email')
+    if object_ids is not None:
+        rows = rows.filter(id__in=object_ids)
+    for reader_id, name, email in rows.iterator(chunk_size=BATCH_SIZE):
+        name = fold_text(name)
+        email = (email or '').lower()
+        yield reader_id, [name, email], name.split(), [name]
+
+
+def _book_documents(object_ids=None):
+    """(id, keys, words, trigram_texts) của sách: tên sách + tên các tác giả"""
+    from .models import Book, AuthorDetail
+
+    books = Book.objects.order_by().values_list('id', 'book_title_id', 'book_title__book_title')
+    if object_ids is not None:
+        books = books.filter(id__in=object_ids)
+    books = list(books)
+
+    authors = defaultdict(list)
+    details = AuthorDetail.objects.order_by().values_list('book_title_id', 'author__author_name')
+    if object_ids is not None:
+        details = details.filter(book_title_id__in={title_id for _, title_id, _ in books})
+    for title_id, author_name in details:
+        authors[title_id].append(fold_text(author_name))
+
+    for book_id, title_id, title in books:
+        title = fold_text(title)
+        names = authors[title_id]
+        words = title.split() + [word for name in names for word in name.split()]
+        yield book_id, [title, *names], words, [title, *names]
+
+
+DOCUMENT_SOURCES = {
+    'reader': _reader_documents,
+    'book': _book_documents,
+}
+
+
+def build_tokens(kind, object_id, keys, words, texts):
+    """Các dòng AutocompleteToken (không trùng lặp) của 1 đối tượng"""
+    from .models import AutocompleteToken
+
+    tokens = {(AutocompleteToken.TYPE_KEY, key[:TOKEN_MAX_LENGTH]) for key in keys if key}
+    tokens.update((AutocompleteToken.TYPE_WORD, word[:TOKEN_MAX_LENGTH]) for word in words)
+    for text in texts:
+        tokens.update((AutocompleteToken.TYPE_TRIGRAM, gram) for gram in trigrams(text))
+    return [
+        AutocompleteToken(kind=kind, token_type=token_type, token=token, object_id=object_id)
+        for token_type, token in tokens
+    ]
+
+
+def _insert_documents(kind, documents):
+    """Ghi token theo lô, trả về số đối tượng"""
+    from .models import AutocompleteToken
+
+    count = 0
+    batch = []
+    for object_id, keys, words, texts in documents:
+        batch.extend(build_tokens(kind, object_id, keys, words, texts))
+        count += 1
+        if len(batch) >= BATCH_SIZE:
+            AutocompleteToken.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+            batch = []
+    if batch:
+        AutocompleteToken.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+    return count
+
+
+def reindex(kind, object_ids):
+    """Đánh lại token của các đối tượng (đối tượng đã xóa -> chỉ xóa token)"""
+    from .models import AutocompleteToken
+
+    object_ids = set(object_ids)
+    if not object_ids:
+        return
+    with transaction.atomic():
+        AutocompleteToken.objects.filter(kind=kind, object_id__in=object_ids).delete()
+        _insert_documents(kind, DOCUMENT_SOURCES[kind](object_ids))
+
+
+def remove(kind, object_ids):
+    from .models import AutocompleteToken
+
+    AutocompleteToken.objects.filter(kind=kind, object_id__in=set(object_ids)).delete()
+
+
+def rebuild(kind):
+    """Xóa và nạp lại toàn bộ token của 1 loại, trả về số đối tượng"""
+    from .models import AutocompleteToken
+
+    with transaction.atomic():
+        AutocompleteToken.objects.filter(kind=kind).delete()
+        return _insert_documents(kind, DOCUMENT_SOURCES[kind]())
+
+
+def ensure_autocomplete_index():
+    """Nạp chỉ mục của loại đang trống (VD: lần migrate đầu trên dữ liệu có sẵn)"""
+    from .models import AutocompleteToken, Reader, Book
+
+    sources = {'reader': Reader, 'book': Book}
+    for kind, model in sources.items():
+        if not AutocompleteToken.objects.filter(kind=kind).exists() and model.objects.exists():
+            rebuild(kind)
+
+
+def _scan(rows, page_size, by_token=True):
+    """
+    Đọc object_id theo trang (keyset trên index), tối đa SCAN_LIMIT dòng.
+    by_token: thứ tự (token, object_id) cho khoảng tiền tố; ngược lại theo object_id (1 token cố định)
+    """
+    order = ('token', 'object_id') if by_token else ('object_id',)
+    rows = rows.order_by(*order).values_list('token', 'object_id')
+    page_rows = rows
+    scanned = 0
+    while scanned < SCAN_LIMIT:
+        page = list(page_rows[:page_size])
+        if not page:
+            return
+        yield [object_id for _, object_id in page]
+        scanned += len(page)
+        if len(page) < page_size:
+            return
+        token, object_id = page[-1]
+        if by_token:
+            page_rows = rows.filter(token__gte=token).exclude(token=token, object_id__lte=object_id)
+        else:
+            page_rows = rows.filter(object_id__gt=object_id)
+
+
+def _candidate_pages(kind, query, page_size):
+    """Ứng viên theo từng tầng: yield 1 generator các trang object_id (theo thứ tự index) cho mỗi tầng"""
+    from .models import AutocompleteToken
+
+    tokens = AutocompleteToken.objects.filter(kind=kind).order_by()
+
+    # Tầng 1: tiền tố cả chuỗi, theo thứ tự chữ cái
+    yield _scan(
+        tokens.filter(token_type=AutocompleteToken.TYPE_KEY, token__gte=query, token__lt=query + PREFIX_END),
+        page_size,
+    )
+
+    # Tầng 2: tiền tố từng từ; quét theo từ dài nhất (ít kết quả nhất),
+    # các từ còn lại kiểm tra trên token từ của ứng viên
+    words = query.split()
+    longest = max(words, key=len)
+    others = list(words)
+    others.remove(longest)
+
+    def word_pages():
+        for ids in _scan(
+            tokens.filter(
+                token_type=AutocompleteToken.TYPE_WORD, token__gte=longest, token__lt=longest + PREFIX_END
+            ),
+            page_size,
+        ):
+            ids = list(dict.fromkeys(ids))
+            if others:
+                object_words = _object_tokens(tokens, ids, AutocompleteToken.TYPE_WORD)
+                ids = [
+                    object_id for object_id in ids
+                    if all(any(token.startswith(word) for token in object_words[object_id]) for word in others)
+                ]
+            yield ids
+
+    yield word_pages()
+
+    # Tầng 3: chuỗi con. Duyệt danh sách đối tượng của trigram đầu theo index,
+    # mỗi trigram còn lại kiểm tra bằng 1 lần seek index (EXISTS) -> dừng ngay khi đủ ứng viên,
+    # không phải gom nhóm toàn bộ danh sách của các trigram phổ biến
+    grams = covering_trigrams(query)
+    if grams:
+        trigram_tokens = tokens.filter(token_type=AutocompleteToken.TYPE_TRIGRAM)
+        # Trigram hiếm nhất (đếm có chặn trên) làm danh sách duyệt chính
+        grams.sort(key=lambda gram: trigram_tokens.filter(token=gram)[:TRIGRAM_COUNT_CAP].count())
+        candidates = trigram_tokens.filter(token=grams[0])
+        for gram in grams[1:]:
+            candidates = candidates.filter(
+                Exists(trigram_tokens.filter(token=gram, object_id=OuterRef('object_id')))
+            )
+
+        def substring_pages():
+            for ids in _scan(candidates, page_size, by_token=False):
+                # Trigram phủ kín nhưng có thể không liền nhau -> đối chiếu lại trên chuỗi đầy đủ
+                keys = _object_tokens(tokens, ids, AutocompleteToken.TYPE_KEY)
+                yield [object_id for object_id in ids if any(query in key for key in keys[object_id])]
+
+        yield substring_pages()
+
+
+def _object_tokens(tokens, object_ids, token_type):
+    """{object_id: [token]} của các đối tượng (index phủ theo đối tượng)"""
+    result = defaultdict(list)
+    for object_id, token in tokens.filter(
+        object_id__in=object_ids, token_type=token_type
+    ).values_list('object_id', 'token'):
+        result[object_id].append(token)
+    return result
+
+
+def suggest(kind, text, queryset, limit=SUGGESTION_LIMIT):
+    """
+    Gợi ý tối đa `limit` đối tượng của `queryset` (VD: độc giả đang hoạt động)
+    khớp với chuỗi nhập, xếp theo tầng khớp rồi theo thứ tự trên index.
+    """
+    query = fold_text(text)[:TOKEN_MAX_LENGTH]
+    if not query:
+        return []
+
+    results = []
+    seen = set()
+    # Bộ lọc của queryset áp dụng sau khi đọc ứng viên -> đọc tiếp trang sau
+    # khi các đối tượng không thỏa (VD: độc giả ngừng hoạt động) chiếm hết trang
+    for pages in _candidate_pages(kind, query, limit * CANDIDATE_FACTOR):
+        for ids in pages:
+            new_ids = [object_id for object_id in dict.fromkeys(ids) if object_id not in seen]
+            seen.update(new_ids)
+            objects = queryset.in_bulk(new_ids)
+            results.extend(objects[object_id] for object_id in new_ids if object_id in objects)
+            if len(results) >= limit:
+                return results[:limit]
+    return results
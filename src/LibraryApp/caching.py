@@ -0,0 +1,267 @@
+"""
+Cache dùng chung giữa các worker (gunicorn) cho dữ liệu đọc nhiều, ghi ít.
+
+Mỗi nhóm dữ liệu có một bộ đếm phiên bản (version) lưu trong cache.
+Khi dữ liệu thay đổi, signal đổi version -> key dữ liệu cũ tự hết hiệu lực,
+các worker chỉ đọc lại database khi version thay đổi.
+"""
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from django.core.cache import cache, caches
+
+logger = logging.getLogger(__name__)
+
+# Version counter không hết hạn, dữ liệu theo version hết hạn theo TIMEOUT mặc định
+VERSION_TIMEOUT = None
+
+PERMISSION_VERSION_KEY = 'perm:group:{group_id}:version'
+PERMISSION_DATA_KEY = 'perm:group:{group_id}:v{version}'
+PERMISSION_STATS_KEY = 'perm:stats:{name}'
+
+# Cache cục bộ trong process: {group_id: (version, permission_map)}
+_local_permission_maps = {}
+
+PARAMETER_VERSION_KEY = 'parameter:version'
+# Khoảng thời gian (giây) giữa 2 lần kiểm tra version Parameter trên cache dùng chung
+PARAMETER_VERSION_CHECK_INTERVAL = 1.0
+
+# Parameter cache trong process: version, thời điểm kiểm tra, instance
+_local_parameter = {'version': None, 'checked_at': 0.0, 'value': None}
+
+# Version danh mục sách (đầu sách, tác giả, thể loại): tăng khi danh mục thay đổi
+CATALOG_VERSION_KEY = 'catalog:version'
+
+# Kết quả tra cứu (list id đã sắp xếp + tổng số) theo phạm vi:
+# 'book' (tra cứu sách, ô chọn sách), 'reader' (ô chọn độc giả)
+SEARCH_VERSION_KEY = 'search:{scope}:version'
+SEARCH_RESULT_KEY = 'search:{scope}:v{version}:{signature}'
+SEARCH_FACETS_KEY = 'search:{scope}:v{version}:facets:{signature}'
+SEARCH_RESULT_TIMEOUT = 600
+# Kết quả / facet nằm ở cache riêng (ngân sách cull riêng), version counter vẫn ở 'default'
+SEARCH_CACHE_ALIAS = 'search'
+
+# Số đếm hit/miss chưa đẩy lên cache dùng chung
+_pending_stats = {'hit': 0, 'miss': 0}
+STATS_FLUSH_EVERY = 100
+
+
+def _new_version():
+    """
+    Giá trị version mới, không trùng với mọi version đã cấp.
+    Version key có thể bị cache loại bỏ (cull khi đầy, restart): nếu khởi tạo lại = 1
+    thì worker còn giữ dữ liệu của version 1 cũ (VD: quyền trước khi thu hồi) sẽ dùng lại nó.
+    """
+    return uuid.uuid4().hex
+
+
+def get_version(key):
+    """Lấy version hiện tại của key (chưa có / đã bị loại khỏi cache -> cấp version mới)"""
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            # Worker khác vừa khởi tạo
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    """Đổi version -> vô hiệu hóa toàn bộ dữ liệu cache theo version cũ"""
+    version = _new_version()
+    cache.set(key, version, VERSION_TIMEOUT)
+    return version
+
+
+def _count(name):
+    """
+    Đếm hit/miss trong process, định kỳ cộng dồn vào cache dùng chung
+    (tránh ghi cache ở mỗi request).
+    """
+    _pending_stats[name] += 1
+    if sum(_pending_stats.values()) >= STATS_FLUSH_EVERY:
+        flush_permission_cache_stats()
+
+
+def flush_permission_cache_stats():
+    """Đẩy số đếm hit/miss của process hiện tại vào cache dùng chung"""
+    for name, delta in _pending_stats.items():
+        if not delta:
+            continue
+        key = PERMISSION_STATS_KEY.format(name=name)
+        if not cache.add(key, delta, VERSION_TIMEOUT):
+            try:
+                cache.incr(key, delta)
+            except ValueError:
+                cache.set(key, delta, VERSION_TIMEOUT)
+        _pending_stats[name] = 0
+
+
+def load_group_permission_map(group_id):
+    """
+    Đọc quyền của nhóm từ database (1 truy vấn):
+    {function_name: {'view': bool, 'add': bool, 'edit': bool, 'delete': bool}}
+    """
+    from .models import Permission
+
+    permission_map = {}
+    rows = Permission.objects.filter(
+        user_group_id=group_id
+    ).values_list(
+        'function__function_name', 'can_view', 'can_add', 'can_edit', 'can_delete'
+    )
+    for function_name, can_view, can_add, can_edit, can_delete in rows:
+        permission_map[function_name] = {
+            'view': can_view,
+            'add': can_add,
+            'edit': can_edit,
+            'delete': can_delete,
+        }
+    return permission_map
+
+
+def get_group_permission_map(group_id):
+    """
+    Lấy bảng quyền đã biên dịch của nhóm người dùng.
+    Thứ tự tra cứu: cache trong process -> cache dùng chung -> database.
+    Không được sửa dict trả về (dùng chung giữa các request).
+    """
+    version = get_version(PERMISSION_VERSION_KEY.format(group_id=group_id))
+
+    local = _local_permission_maps.get(group_id)
+    if local is not None and local[0] == version:
+        _count('hit')
+        return local[1]
+
+    data_key = PERMISSION_DATA_KEY.format(group_id=group_id, version=version)
+    permission_map = cache.get(data_key)
+    if permission_map is None:
+        _count('miss')
+        logger.debug('Permission cache miss: group=%s version=%s', group_id, version)
+        permission_map = load_group_permission_map(group_id)
+        cache.set(data_key, permission_map)
+    else:
+        _count('hit')
+
+    _local_permission_maps[group_id] = (version, permission_map)
+    return permission_map
+
+
+def invalidate_group_permissions(group_id):
+    """Tăng version quyền của 1 nhóm"""
+    _local_permission_maps.pop(group_id, None)
+    return bump_version(PERMISSION_VERSION_KEY.format(group_id=group_id))
+
+
+def invalidate_all_group_permissions():
+    """Tăng version quyền của tất cả nhóm (VD: đổi tên chức năng)"""
+    from .models import UserGroup
+
+    for group_id in UserGroup.objects.values_list('id', flat=True):
+        invalidate_group_permissions(group_id)
+
+
+def get_permission_cache_stats():
+    """Thống kê hit/miss của cache quyền (cộng dồn trên mọi worker)"""
+    flush_permission_cache_stats()
+    hits = cache.get(PERMISSION_STATS_KEY.format(name='hit'), 0)
+    misses = cache.get(PERMISSION_STATS_KEY.format(name='miss'), 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits * 100 / total, 2) if total else 0,
+    }
+
+
+def reset_permission_cache_stats():
+    """Đặt lại bộ đếm hit/miss"""
+    _pending_stats['hit'] = 0
+    _pending_stats['miss'] = 0
+    cache.delete_many([
+        PERMISSION_STATS_KEY.format(name='hit'),
+        PERMISSION_STATS_KEY.format(name='miss'),
+    ])
+
+
+def get_current_parameter(loader):
+    """
+    Lấy Parameter hiện tại từ cache trong process.
+    Version dùng chung chỉ được kiểm tra tối đa 1 lần / PARAMETER_VERSION_CHECK_INTERVAL,
+    worker khác thấy thay đổi chậm nhất sau khoảng thời gian này.
+    loader: hàm đọc Parameter từ database khi cache hết hiệu lực.
+    """
+    now = time.monotonic()
+    value = _local_parameter['value']
+    if value is not None and now - _local_parameter['checked_at'] < PARAMETER_VERSION_CHECK_INTERVAL:
+        return value
+
+    version = get_version(PARAMETER_VERSION_KEY)
+    if value is None or _local_parameter['version'] != version:
+        value = loader()
+        # Chưa cấu hình Parameter -> không cache để lần sau đọc lại
+        _local_parameter['value'] = value
+        _local_parameter['version'] = version if value is not None else None
+    _local_parameter['checked_at'] = now
+    return value
+
+
+def invalidate_parameter(shared=True):
+    """Xóa Parameter trong process, tăng version dùng chung để worker khác nạp lại"""
+    _local_parameter['value'] = None
+    _local_parameter['version'] = None
+    if shared:
+        bump_version(PARAMETER_VERSION_KEY)
+
+
+def invalidate_catalog():
+    """
+    Danh mục sách thay đổi -> tăng version (chỉ mục trong bộ nhớ của các worker xây lại)
+    và bỏ kết quả tra cứu sách đã cache
+    """
+    invalidate_search_results('book')
+    return bump_version(CATALOG_VERSION_KEY)
+
+
+def search_signature(params):
+    """Chữ ký của bộ lọc đã chuẩn hóa (bỏ giá trị rỗng, không phụ thuộc thứ tự tham số)"""
+    normalized = sorted((name, str(value)) for name, value in params.items() if value not in (None, ''))
+    return hashlib.sha1(json.dumps(normalized).encode()).hexdigest()
+
+
+def _get_versioned(key_format, scope, params, loader):
+    """Giá trị cache theo version của phạm vi + chữ ký bộ lọc, nạp bằng loader() khi chưa có"""
+    version = get_version(SEARCH_VERSION_KEY.format(scope=scope))
+    key = key_format.format(scope=scope, version=version, signature=search_signature(params))
+    search_cache = caches[SEARCH_CACHE_ALIAS]
+    value = search_cache.get(key)
+    if value is None:
+        value = loader()
+        search_cache.set(key, value, SEARCH_RESULT_TIMEOUT)
+    return value
+
+
+def get_search_results(scope, params, loader):
+    """
+    Kết quả tra cứu đã cache theo bộ lọc và version của phạm vi: (ids, total).
+    loader(): đọc list id đã sắp xếp từ database khi chưa có trong cache.
+    Phân trang / tra cứu lặp lại chỉ còn truy vấn nạp các dòng của trang.
+    """
+    def load():
+        ids = list(loader())
+        return ids, len(ids)
+
+    return _get_versioned(SEARCH_RESULT_KEY, scope, params, load)
+
+
+def get_search_facets(scope, params, loader):
+    """Facet (số sách theo thể loại / tác giả / tình trạng) đã cache, cùng version với kết quả"""
+    return _get_versioned(SEARCH_FACETS_KEY, scope, params, loader)
+
+
+def invalidate_search_results(scope):
+    """Dữ liệu của phạm vi thay đổi (tồn kho, danh mục, độc giả) -> tăng version kết quả tra cứu"""
+    return bump_version(SEARCH_VERSION_KEY.format(scope=scope))
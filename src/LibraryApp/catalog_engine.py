@@ -0,0 +1,366 @@
+"""
+Bộ máy tra cứu sách trong bộ nhớ (mỗi worker 1 bản), bật bằng
+settings.CATALOG_SEARCH_ENGINE = 'memory' (mặc định 'database').
+
+Chỉ mục gồm:
+- postings: token (đã chuẩn hóa bằng fold_text) -> mảng book_id đã sắp xếp;
+  từ khóa tìm theo tiền tố, các từ khóa giao nhau bằng tìm nhị phân trên mảng
+- Bitset (bit thứ book_id) cho thể loại và tình trạng còn sách; tác giả dùng
+  mảng book_id đã sắp xếp (bitset theo từng tác giả tốn bộ nhớ tỉ lệ với
+  book_id lớn nhất)
+- Thứ tự hiển thị mặc định theo tên sách
+
+Làm mới:
+- Xóa sách -> signal tăng version dùng chung, worker xây lại toàn bộ khi thấy version mới
+- Tồn kho / sách mới / sửa sách / sửa đầu sách, tác giả, thể loại (signal ghi lại
+  updated_at của các sách liên quan) -> đọc các sách có updated_at sau mốc (watermark)
+  và cập nhật từng sách. Mốc lùi lại WATERMARK_OVERLAP để không bỏ sót
+  transaction commit muộn hơn thời điểm ghi updated_at.
+Version và watermark được kiểm tra tối đa 1 lần / REFRESH_INTERVAL giây.
+Tra cứu không truy vấn database, view chỉ nạp sách của trang hiện tại.
+"""
+import threading
+import time
+from array import array
+from collections import Counter
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from .caching import CATALOG_VERSION_KEY, get_version
+from .search import fold_text, tokenize_query
+
+REFRESH_INTERVAL = 1.0
+WATERMARK_OVERLAP = timedelta(seconds=60)
+
+# Kiểu phần tử của mảng book_id (BigAutoField)
+ID_TYPECODE = 'q'
+# Mảng ngắn nhất không quá ngưỡng này -> giao bằng tìm nhị phân, ngược lại dùng set
+PROBE_LIMIT = 512
+
+
+class Bitset:
+    """Bitset trên bytearray: bit thứ i ứng với book_id i, bật/tắt 1 bit O(1)"""
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, i):
+        index = i >> 3
+        if index >= len(self.data):
+            self.data.extend(bytes(max(index + 1, 2 * len(self.data)) - len(self.data)))
+        self.data[index] |= 1 << (i & 7)
+
+    def discard(self, i):
+        index = i >> 3
+        if index < len(self.data):
+            self.data[index] &= ~(1 << (i & 7)) & 0xFF
+
+    def __contains__(self, i):
+        index = i >> 3
+        return index < len(self.data) and bool(self.data[index] >> (i & 7) & 1)
+
+    def to_int(self):
+        return int.from_bytes(self.data, 'little')
+
+
+class CatalogIndex:
+    """Chỉ mục đảo ngược của danh mục sách"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = None
+        self.watermark = None
+        self.checked_at = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.postings = {}
+        self.title_postings = {}
+        self.sorted_tokens = []
+        # book_id -> (title_key, category_id, author_ids, tokens, title_tokens)
+        self.books = {}
+        self.order = []
+        self.position = {}
+        self.category_bits = {}
+        self.author_postings = {}
+        self.available_bits = Bitset()
+        self.all_bits = Bitset()
+
+    # ---------- Nạp dữ liệu ----------
+
+    def _load(self, book_filter=None):
+        """Đọc sách và tác giả (2 truy vấn), trả về list tài liệu"""
+        from .models import Book, AuthorDetail
+
+        books = Book.objects.order_by().values_list(
+            'id', 'book_title_id', 'book_title__book_title', 'publisher', 'isbn',
+            'book_title__category_id', 'book_title__category__category_name',
+            'remaining_quantity', 'updated_at',
+        )
+        if book_filter is not None:
+            books = books.filter(book_filter)
+        books = list(books)
+
+        authors = {}
+        details = AuthorDetail.objects.order_by().values_list('book_title_id', 'author_id', 'author__author_name')
+        if book_filter is not None:
+            details = details.filter(book_title_id__in={book[1] for book in books})
+        for title_id, author_id, author_name in details:
+            authors.setdefault(title_id, []).append((author_id, author_name))
+
+        documents = []
+        for (book_id, title_id, title, publisher, isbn, category_id, category_name,
+             remaining, updated_at) in books:
+            book_authors = authors.get(title_id, [])
+            title_tokens = set(tokenize_query(title))
+            tokens = title_tokens | set(tokenize_query(' '.join([
+                publisher or '', isbn or '', category_name or '',
+                *(name for _, name in book_authors),
+            ])))
+            documents.append({
+                'id': book_id,
+                'title_key': fold_text(title),
+                'category_id': category_id,
+                'author_ids': tuple(sorted({author_id for author_id, _ in book_authors})),
+                'tokens': tuple(sorted(tokens)),
+                'title_tokens': tuple(sorted(title_tokens)),
+                'available': remaining > 0,
+                'updated_at': updated_at,
+            })
+        return documents
+
+    def rebuild(self):
+        """Xây lại toàn bộ chỉ mục"""
+        from django.utils import timezone
+
+        started = timezone.now()
+        documents = self._load()
+        with self.lock:
+            self._reset()
+            postings = {}
+            title_postings = {}
+            for doc in sorted(documents, key=lambda doc: doc['id']):
+                self._add(doc, postings, title_postings)
+            self.postings = {token: array(ID_TYPECODE, ids) for token, ids in postings.items()}
+            self.title_postings = {token: array(ID_TYPECODE, ids) for token, ids in title_postings.items()}
+            self.author_postings = {
+                author_id: array(ID_TYPECODE, ids) for author_id, ids in self.author_postings.items()
+            }
+            self.sorted_tokens = sorted(self.postings)
+            self._reorder()
+            self.watermark = max((doc['updated_at'] for doc in documents), default=started)
+
+    def _add(self, doc, postings=None, title_postings=None):
+        """
+        Thêm 1 sách. Khi xây lại: id tăng dần -> append vào list;
+        khi cập nhật từng sách: chèn vào mảng đã sắp xếp.
+        """
+        book_id = doc['id']
+        self.books[book_id] = (doc['title_key'], doc['category_id'], doc['author_ids'],
+                               doc['tokens'], doc['title_tokens'])
+        self.all_bits.add(book_id)
+        if doc['available']:
+            self.available_bits.add(book_id)
+        self.category_bits.setdefault(doc['category_id'], Bitset()).add(book_id)
+
+        if postings is not None:
+            for token in doc['tokens']:
+                postings.setdefault(token, []).append(book_id)
+            for token in doc['title_tokens']:
+                title_postings.setdefault(token, []).append(book_id)
+            for author_id in doc['author_ids']:
+                self.author_postings.setdefault(author_id, []).append(book_id)
+            return
+
+        for token in doc['tokens']:
+            if token not in self.postings:
+                self.postings[token] = array(ID_TYPECODE)
+                insort(self.sorted_tokens, token)
+            insort(self.postings[token], book_id)
+        for token in doc['title_tokens']:
+            insort(self.title_postings.setdefault(token, array(ID_TYPECODE)), book_id)
+        for author_id in doc['author_ids']:
+            insort(self.author_postings.setdefault(author_id, array(ID_TYPECODE)), book_id)
+
+    def _remove(self, book_id):
+        """Gỡ 1 sách khỏi chỉ mục"""
+        title_key, category_id, author_ids, tokens, title_tokens = self.books.pop(book_id)
+        self.all_bits.discard(book_id)
+        self.available_bits.discard(book_id)
+        self.category_bits[category_id].discard(book_id)
+        for token in tokens:
+            self._discard(self.postings, token, book_id)
+        for token in title_tokens:
+            self._discard(self.title_postings, token, book_id)
+        for author_id in author_ids:
+            self._discard(self.author_postings, author_id, book_id)
+
+    @staticmethod
+    def _discard(index, key, book_id):
+        ids = index.get(key)
+        if ids is None:
+            return
+        position = bisect_left(ids, book_id)
+        if position < len(ids) and ids[position] == book_id:
+            del ids[position]
+
+    def _reorder(self):
+        """Thứ tự hiển thị mặc định: tên sách (không dấu), rồi mã sách"""
+        self.order = sorted(self.books, key=lambda book_id: (self.books[book_id][0], book_id))
+        self.position = {book_id: position for position, book_id in enumerate(self.order)}
+
+    def apply_changes(self):
+        """Cập nhật các sách có updated_at sau watermark"""
+        from django.db.models import Q
+
+        documents = self._load(Q(updated_at__gte=self.watermark - WATERMARK_OVERLAP))
+        if not documents:
+            return
+        with self.lock:
+            reorder = False
+            for doc in documents:
+                old = self.books.get(doc['id'])
+                new = (doc['title_key'], doc['category_id'], doc['author_ids'],
+                       doc['tokens'], doc['title_tokens'])
+                if old == new:
+                    # Chỉ đổi tồn kho
+                    if doc['available']:
+                        self.available_bits.add(doc['id'])
+                    else:
+                        self.available_bits.discard(doc['id'])
+                    continue
+                if old is not None:
+                    self._remove(doc['id'])
+                self._add(doc)
+                reorder = True
+            if reorder:
+                self._reorder()
+            self.watermark = max(self.watermark, *(doc['updated_at'] for doc in documents))
+
+    def refresh(self, force=False):
+        """Kiểm tra version / watermark (tối đa 1 lần mỗi REFRESH_INTERVAL giây)"""
+        now = time.monotonic()
+        if not force and now - self.checked_at < REFRESH_INTERVAL:
+            return
+        with self.lock:
+            if not force and now - self.checked_at < REFRESH_INTERVAL:
+                return
+            version = get_version(CATALOG_VERSION_KEY)
+            if version != self.version or self.watermark is None:
+                self.rebuild()
+                self.version = version
+            else:
+                self.apply_changes()
+            self.checked_at = now
+
+    # ---------- Tra cứu ----------
+
+    def _token_ids(self, postings, token):
+        """Mảng book_id của mọi token có tiền tố `token` (đã sắp xếp, không trùng)"""
+        start = bisect_left(self.sorted_tokens, token)
+        arrays = []
+        for candidate in self.sorted_tokens[start:]:
+            if not candidate.startswith(token):
+                break
+            ids = postings.get(candidate)
+            if ids:
+                arrays.append(ids)
+        if len(arrays) == 1:
+            return arrays[0]
+        return array(ID_TYPECODE, sorted(set().union(*arrays)))
+
+    @staticmethod
+    def _contains(ids, book_id):
+        position = bisect_left(ids, book_id)
+        return position < len(ids) and ids[position] == book_id
+
+    def _intersect(self, lists):
+        """Giao các mảng đã sắp xếp, bắt đầu từ mảng ngắn nhất"""
+        lists = sorted(lists, key=len)
+        if len(lists[0]) <= PROBE_LIMIT:
+            return {
+                book_id for book_id in lists[0]
+                if all(self._contains(ids, book_id) for ids in lists[1:])
+            }
+        return set(lists[0]).intersection(*lists[1:])
+
+    def _in_order(self, ids):
+        """Sắp xếp tập id theo thứ tự hiển thị (tên sách)"""
+        if len(ids) * 8 < len(self.order):
+            return sorted(ids, key=self.position.__getitem__)
+        return [book_id for book_id in self.order if book_id in ids]
+
+    def _mask(self, category_id, status):
+        """Bitset (bytes) của bộ lọc thể loại / tình trạng, None nếu không lọc"""
+        mask = None
+        if category_id is not None:
+            bits = self.category_bits.get(category_id)
+            mask = bits.to_int() if bits is not None else 0
+        if status in ('available', 'unavailable'):
+            available = self.available_bits.to_int()
+            if status == 'unavailable':
+                available = self.all_bits.to_int() & ~available
+            mask = available if mask is None else mask & available
+        if mask is None:
+            return None
+        return mask.to_bytes(len(self.all_bits.data), 'little')
+
+    def search(self, text=None, category_id=None, author_id=None, status=None):
+        """
+        Danh sách book_id khớp bộ lọc.
+        Có từ khóa: sách khớp mọi từ khóa trong tên sách xếp trước, sau đó theo tên sách.
+        """
+        with self.lock:
+            mask = self._mask(category_id, status)
+            tokens = tokenize_query(text) if text else []
+
+            lists = [self._token_ids(self.postings, token) for token in tokens]
+            if author_id is not None:
+                lists.append(self.author_postings.get(author_id, array(ID_TYPECODE)))
+            candidates = self._intersect(lists) if lists else None
+
+            if mask is not None:
+                source = self.order if candidates is None else candidates
+                filtered = [book_id for book_id in source if mask[book_id >> 3] >> (book_id & 7) & 1]
+                if candidates is None:
+                    return filtered
+                candidates = set(filtered)
+            elif candidates is None:
+                return list(self.order)
+
+            if not tokens:
+                return self._in_order(candidates)
+
+            title_ids = self._intersect([self._token_ids(self.title_postings, token) for token in tokens])
+            in_title = candidates & title_ids
+            ranked = self._in_order(in_title) + self._in_order(candidates - in_title)
+
+            # Từ khóa là số -> sách có mã đó lên đầu (nếu thỏa các bộ lọc khác)
+            text = text.strip()
+            if text.isdigit() and int(text) in self.books:
+                book_id = int(text)
+                if mask is None or mask[book_id >> 3] >> (book_id & 7) & 1:
+                    if author_id is None or self._contains(self.author_postings.get(author_id, ()), book_id):
+                        ranked = [book_id] + [i for i in ranked if i != book_id]
+            return ranked
+
+    def facet_counts(self, book_ids):
+        """(Counter thể loại, Counter tác giả, số sách còn) của danh sách id kết quả"""
+        with self.lock:
+            rows = [(book_id, self.books[book_id]) for book_id in book_ids if book_id in self.books]
+            # Bitset chỉ dài tới book_id còn sách lớn nhất
+            return (
+                Counter(row[1] for _, row in rows),
+                Counter(author_id for _, row in rows for author_id in row[2]),
+                sum(book_id in self.available_bits for book_id, _ in rows),
+            )
+
+
+_catalog_index = CatalogIndex()
+
+
+def get_catalog_index():
+    """Chỉ mục của worker hiện tại, đã làm mới nếu đến hạn"""
+    _catalog_index.refresh()
+    return _catalog_index
@@ -1,95 +1,98 @@
 """
 Context processors for permission checking in templates
 """
-from .decorators import get_library_user, check_permission
+from .decorators import get_permission_snapshot
+
+
+# Cờ quyền dùng trong template -> danh sách (chức năng, loại quyền), chỉ cần 1 quyền thỏa
+PERMISSION_FLAGS = {
+    # Độc giả
+    'can_view_readers': [('Quản lý độc giả', 'view'), ('Lập thẻ độc giả', 'view')],
+    'can_add_readers': [('Lập thẻ độc giả', 'add')],
+    'can_edit_readers': [('Quản lý độc giả', 'edit')],
+    'can_change_rules': [('Thay đổi quy định', 'edit')],
+    # Sách
+    'can_view_books': [('Quản lý kho sách', 'view')],
+    'can_add_books': [('Lập phiếu nhập sách', 'add')],
+    # Mượn sách
+    'can_view_borrow': [('Quản lý mượn/trả', 'view')],
+    'can_add_borrow': [('Lập phiếu mượn sách', 'add')],
+    # Trả sách
+    'can_view_return': [('Quản lý mượn/trả', 'view')],
+    'can_add_return': [('Lập phiếu trả sách', 'add')],
+    # Phiếu thu
+    'can_view_receipt': [('Quản lý phiếu thu', 'view')],
+    'can_add_receipt': [('Lập phiếu thu tiền phạt', 'add')],
+    # Báo cáo
+    'can_view_reports': [('Báo cáo mượn sách theo thể loại', 'view'), ('Báo cáo sách trả trễ', 'view')],
+    # Cài đặt hệ thống (chỉ manager)
+    'can_view_settings': [('Thay đổi quy định', 'view')],
+    'can_view_users': [('Quản lý người dùng', 'view')],
+    'can_view_permissions': [],  # 'Quản lý quyền' không có trong init_data
+}
+
+
+class LazyPermissionFlag:
+    """
+    Cờ quyền chỉ được tính khi template đọc đến.
+    Template tự gọi callable khi resolve biến ({% if can_view_readers %}),
+    kết quả được ghi nhớ và số cờ đã đọc được đếm trên request.
+    """
+    def __init__(self, request, name):
+        self.request = request
+        self.name = name
+        self._value = None
+    
+    def __call__(self):
+        if self._value is None:
+            self._value = _resolve_flag(self.request, self.name)
+            self.request._permission_flags_read = getattr(self.request, '_permission_flags_read', 0) + 1
+        return self._value
+    
+    def __bool__(self):
+        return self()
+    
+    def __str__(self):
+        return str(self())
+
+
+def _resolve_flag(request, name):
+    """Tính giá trị 1 cờ quyền từ snapshot quyền của request"""
+    user = request.user
+    if not user.is_authenticated or not user.is_staff:
+        return False
+    
+    # Superuser có tất cả quyền
+    if user.is_superuser:
+        return True
+    
+    snapshot = get_permission_snapshot(request)
+    if snapshot is None:
+        # Staff không có LibraryUser - fallback cho phép view/add tất cả
+        return name.startswith('can_view') or name.startswith('can_add')
+    
+    return any(
+        snapshot.get(function_name, {}).get(permission_type, False)
+        for function_name, permission_type in PERMISSION_FLAGS[name]
+    )
 
 
 def user_permissions(request):
     """
     Thêm thông tin quyền của user vào context cho tất cả templates.
+    Các cờ can_* được tính lười: chỉ đọc snapshot quyền khi template dùng đến.
     
     Sử dụng trong template:
     {% if can_view_readers %}...{% endif %}
     {% if can_add_borrow %}...{% endif %}
     """
+    request._permission_flags_defined = len(PERMISSION_FLAGS)
     context = {
-        'is_manager': False,
-        'is_staff': False,
-        # Quyền cho từng chức năng
-        'can_view_readers': False,
-        'can_add_readers': False,
-        'can_edit_readers': False,
-        'can_view_books': False,
-        'can_add_books': False,
-        'can_view_borrow': False,
-        'can_add_borrow': False,
-        'can_view_return': False,
-        'can_add_return': False,
-        'can_view_receipt': False,
-        'can_add_receipt': False,
-        'can_view_reports': False,
-        'can_view_settings': False,
-        'can_view_users': False,
-        'can_view_permissions': False,
+        'is_manager': request.user.is_authenticated and request.user.is_superuser,
+        'is_staff': request.user.is_authenticated and (request.user.is_staff or request.user.is_superuser),
     }
-    
-    if not request.user.is_authenticated:
-        return context
-    
-    # Superuser có tất cả quyền
-    if request.user.is_superuser:
-        context['is_manager'] = True
-        context['is_staff'] = True
-        # Set all permissions to True
-        for key in context:
-            if key.startswith('can_'):
-                context[key] = True
-        return context
-    
-    # Staff user
-    if request.user.is_staff:
-        context['is_staff'] = True
-        
-        # Kiểm tra quyền từ Permission model
-        library_user = get_library_user(request.user)
-        if library_user:
-            # Độc giả
-            context['can_view_readers'] = library_user.has_permission('Quản lý độc giả', 'view') or library_user.has_permission('Lập thẻ độc giả', 'view')
-            context['can_add_readers'] = library_user.has_permission('Lập thẻ độc giả', 'add')
-            context['can_edit_readers'] = library_user.has_permission('Quản lý độc giả', 'edit')
-            context['can_change_rules'] = library_user.has_permission('Thay đổi quy định', 'edit')
-            
-            # Sách
-            context['can_view_books'] = library_user.has_permission('Quản lý kho sách', 'view')
-            context['can_add_books'] = library_user.has_permission('Lập phiếu nhập sách', 'add')
-            
-            # Mượn sách
-            context['can_view_borrow'] = library_user.has_permission('Quản lý mượn/trả', 'view')
-            context['can_add_borrow'] = library_user.has_permission('Lập phiếu mượn sách', 'add')
-            
-            # Trả sách
-            context['can_view_return'] = library_user.has_permission('Quản lý mượn/trả', 'view')
-            context['can_add_return'] = library_user.has_permission('Lập phiếu trả sách', 'add')
-            
-            # Phiếu thu
-            context['can_view_receipt'] = library_user.has_permission('Quản lý phiếu thu', 'view')
-            context['can_add_receipt'] = library_user.has_permission('Lập phiếu thu tiền phạt', 'add')
-            
-            # Báo cáo
-            context['can_view_reports'] = library_user.has_permission('Báo cáo mượn sách theo thể loại', 'view') or library_user.has_permission('Báo cáo sách trả trễ', 'view')
-            
-            # Cài đặt hệ thống (chỉ manager)
-            context['can_view_settings'] = library_user.has_permission('Thay đổi quy định', 'view')
-            context['can_view_users'] = library_user.has_permission('Quản lý người dùng', 'view')
-            # context['can_view_permissions'] = library_user.has_permission('Quản lý quyền', 'view') # Removed as not in init_data
-        else:
-            # Staff không có LibraryUser - fallback cho phép view tất cả
-            for key in context:
-                if key.startswith('can_view'):
-                    context[key] = True
-                if key.startswith('can_add'):
-                    context[key] = True
-    
+    for name in PERMISSION_FLAGS:
+        context[name] = LazyPermissionFlag(request, name)
     return context
 
 
@@ -43,6 +43,24 @@ def get_library_user(user):
         return None
 
 
+def get_permission_snapshot(request):
+    """
+    Lấy snapshot quyền của user hiện tại, ghi nhớ trên request.
+    Trả về dict {function_name: {'view', 'add', 'edit', 'delete'}} hoặc None
+    nếu không áp dụng (chưa đăng nhập, superuser, staff không có LibraryUser).
+    """
+    if not hasattr(request, '_permission_snapshot'):
+        snapshot = None
+        user = request.user
+        if user.is_authenticated and user.is_staff and not user.is_superuser:
+            library_user = get_library_user(user)
+            if library_user:
+                # Snapshot được nạp 1 lần trên LibraryUser (request.user giữ instance này)
+                snapshot = library_user.get_permission_snapshot()
+        request._permission_snapshot = snapshot
+    return request._permission_snapshot
+
+
 def check_permission(user, function_name, permission_type='view'):
     """
     Kiểm tra quyền của user với chức năng cụ thể
@@ -155,15 +173,11 @@ def staff_required(view_func):
             return redirect('home')
         
         # Staff: kiểm tra LibraryUser và Permission
-        library_user = get_library_user(request.user)
-        if library_user:
+        snapshot = get_permission_snapshot(request)
+        if snapshot is not None:
             # Có LibraryUser - kiểm tra có ít nhất 1 quyền nào đó
             # (Không block nếu user có ít nhất 1 permission)
-            from LibraryApp.models import Permission
-            has_any_permission = Permission.objects.filter(
-                user_group=library_user.user_group,
-                can_view=True
-            ).exists()
+            has_any_permission = any(flags['view'] for flags in snapshot.values())
             
             if not has_any_permission:
                 messages.error(request, 'Tài khoản của bạn chưa được phân quyền. Liên hệ quản trị viên.')
@@ -174,6 +188,78 @@ def staff_required(view_func):
     return wrapper
 
 
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def new_idempotency_key():
+    """Tạo khóa chống gửi trùng mới cho mỗi lần hiển thị form"""
+    import uuid
+    return uuid.uuid4().hex
+
+
+def idempotent(view_func):
+    """
+    Decorator chống gửi trùng cho POST ghi dữ liệu.
+    Form gửi kèm khóa (input ẩn idempotency_key hoặc header Idempotency-Key):
+    - Lần đầu: xử lý bình thường; nếu view trả về redirect (đã xử lý xong),
+      lưu đích redirect + thông báo để trả lại cho các lần gửi trùng.
+    - Gửi trùng: trả lại redirect + thông báo đã lưu, không chạy lại view
+      (không đụng tới tồn kho, nợ).
+    - View trả về trang (VD: form lỗi) hoặc lỗi: bỏ khóa để có thể gửi lại.
+    Không có khóa -> xử lý như cũ.
+    
+    Đặt sau permission_required:
+    @permission_required('Lập phiếu mượn sách', 'add')
+    @idempotent
+    def borrow_book_view(request):
+        ...
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        key = (request.POST.get(IDEMPOTENCY_FIELD) or request.headers.get(IDEMPOTENCY_HEADER) or '').strip()
+        if request.method != 'POST' or not key or len(key) > 64 or not request.user.is_authenticated:
+            return view_func(request, *args, **kwargs)
+        
+        from django.http import HttpResponseRedirect
+        from .models import IdempotencyKey
+        
+        record, created = IdempotencyKey.claim(request.user, view_func.__name__, key)
+        if not created:
+            if record.is_completed:
+                for item in record.messages:
+                    messages.add_message(request, item['level'], item['message'], extra_tags=item['extra_tags'])
+                messages.info(request, 'Yêu cầu này đã được xử lý trước đó, không thực hiện lại.')
+                return HttpResponseRedirect(record.location)
+            messages.warning(request, 'Yêu cầu đang được xử lý, vui lòng không gửi lại.')
+            return redirect(request.path)
+        
+        # Số thông báo có sẵn trước khi xử lý (duyệt storage rồi đặt used = False để không xóa thông báo)
+        storage = messages.get_messages(request)
+        existing = len(list(storage))
+        storage.used = False
+        
+        try:
+            response = view_func(request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        
+        if response.status_code in (301, 302, 303) and response.has_header('Location'):
+            # Thông báo được thêm trong request này (để hiển thị lại khi gửi trùng)
+            added = list(storage)[existing:]
+            storage.used = False
+            record.complete(response['Location'], [
+                {'level': m.level, 'message': str(m.message), 'extra_tags': m.extra_tags or ''}
+                for m in added
+            ])
+        else:
+            record.delete()
+        return response
+    
+    return wrapper
+
+
 def get_user_role_display(user):
     """
     Trả về vai trò của người dùng dưới dạng text
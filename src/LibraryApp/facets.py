@@ -0,0 +1,80 @@
+"""
+Đếm theo nhóm (facet) cho trang tra cứu sách: số sách theo thể loại, tác giả
+và tình trạng trong tập kết quả hiện tại, để thu hẹp kết quả bằng 1 cú nhấp.
+- Database: 1 truy vấn UNION ALL của các nhóm GROUP BY trên tập kết quả
+- Chỉ mục trong bộ nhớ (CATALOG_SEARCH_ENGINE=memory): đếm trên danh sách id
+Kết quả được cache theo chữ ký bộ lọc + version kết quả tra cứu sách.
+"""
+from collections import Counter
+
+# Số tác giả nhiều sách nhất được hiển thị
+AUTHOR_FACET_LIMIT = 20
+
+
+def _empty_facets():
+    return {'categories': [], 'authors': [], 'status': {'available': 0, 'unavailable': 0}}
+
+
+def _sorted_counts(counts, labels, limit=None):
+    """[{'id', 'name', 'count'}] theo số sách giảm dần, rồi theo tên"""
+    rows = sorted(
+        ({'id': key, 'name': labels.get(key, ''), 'count': count} for key, count in counts.items()),
+        key=lambda row: (-row['count'], row['name'])
+    )
+    return rows[:limit] if limit else rows
+
+
+def database_facets(books):
+    """Facet của queryset sách (1 truy vấn)"""
+    from django.db.models import Case, CharField, Count, F, IntegerField, Value, When
+    from .models import AuthorDetail
+
+    books = books.order_by()
+    categories = books.values(
+        kind=Value('category', output_field=CharField()),
+        key=F('book_title__category_id'),
+        label=F('book_title__category__category_name'),
+    ).annotate(count=Count('id'))
+    # Đếm qua bảng AuthorDetail: không dùng lại join của bộ lọc tác giả (giữ đồng tác giả)
+    authors = AuthorDetail.objects.filter(book_title__books__in=books.values('id')).values(
+        kind=Value('author', output_field=CharField()),
+        key=F('author_id'),
+        label=F('author__author_name'),
+    ).annotate(count=Count('book_title__books'))
+    status = books.values(
+        kind=Value('status', output_field=CharField()),
+        key=Case(When(remaining_quantity__gt=0, then=Value(1)), default=Value(0), output_field=IntegerField()),
+        label=Value('', output_field=CharField()),
+    ).annotate(count=Count('id'))
+
+    counts = {'category': Counter(), 'author': Counter(), 'status': Counter()}
+    labels = {'category': {}, 'author': {}}
+    for row in categories.union(authors, status, all=True):
+        counts[row['kind']][row['key']] += row['count']
+        if row['kind'] in labels:
+            labels[row['kind']][row['key']] = row['label']
+
+    return {
+        'categories': _sorted_counts(counts['category'], labels['category']),
+        'authors': _sorted_counts(counts['author'], labels['author'], AUTHOR_FACET_LIMIT),
+        'status': {'available': counts['status'][1], 'unavailable': counts['status'][0]},
+    }
+
+
+def memory_facets(index, book_ids):
+    """Facet của danh sách id từ chỉ mục trong bộ nhớ (chỉ truy vấn tên thể loại / tác giả)"""
+    from .models import Category, Author
+
+    if not book_ids:
+        return _empty_facets()
+    categories, authors, available = index.facet_counts(book_ids)
+    top_authors = dict(authors.most_common(AUTHOR_FACET_LIMIT))
+    return {
+        'categories': _sorted_counts(
+            categories, dict(Category.objects.filter(id__in=categories).values_list('id', 'category_name'))
+        ),
+        'authors': _sorted_counts(
+            top_authors, dict(Author.objects.filter(id__in=top_authors).values_list('id', 'author_name'))
+        ),
+        'status': {'available': available, 'unavailable': len(book_ids) - available},
+    }
@@ -189,7 +189,7 @@ class ReaderForm(forms.ModelForm):
         
         # Lấy tham số hệ thống
         try:
-            params = Parameter.objects.first()
+            params = Parameter.get_current()
             if not params:
                 raise ValidationError("Hệ thống chưa được cấu hình. Vui lòng liên hệ quản trị viên.")
             
@@ -274,74 +274,26 @@ class BorrowBookForm(forms.Form):
             raise ValidationError({'book_id': 'Vui lòng chọn ít nhất 1 quyển sách.'})
         
         # Lấy tham số hệ thống
-        try:
-            params = Parameter.objects.first()
-            if not params:
-                raise ValidationError("Hệ thống chưa được cấu hình.")
-        except Parameter.DoesNotExist:
+        if not Parameter.get_current():
             raise ValidationError("Hệ thống chưa được cấu hình.")
         
-        # Kiểm tra độc giả tồn tại
-        try:
-            reader = Reader.objects.get(id=reader_id)
-        except Reader.DoesNotExist:
-            raise ValidationError({
-                'reader_id': 'Độc giả không tồn tại.'
-            })
-        
-        # QĐ4.1: Kiểm tra thẻ còn hạn
-        from datetime import date, datetime
-        today = date.today()
-        if reader.expiration_date and reader.expiration_date.date() < today:
-            raise ValidationError({
-                'reader_id': f'Thẻ độc giả đã hết hạn (hết hạn: {reader.expiration_date.strftime("%d/%m/%Y")}).'
-            })
-        
-        # QĐ4.2: Kiểm tra độc giả không có sách mượn quá hạn (nếu setting yêu cầu)
-        if not params.allow_borrow_when_overdue:
-            overdue_borrows = BorrowReturnReceipt.objects.filter(
-                reader=reader,
-                return_date__isnull=True,
-                due_date__lt=today
-            ).exists()
-            if overdue_borrows:
-                raise ValidationError({
-                    'reader_id': 'Độc giả có sách mượn quá hạn. Vui lòng trả sách trước khi mượn thêm.'
-                })
-        
-        # QĐ4.4: Kiểm tra số sách đang mượn + số sách chọn không vượt quá tối đa
-        current_borrowed = BorrowReturnReceipt.objects.filter(
-            reader=reader,
-            return_date__isnull=True
-        ).count()
+        # Kiểm tra điều kiện mượn cho cả giỏ sách (số truy vấn cố định)
+        from .services import check_borrow_eligibility
+        result = check_borrow_eligibility(reader_id, book_ids)
         
-        total_will_borrow = current_borrowed + len(book_ids)
-        if total_will_borrow > params.max_borrowed_books:
-            raise ValidationError({
-                'reader_id': f'Độc giả đang mượn {current_borrowed} quyển. Chỉ có thể mượn thêm {params.max_borrowed_books - current_borrowed} quyển nữa (tối đa {params.max_borrowed_books}).'
-            })
+        # QĐ4.1, QĐ4.2, QĐ4.4: Lỗi về độc giả (báo lỗi đầu tiên như trước)
+        if result['reader_errors']:
+            raise ValidationError({'reader_id': result['reader_errors'][0]})
         
-        # Kiểm tra tất cả sách tồn tại và có sách còn sẵn
-        books = {}
-        for book_id in book_ids:
-            try:
-                book = Book.objects.get(id=book_id)
-                books[book_id] = book
-            except Book.DoesNotExist:
-                raise ValidationError({
-                    'book_id': f'Sách (ID: {book_id}) không tồn tại.'
-                })
-            
-            # QĐ4.3: Kiểm tra sách không đang được mượn (còn sách có sẵn)
-            available_items = BookItem.objects.filter(book=book, is_borrowed=False).exists()
-            if not available_items:
-                raise ValidationError({
-                    'book_id': f'Sách "{book.book_title.book_title}" hiện đang không có sẵn (tất cả đang được mượn).'
-                })
+        # QĐ4.3: Sách tồn tại và còn sẵn
+        for row in result['books']:
+            if not row['ok']:
+                raise ValidationError({'book_id': row['error']})
         
         # Lưu lại book_ids đã parse
         cleaned_data['book_ids'] = book_ids
-        cleaned_data['books'] = books
+        cleaned_data['books'] = result['book_objects']
+        cleaned_data['reader'] = result['reader']
         
         return cleaned_data
     
@@ -669,7 +621,7 @@ class BookImportForm(forms.Form):
         
         # Lấy tham số hệ thống
         try:
-            params = Parameter.objects.first()
+            params = Parameter.get_current()
             if not params:
                 raise ValidationError("Hệ thống chưa được cấu hình. Vui lòng liên hệ quản trị viên.")
         except Parameter.DoesNotExist:
@@ -846,31 +798,16 @@ class ReturnBookForm(forms.Form):
     def save(self):
         """Lưu thông tin trả sách cho nhiều phiếu"""
         import json
-        from django.utils import timezone
         
         reader_id = self.cleaned_data['reader_id']
         book_item_ids = json.loads(self.cleaned_data['book_item_ids'])
         return_date = self.cleaned_data['return_date']
         
-        receipts_updated = []
-        try:
-            reader = Reader.objects.get(id=reader_id)
-            
-            # Cập nhật return_date cho các phiếu mượn
-            receipts = BorrowReturnReceipt.objects.filter(
-                reader=reader,
-                book_item_id__in=book_item_ids,
-                return_date__isnull=True
-            )
-            
-            for receipt in receipts:
-                receipt.return_date = return_date
-                receipt.save()
-                receipts_updated.append(receipt)
-                
-            return receipts_updated if receipts_updated else None
-        except Reader.DoesNotExist:
-            return None
+        # Trả tất cả phiếu theo tập (tiền phạt, trạng thái sách, nợ cập nhật theo lô)
+        from .services import return_books
+        receipts_updated = return_books(reader_id, book_item_ids, return_date)
+        
+        return receipts_updated if receipts_updated else None
 
 
 class ReceiptForm(forms.Form):
@@ -0,0 +1,20 @@
+"""
+Management command to rebuild DailyCirculationRollup and DailyPaymentRollup from borrow and payment receipts
+"""
+from django.core.management.base import BaseCommand
+from LibraryApp.models import DailyCirculationRollup, DailyPaymentRollup
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the daily circulation rollup (borrows, returns, late returns, late days '
+        'per date x category x book title x reader type) and the daily payment rollup '
+        '(fines collected per date x reader type) from all receipts. '
+        'Saved monthly category reports are discarded and rebuilt on next view'
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding daily circulation rollup...')
+        count = DailyCirculationRollup.rebuild_all()
+        payment_count = DailyPaymentRollup.rebuild_all()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} circulation and {payment_count} payment rollup rows.'))
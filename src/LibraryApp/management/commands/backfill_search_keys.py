@@ -0,0 +1,52 @@
+"""
+Management command to backfill the accent-insensitive search_key columns
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from LibraryApp.models import BookTitle, Author, Reader, Category
+from LibraryApp.search import fold_text
+
+# Model -> cột nguồn của search_key
+SEARCH_KEY_SOURCES = [
+    (BookTitle, 'book_title'),
+    (Author, 'author_name'),
+    (Reader, 'reader_name'),
+    (Category, 'category_name'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Fill search_key (accent/case folded names) for existing rows, in primary-key batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows read and updated per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        for model, source in SEARCH_KEY_SOURCES:
+            updated = 0
+            last_pk = 0
+            while True:
+                rows = list(
+                    model.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', source, 'search_key')[:batch_size]
+                )
+                if not rows:
+                    break
+                last_pk = rows[-1].pk
+                changed = []
+                for row in rows:
+                    key = fold_text(getattr(row, source))
+                    if row.search_key != key:
+                        row.search_key = key
+                        changed.append(row)
+                if changed:
+                    # bulk_update: không gọi save() (không full_clean, không signal)
+                    with transaction.atomic():
+                        model.objects.bulk_update(changed, ['search_key'])
+                    updated += len(changed)
+            self.stdout.write(f'{model._meta.db_table}: updated {updated} rows')
+        self.stdout.write(self.style.SUCCESS('Search keys are up to date.'))
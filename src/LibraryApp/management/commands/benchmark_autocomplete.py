@@ -0,0 +1,174 @@
+"""
+Management command to benchmark reader/book picker autocomplete latency
+"""
+import math
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from LibraryApp.autocomplete import rebuild, suggest
+from LibraryApp.models import (
+    ReaderType, Reader, Author, Category, BookTitle, AuthorDetail, Book, AutocompleteToken
+)
+from LibraryApp.search import fold_text
+
+FAMILY_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ', 'Hồ', 'Ngô', 'Dương', 'Lý']
+MIDDLE_NAMES = ['Văn', 'Thị', 'Hữu', 'Đức', 'Minh', 'Ngọc', 'Thanh', 'Quốc', 'Gia', 'Hoài', 'Xuân', 'Thu']
+GIVEN_NAMES = [
+    'An', 'Bình', 'Châu', 'Dũng', 'Đào', 'Giang', 'Hà', 'Hải', 'Hạnh', 'Hiếu', 'Hòa', 'Hùng', 'Khang',
+    'Khoa', 'Lan', 'Linh', 'Long', 'Mai', 'Nam', 'Nga', 'Nhân', 'Phúc', 'Phương', 'Quân', 'Quyên',
+    'Sơn', 'Tâm', 'Thảo', 'Thắng', 'Trang', 'Trí', 'Trung', 'Tú', 'Tuấn', 'Vân', 'Việt', 'Vy', 'Yến',
+]
+TITLE_WORDS = [
+    'Lập', 'trình', 'Python', 'cơ', 'bản', 'nâng', 'cao', 'Cấu', 'trúc', 'dữ', 'liệu', 'giải', 'thuật',
+    'Đắc', 'Nhân', 'Tâm', 'Lịch', 'sử', 'Việt', 'Nam', 'Kinh', 'tế', 'học', 'Toán', 'rời', 'rạc',
+    'Mạng', 'máy', 'tính', 'Hệ', 'điều', 'hành', 'Văn', 'hóa', 'Truyện', 'ngắn', 'Tiểu', 'thuyết',
+    'Khoa', 'học', 'Thiên', 'văn', 'Triết', 'Tâm', 'lý', 'Quản', 'trị', 'Marketing', 'Dế', 'Mèn',
+]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark reader/book autocomplete (p50/p95/p99) on synthetic data; '
+        'the data is created in a transaction that is rolled back unless --keep'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=200000, help='Synthetic readers to create')
+        parser.add_argument('--titles', type=int, default=100000, help='Synthetic book titles (1 book each)')
+        parser.add_argument('--queries', type=int, default=1000, help='Queries per picker')
+        parser.add_argument('--limit', type=int, default=20, help='Suggestions per query')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Commit the synthetic data and index')
+
+    def handle(self, *args, **options):
+        if options['readers'] < 1 or options['titles'] < 1 or options['queries'] < 1:
+            raise CommandError('--readers, --titles and --queries must be at least 1.')
+        self.random = random.Random(options['seed'])
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            readers = self._create_readers(options['readers'])
+            titles = self._create_books(options['titles'])
+            self.stdout.write(f'Created data in {time.perf_counter() - started:.1f}s')
+
+            started = time.perf_counter()
+            for kind in (AutocompleteToken.KIND_READER, AutocompleteToken.KIND_BOOK):
+                rebuild(kind)
+            tokens = AutocompleteToken.objects.count()
+            self.stdout.write(f'Built index ({tokens} tokens) in {time.perf_counter() - started:.1f}s')
+
+            self._run(
+                'Reader picker', AutocompleteToken.KIND_READER, readers,
+                Reader.objects.filter(is_active=True), options
+            )
+            self._run(
+                'Book picker', AutocompleteToken.KIND_BOOK, titles,
+                Book.objects.filter(remaining_quantity__gt=0).select_related('book_title'), options
+            )
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def _name(self):
+        return ' '.join([
+            self.random.choice(FAMILY_NAMES), self.random.choice(MIDDLE_NAMES), self.random.choice(GIVEN_NAMES)
+        ])
+
+    def _create_readers(self, count):
+        """Độc giả giả lập (bulk_create không gọi save() nên tự điền search_key, ngày hết hạn)"""
+        stamp = timezone.now().strftime('%Y%m%d%H%M%S')
+        reader_type = ReaderType.objects.first() or ReaderType.objects.create(reader_type_name='Benchmark')
+        now = timezone.now()
+        names = []
+        batch = []
+        for i in range(count):
+            name = self._name()
+            names.append((name, f'bench{stamp}.{i}@example.com'))
+            batch.append(Reader(
+                reader_name=name,
+                search_key=fold_text(name),
+                reader_type=reader_type,
+                date_of_birth='2000-01-01',
+                address='Benchmark',
+                email=names[-1][1],
+                card_creation_date=now,
+                expiration_date=now + timezone.timedelta(days=180),
+            ))
+            if len(batch) >= 2000:
+                Reader.objects.bulk_create(batch)
+                batch = []
+        Reader.objects.bulk_create(batch)
+        return names
+
+    def _create_books(self, count):
+        category = Category.objects.first() or Category.objects.create(category_name='Benchmark')
+        authors = []
+        for _ in range(max(1, count // 20)):
+            name = self._name()
+            authors.append(Author(author_name=name, search_key=fold_text(name)))
+        authors = Author.objects.bulk_create(authors, batch_size=2000)
+
+        samples = []
+        for start in range(0, count, 2000):
+            titles = []
+            for _ in range(min(2000, count - start)):
+                text = ' '.join(self.random.choices(TITLE_WORDS, k=self.random.randint(2, 6)))
+                titles.append(BookTitle(book_title=text, search_key=fold_text(text), category=category))
+            titles = BookTitle.objects.bulk_create(titles)
+            details = []
+            for title in titles:
+                for author in self.random.sample(authors, min(len(authors), self.random.randint(1, 2))):
+                    details.append(AuthorDetail(book_title=title, author=author))
+                    samples.append((title.book_title, author.author_name))
+            AuthorDetail.objects.bulk_create(details)
+            Book.objects.bulk_create([
+                Book(
+                    book_title=title, quantity=5, remaining_quantity=self.random.randint(0, 5),
+                    unit_price=0, publish_year=2020, publisher='Benchmark',
+                )
+                for title in titles
+            ])
+        return samples
+
+    def _queries(self, samples, count):
+        """Chuỗi nhập giả lập: tiền tố tên, tiền tố từ thứ 2, chuỗi con, tiền tố phần còn lại (email / tác giả)"""
+        queries = []
+        for _ in range(count):
+            first, second = self.random.choice(samples)
+            first = fold_text(first)
+            words = first.split()
+            shape = self.random.randrange(4)
+            if shape == 0:
+                queries.append(first[:self.random.randint(1, 6)])
+            elif shape == 1 and len(words) > 1:
+                word = self.random.choice(words[1:])
+                queries.append(word[:self.random.randint(2, len(word))] if len(word) > 1 else word)
+            elif shape == 2 and len(first) > 5:
+                start = self.random.randrange(len(first) - 4)
+                queries.append(first[start:start + self.random.randint(3, 5)])
+            else:
+                queries.append(fold_text(second)[:self.random.randint(3, 8)])
+        return queries
+
+    def _run(self, label, kind, samples, queryset, options):
+        timings = []
+        empty = 0
+        for query in self._queries(samples, options['queries']):
+            started = time.perf_counter()
+            results = suggest(kind, query, queryset, options['limit'])
+            timings.append((time.perf_counter() - started) * 1000)
+            empty += not results
+        self.stdout.write(
+            f'{label} ({connection.vendor}, {len(timings)} queries): '
+            f'p50={percentile(timings, 50):.2f}ms p95={percentile(timings, 95):.2f}ms '
+            f'p99={percentile(timings, 99):.2f}ms max={max(timings):.2f}ms, no results={empty}'
+        )
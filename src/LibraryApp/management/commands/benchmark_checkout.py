@@ -0,0 +1,147 @@
+"""
+Management command to benchmark concurrent checkouts of a single hot title
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, OperationalError
+from django.utils import timezone
+
+from LibraryApp.models import (
+    Parameter, ReaderType, Reader, Category, BookTitle, Book, BookItem, BorrowReturnReceipt
+)
+from LibraryApp.services import allocate_book_items
+
+
+def allocate_first(book_id):
+    """Cách cũ: mọi transaction khóa cùng cuốn có id nhỏ nhất"""
+    item = BookItem.objects.select_for_update().filter(book_id=book_id, is_borrowed=False).first()
+    return [item] if item else []
+
+
+ALLOCATORS = {
+    'skip-locked': lambda book_id: allocate_book_items(book_id),
+    'first': allocate_first,
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent checkouts of one title with N threads (creates and removes its own data)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Number of concurrent workers')
+        parser.add_argument('--copies', type=int, default=200, help='Copies of the hot title to check out')
+        parser.add_argument('--hold-ms', type=int, default=5,
+                            help='Time each checkout transaction keeps running after allocating a copy')
+        parser.add_argument('--allocator', choices=sorted(ALLOCATORS), default='skip-locked')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark data')
+
+    def handle(self, *args, **options):
+        params = Parameter.get_current()
+        if not params:
+            raise CommandError('Parameter is not configured. Run init_data first.')
+
+        threads = options['threads']
+        if threads < 1:
+            raise CommandError('--threads must be at least 1.')
+        copies = options['copies']
+        hold = options['hold_ms'] / 1000
+        allocate = ALLOCATORS[options['allocator']]
+
+        book, readers = self._create_data(params, threads, copies)
+        stats = {'checkouts': 0, 'retries': 0, 'items': []}
+        lock = threading.Lock()
+
+        def worker(reader):
+            try:
+                while True:
+                    try:
+                        with transaction.atomic():
+                            items = allocate(book.id)
+                            if not items:
+                                return
+                            time.sleep(hold)
+                            now = timezone.now()
+                            BorrowReturnReceipt.objects.create(
+                                reader=reader,
+                                book_item=items[0],
+                                borrow_date=now,
+                                due_date=now + timedelta(days=params.max_borrow_days),
+                            )
+                    except OperationalError:
+                        # SQLite: database is locked -> thử lại
+                        with lock:
+                            stats['retries'] += 1
+                        time.sleep(0.001)
+                        continue
+                    with lock:
+                        stats['checkouts'] += 1
+                        stats['items'].append(items[0].id)
+            finally:
+                connection.close()
+
+        self.stdout.write(
+            f'Checking out {copies} copies with {threads} threads '
+            f'(allocator={options["allocator"]}, backend={connection.vendor})...'
+        )
+        workers = [threading.Thread(target=worker, args=(reader,)) for reader in readers]
+        started = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        duplicates = len(stats['items']) - len(set(stats['items']))
+        self.stdout.write(f'Checkouts:  {stats["checkouts"]}')
+        self.stdout.write(f'Retries:    {stats["retries"]}')
+        self.stdout.write(f'Elapsed:    {elapsed:.2f}s')
+        self.stdout.write(f'Throughput: {stats["checkouts"] / elapsed:.1f} checkouts/s')
+        if duplicates:
+            self.stdout.write(self.style.ERROR(f'{duplicates} copies were allocated more than once!'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No copy was allocated twice.'))
+
+        if not options['keep']:
+            self._delete_data(book, readers)
+
+    def _create_data(self, params, threads, copies):
+        """Tạo 1 đầu sách với `copies` cuốn và mỗi luồng 1 độc giả"""
+        stamp = timezone.now().strftime('%Y%m%d%H%M%S')
+        reader_type = ReaderType.objects.first() or ReaderType.objects.create(reader_type_name='Benchmark')
+        birth = timezone.localdate() - timedelta(days=366 * (params.min_age + 1))
+        readers = [
+            Reader.objects.create(
+                reader_name=f'Benchmark {i}',
+                reader_type=reader_type,
+                date_of_birth=birth,
+                address='Benchmark',
+                email=f'benchmark-{stamp}-{i}@example.com',
+            )
+            for i in range(threads)
+        ]
+        category = Category.objects.first() or Category.objects.create(category_name='Benchmark')
+        title = BookTitle.objects.create(book_title=f'Benchmark {stamp}', category=category)
+        book = Book.objects.create(
+            book_title=title,
+            quantity=copies,
+            remaining_quantity=copies,
+            unit_price=0,
+            publish_year=timezone.localdate().year,
+            publisher='Benchmark',
+        )
+        BookItem.objects.bulk_create([
+            BookItem(book=book, barcode=f'BENCH-{stamp}-{i:05d}') for i in range(copies)
+        ])
+        return book, readers
+
+    def _delete_data(self, book, readers):
+        BorrowReturnReceipt.objects.filter(book_item__book=book).delete()
+        BookItem.objects.filter(book=book).delete()
+        title = book.book_title
+        book.delete()
+        title.delete()
+        for reader in readers:
+            reader.delete()
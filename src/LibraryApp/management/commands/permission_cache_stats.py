@@ -0,0 +1,22 @@
+"""
+Management command to show permission cache hit/miss counters
+"""
+from django.core.management.base import BaseCommand
+from LibraryApp.caching import get_permission_cache_stats, reset_permission_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show permission cache hit/miss counters (shared across workers)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset counters after printing')
+
+    def handle(self, *args, **options):
+        stats = get_permission_cache_stats()
+        self.stdout.write(f"Hits:     {stats['hits']}")
+        self.stdout.write(f"Misses:   {stats['misses']}")
+        self.stdout.write(f"Hit rate: {stats['hit_rate']}%")
+
+        if options['reset']:
+            reset_permission_cache_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
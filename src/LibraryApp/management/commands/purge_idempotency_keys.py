@@ -0,0 +1,13 @@
+"""
+Management command to delete expired idempotency keys
+"""
+from django.core.management.base import BaseCommand
+from LibraryApp.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys whose TTL has expired (run daily, e.g. from cron)'
+
+    def handle(self, *args, **options):
+        deleted = IdempotencyKey.purge_expired()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys.'))
@@ -0,0 +1,22 @@
+"""
+Management command to rebuild the reader/book autocomplete token index
+"""
+from django.core.management.base import BaseCommand
+from LibraryApp.autocomplete import rebuild
+from LibraryApp.models import AutocompleteToken
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the prefix/trigram autocomplete index used by the reader and book pickers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kind', choices=[kind for kind, _ in AutocompleteToken.KIND_CHOICES],
+            help='Only rebuild one kind (default: all)'
+        )
+
+    def handle(self, *args, **options):
+        kinds = [options['kind']] if options['kind'] else [kind for kind, _ in AutocompleteToken.KIND_CHOICES]
+        for kind in kinds:
+            indexed = rebuild(kind)
+            self.stdout.write(self.style.SUCCESS(f'{kind}: indexed {indexed} objects.'))
@@ -0,0 +1,14 @@
+"""
+Management command to rebuild ReaderCirculationSummary from borrow receipts
+"""
+from django.core.management.base import BaseCommand
+from LibraryApp.models import ReaderCirculationSummary
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-reader circulation summary (open loans, overdue, due dates, debt)'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding reader circulation summary...')
+        count = ReaderCirculationSummary.rebuild_all()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} reader summaries.'))
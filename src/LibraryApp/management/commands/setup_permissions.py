@@ -79,16 +79,16 @@ class Command(BaseCommand):
                 'Quản lý quyền': {'can_view': False, 'can_add': False, 'can_edit': False, 'can_delete': False},
             }
             
+            matrix = {}
             for func_name, perms in thu_thu_permissions.items():
                 func = functions.get(func_name)
                 if func:
-                    perm, created = Permission.objects.update_or_create(
-                        user_group=thu_thu,
-                        function=func,
-                        defaults=perms
-                    )
-                    status = 'Created' if created else 'Updated'
-                    self.stdout.write(f"  - {func_name}: {status}")
+                    matrix[func.id] = {
+                        key: perms[field] for key, field in Permission.FLAG_FIELDS.items()
+                    }
+            
+            created, updated = Permission.apply_matrix(thu_thu, matrix)
+            self.stdout.write(f"  - Created: {created}, Updated: {updated}, Unchanged: {len(matrix) - created - updated}")
         
         # 4. Link existing staff users to LibraryUser if not already linked
         self.stdout.write('\nChecking staff users...')
@@ -0,0 +1,28 @@
+"""
+Middleware ghi log thống kê theo request
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PermissionFlagStatsMiddleware:
+    """
+    Ghi log số cờ quyền (can_*) template thực sự đọc trong mỗi request.
+    Request không render template (redirect, API JSON) ghi 0/0.
+    Bật bằng LIBRARY_LOG_LEVEL=DEBUG.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'Permission flags read %s/%s: %s %s',
+                getattr(request, '_permission_flags_read', 0),
+                getattr(request, '_permission_flags_defined', 0),
+                request.method,
+                request.path,
+            )
+        return response
@@ -3,6 +3,64 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+
+from .search import fold_text
+
+
+# ==================== DATABASE FUNCTIONS ====================
+
+class DaysBetween(models.Func):
+    """
+    Số ngày giữa 2 biểu thức ngày (end - start), tính trong database.
+    Dùng cho ngày đã quy về giờ địa phương (TruncDate theo TIME_ZONE).
+    """
+    output_field = models.IntegerField()
+    arity = 2
+    
+    def __init__(self, end, start, **extra):
+        super().__init__(end, start, **extra)
+    
+    def as_sql(self, compiler, connection, **extra_context):
+        # MySQL / MariaDB
+        return super().as_sql(compiler, connection, template='DATEDIFF(%(expressions)s)', **extra_context)
+    
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection,
+            template='CAST(julianday(%(expressions)s) AS INTEGER)',
+            arg_joiner=') - julianday(',
+            **extra_context
+        )
+    
+    def as_postgresql(self, compiler, connection, **extra_context):
+        # date - date trả về số nguyên (ngày)
+        return super().as_sql(
+            compiler, connection,
+            template='(%(expressions)s)',
+            arg_joiner=' - ',
+            **extra_context
+        )
+
+
+def local_today_range():
+    """Ngày hôm nay (giờ địa phương) và thời điểm 00:00 hôm nay (aware)"""
+    from datetime import datetime, time
+    today = timezone.localdate()
+    start_of_today = timezone.make_aware(datetime.combine(today, time.min))
+    return today, start_of_today
+
+
+def sync_search_key(instance, source_field, save_kwargs):
+    """
+    Cập nhật cột search_key (chuỗi không dấu, chữ thường) từ cột nguồn trước khi lưu.
+    save(update_fields=[...]) có cột nguồn -> ghi kèm search_key.
+    """
+    instance.search_key = fold_text(getattr(instance, source_field))
+    update_fields = save_kwargs.get('update_fields')
+    if update_fields is not None and source_field in update_fields:
+        save_kwargs['update_fields'] = {*update_fields, 'search_key'}
+
 
 # ==================== SYSTEM PARAMETERS ====================
 
@@ -153,6 +211,30 @@ class Parameter(models.Model):
             if existing:
                 self.pk = existing.pk
         super().save(*args, **kwargs)
+        self.invalidate_cache()
+    
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.invalidate_cache()
+        return result
+    
+    @classmethod
+    def get_current(cls):
+        """
+        Lấy tham số hệ thống hiện tại (thay cho Parameter.objects.first()).
+        Được cache trong process và vô hiệu hóa theo version dùng chung khi lưu.
+        Instance trả về dùng chung - chỉ đọc, muốn sửa thì lấy bản ghi từ database.
+        """
+        from .caching import get_current_parameter
+        return get_current_parameter(lambda: cls.objects.first())
+    
+    @classmethod
+    def invalidate_cache(cls):
+        """Vô hiệu hóa cache Parameter (process hiện tại ngay, các worker khác sau commit)"""
+        from django.db import transaction
+        from .caching import invalidate_parameter
+        invalidate_parameter(shared=False)
+        transaction.on_commit(invalidate_parameter)
 
 
 class ReaderType(models.Model):
@@ -180,6 +262,38 @@ class ReaderType(models.Model):
         return self.reader_type_name
 
 
+class ReaderQuerySet(models.QuerySet):
+    """QuerySet cho Reader"""
+    
+    def with_pending_debt(self):
+        """
+        Annotate nợ dự tính từ sách đang mượn quá hạn, tính hoàn toàn trong SQL:
+        - pending_overdue_days: tổng số ngày quá hạn của các phiếu chưa trả (chưa hủy)
+        - pending_fine: pending_overdue_days * đơn giá phạt
+        - debt_with_pending: total_debt + pending_fine
+        Ngày quá hạn so theo ngày địa phương, giống BorrowReturnReceipt.days_overdue.
+        """
+        today, start_of_today = local_today_range()
+        params = Parameter.get_current()
+        fine_rate = params.fine_rate if params else 0
+        
+        overdue_days = BorrowReturnReceipt.objects.filter(
+            reader=models.OuterRef('pk'),
+            return_date__isnull=True,
+            is_cancelled=False,
+            due_date__lt=start_of_today,
+        ).order_by().values('reader').annotate(
+            days=models.Sum(DaysBetween(models.Value(today, output_field=models.DateField()), TruncDate('due_date')))
+        ).values('days')
+        
+        return self.annotate(
+            pending_overdue_days=Coalesce(models.Subquery(overdue_days, output_field=models.IntegerField()), 0),
+        ).annotate(
+            pending_fine=models.F('pending_overdue_days') * fine_rate,
+            debt_with_pending=models.F('total_debt') + models.F('pending_overdue_days') * fine_rate,
+        )
+
+
 class Reader(models.Model):
     """
     Bảng READER - Thông tin độc giả
@@ -188,6 +302,14 @@ class Reader(models.Model):
         max_length=255,
         verbose_name='Tên độc giả'
     )
+    search_key = models.CharField(
+        max_length=255,
+        verbose_name='Khóa tìm kiếm (không dấu)',
+        blank=True,
+        default='',
+        editable=False,
+        db_index=True
+    )
     reader_type = models.ForeignKey(
         ReaderType,
         on_delete=models.PROTECT,
@@ -229,13 +351,16 @@ class Reader(models.Model):
 
     @property
     def pending_debt(self):
-        """Tính nợ dự kiến từ sách chưa trả"""
-        pending = 0
-        active_receipts = self.borrow_receipts.filter(return_date__isnull=True)
-        for receipt in active_receipts:
-            if receipt.is_overdue:
-                pending += receipt.calculate_fine()
-        return pending
+        """
+        Tính nợ dự kiến từ sách chưa trả.
+        Dùng giá trị annotate từ Reader.objects.with_pending_debt() nếu có,
+        ngược lại tính bằng 1 truy vấn và ghi nhớ trên instance.
+        """
+        if 'pending_fine' not in self.__dict__:
+            self.pending_fine = Reader.objects.with_pending_debt().filter(
+                pk=self.pk
+            ).values_list('pending_fine', flat=True).first() or 0
+        return self.pending_fine
 
     @property
     def total_debt_with_pending(self):
@@ -254,6 +379,8 @@ class Reader(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = ReaderQuerySet.as_manager()
+    
     class Meta:
         db_table = 'reader'
         verbose_name = 'Độc giả'
@@ -264,6 +391,12 @@ class Reader(models.Model):
             models.Index(fields=['reader_type']),
             models.Index(fields=['is_active']),
         ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(total_debt__gte=0),
+                name='reader_total_debt_non_negative',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.reader_name} - {self.email}"
@@ -304,7 +437,7 @@ class Reader(models.Model):
         
         # Lấy tham số hệ thống
         try:
-            params = Parameter.objects.first()
+            params = Parameter.get_current()
             if not params:
                 raise ValidationError("Chưa cấu hình tham số hệ thống!")
             
@@ -330,7 +463,7 @@ class Reader(models.Model):
         if not self.expiration_date:
             from dateutil.relativedelta import relativedelta
             try:
-                params = Parameter.objects.first()
+                params = Parameter.get_current()
                 months = params.card_validity_period if params else 6
             except:
                 months = 6
@@ -339,6 +472,7 @@ class Reader(models.Model):
         # Validate trước khi lưu
         self.full_clean()
         
+        sync_search_key(self, 'reader_name', kwargs)
         super().save(*args, **kwargs)
 
 
@@ -350,6 +484,14 @@ class Author(models.Model):
         max_length=255,
         verbose_name='Tên tác giả'
     )
+    search_key = models.CharField(
+        max_length=255,
+        verbose_name='Khóa tìm kiếm (không dấu)',
+        blank=True,
+        default='',
+        editable=False,
+        db_index=True
+    )
     bio = models.TextField(
         verbose_name='Tiểu sử',
         blank=True,
@@ -365,6 +507,10 @@ class Author(models.Model):
     def __str__(self):
         return self.author_name
 
+    def save(self, *args, **kwargs):
+        sync_search_key(self, 'author_name', kwargs)
+        super().save(*args, **kwargs)
+
 
 class Category(models.Model):
     """
@@ -375,6 +521,14 @@ class Category(models.Model):
         verbose_name='Tên thể loại',
         unique=True
     )
+    search_key = models.CharField(
+        max_length=100,
+        verbose_name='Khóa tìm kiếm (không dấu)',
+        blank=True,
+        default='',
+        editable=False,
+        db_index=True
+    )
     description = models.TextField(
         verbose_name='Mô tả',
         blank=True,
@@ -390,6 +544,10 @@ class Category(models.Model):
     def __str__(self):
         return self.category_name
 
+    def save(self, *args, **kwargs):
+        sync_search_key(self, 'category_name', kwargs)
+        super().save(*args, **kwargs)
+
 
 class BookTitle(models.Model):
     """
@@ -399,6 +557,14 @@ class BookTitle(models.Model):
         max_length=500,
         verbose_name='Tên tựa sách'
     )
+    search_key = models.CharField(
+        max_length=500,
+        verbose_name='Khóa tìm kiếm (không dấu)',
+        blank=True,
+        default='',
+        editable=False,
+        db_index=True
+    )
     category = models.ForeignKey(
         Category,
         on_delete=models.PROTECT,
@@ -433,6 +599,10 @@ class BookTitle(models.Model):
     def __str__(self):
         return self.book_title
     
+    def save(self, *args, **kwargs):
+        sync_search_key(self, 'book_title', kwargs)
+        super().save(*args, **kwargs)
+    
     @property
     def total_books(self):
         """Tổng số sách thuộc tựa sách này"""
@@ -537,6 +707,18 @@ class Book(models.Model):
             models.Index(fields=['book_title']),
             models.Index(fields=['publish_year']),
             models.Index(fields=['publisher']),
+            # Mốc cập nhật của chỉ mục tra cứu trong bộ nhớ
+            models.Index(fields=['updated_at']),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(remaining_quantity__gte=0),
+                name='book_remaining_quantity_non_negative',
+            ),
+            models.CheckConstraint(
+                condition=models.Q(remaining_quantity__lte=models.F('quantity')),
+                name='book_remaining_quantity_lte_quantity',
+            ),
         ]
     
     def __str__(self):
@@ -563,7 +745,7 @@ class Book(models.Model):
         
         # Kiểm tra năm xuất bản theo tham số hệ thống (Năm XB tối đa)
         try:
-            params = Parameter.objects.first()
+            params = Parameter.get_current()
             if params:
                 from datetime import date
                 current_year = date.today().year
@@ -626,6 +808,8 @@ class BookItem(models.Model):
         indexes = [
             models.Index(fields=['book']),
             models.Index(fields=['is_borrowed']),
+            # Cấp cuốn còn sẵn của 1 đầu sách khi cho mượn
+            models.Index(fields=['book', 'is_borrowed', 'id']),
         ]
     
     def __str__(self):
@@ -776,14 +960,12 @@ class BookImportDetail(models.Model):
                 # Book was just created, set quantity instead of adding
                 self.book.quantity = self.quantity
                 self.book.remaining_quantity = self.quantity
+                self.book.unit_price = self.unit_price
+                self.book.save(update_fields=['quantity', 'remaining_quantity', 'unit_price'])
             else:
-                # Book already existed, add to existing quantity
-                self.book.quantity += self.quantity
-                self.book.remaining_quantity += self.quantity
-            
-            # Always update to latest unit price
-            self.book.unit_price = self.unit_price
-            self.book.save(update_fields=['quantity', 'remaining_quantity', 'unit_price'])
+                # Book already existed, add to existing quantity (UPDATE nguyên tử)
+                from .services import add_stock
+                add_stock(self.book_id, self.quantity, unit_price=self.unit_price)
             
             # Tạo các BookItem tương ứng (only for new imports)
             from django.db import transaction
@@ -812,6 +994,35 @@ class BookImportDetail(models.Model):
 
 # ==================== BORROW & RETURN MANAGEMENT ====================
 
+class BorrowReturnReceiptQuerySet(models.QuerySet):
+    """QuerySet cho BorrowReturnReceipt"""
+    
+    def with_overdue(self):
+        """
+        Annotate thông tin trễ hạn, tính trong database theo TIME_ZONE cấu hình:
+        - local_due_date: ngày phải trả (giờ địa phương)
+        - days_overdue: số ngày trễ (ngày trả hoặc hôm nay - ngày phải trả, tối thiểu 0)
+        - fine: days_overdue * đơn giá phạt hiện tại
+        Cho phép lọc/sắp xếp theo days_overdue ở phía database.
+        """
+        today, _ = local_today_range()
+        params = Parameter.get_current()
+        fine_rate = params.fine_rate if params else 0
+        
+        return self.annotate(
+            local_due_date=TruncDate('due_date'),
+            days_overdue=Greatest(
+                DaysBetween(
+                    Coalesce(TruncDate('return_date'), models.Value(today, output_field=models.DateField())),
+                    TruncDate('due_date'),
+                ),
+                models.Value(0),
+            ),
+        ).annotate(
+            fine=models.F('days_overdue') * fine_rate,
+        )
+
+
 class BorrowReturnReceipt(models.Model):
     """
     Phiếu mượn/trả sách
@@ -877,6 +1088,8 @@ class BorrowReturnReceipt(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Ngày tạo')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Ngày cập nhật')
     
+    objects = BorrowReturnReceiptQuerySet.as_manager()
+    
     class Meta:
         db_table = 'borrow_return_receipt'
         verbose_name = 'Phiếu mượn/trả sách'
@@ -885,8 +1098,8 @@ class BorrowReturnReceipt(models.Model):
         indexes = [
             models.Index(fields=['reader']),
             models.Index(fields=['book_item']),
-            models.Index(fields=['-borrow_date']),
-            models.Index(fields=['return_date']),
+            models.Index(fields=['-borrow_date', '-id']),
+            models.Index(fields=['return_date', 'id']),
         ]
     
     def __str__(self):
@@ -900,9 +1113,10 @@ class BorrowReturnReceipt(models.Model):
     @property
     def is_overdue(self):
         """Kiểm tra có trễ hạn không"""
-    @property
-    def is_overdue(self):
-        """Kiểm tra có trễ hạn không"""
+        if '_days_overdue' in self.__dict__:
+            # Đã annotate bởi BorrowReturnReceipt.objects.with_overdue()
+            return self._days_overdue > 0
+        
         current_due_date = self.due_date
         if hasattr(current_due_date, 'date'):
              current_due_date = timezone.localtime(current_due_date).date()
@@ -917,6 +1131,9 @@ class BorrowReturnReceipt(models.Model):
     @property
     def days_overdue(self):
         """Số ngày trễ hạn"""
+        if '_days_overdue' in self.__dict__:
+            return self._days_overdue
+        
         if not self.is_overdue:
             return 0
         
@@ -938,13 +1155,21 @@ class BorrowReturnReceipt(models.Model):
         
         return max(0, delta.days)
     
+    @days_overdue.setter
+    def days_overdue(self, value):
+        """Nhận giá trị annotate từ with_overdue()"""
+        self._days_overdue = value
+    
     def calculate_fine(self):
         """Tính tiền phạt dựa trên số ngày trễ"""
+        if 'fine' in self.__dict__:
+            return self.fine
+        
         if not self.is_overdue:
             return 0
         
         try:
-            param = Parameter.objects.first()
+            param = Parameter.get_current()
             return self.days_overdue * param.fine_rate
         except:
             return 0
@@ -964,12 +1189,16 @@ class BorrowReturnReceipt(models.Model):
             })
     
     def save(self, *args, **kwargs):
+        # Bỏ giá trị annotate (có thể đã cũ) để tính lại tiền phạt theo dữ liệu hiện tại
+        self.__dict__.pop('_days_overdue', None)
+        self.__dict__.pop('fine', None)
+        
         self.full_clean()
         
         # Nếu chưa có due_date, tính từ borrow_date + max_borrow_days
         if not self.due_date:
             try:
-                param = Parameter.objects.first()
+                param = Parameter.get_current()
                 self.due_date = self.borrow_date + timezone.timedelta(days=param.max_borrow_days)
             except:
                 self.due_date = self.borrow_date + timezone.timedelta(days=30)
@@ -980,37 +1209,37 @@ class BorrowReturnReceipt(models.Model):
         
         is_new = self.pk is None
         
+        # Lấy giá trị cũ từ DB để so sánh
+        old_receipt = None
+        if not is_new:
+            old_receipt = BorrowReturnReceipt.objects.filter(pk=self.pk).first()
+        
         # Kiểm tra xem có phải lần đầu trả sách không (return_date được set lần đầu)
-        is_first_return = False
-        if not is_new and self.return_date:
-            # Lấy giá trị cũ từ DB để so sánh
-            try:
-                old_receipt = BorrowReturnReceipt.objects.get(pk=self.pk)
-                if old_receipt.return_date is None:
-                    is_first_return = True
-            except BorrowReturnReceipt.DoesNotExist:
-                pass
+        is_first_return = bool(self.return_date and old_receipt and old_receipt.return_date is None)
         
         super().save(*args, **kwargs)
         
-        # Cập nhật trạng thái sách
+        # Bảng tổng hợp theo ngày: cộng phần của phiếu, trừ phần cũ khi ngày mượn / trả / hạn trả đổi
+        dates = (self.borrow_date, self.return_date, self.due_date)
+        if old_receipt is None:
+            DailyCirculationRollup.record_receipts([self])
+        elif dates != (old_receipt.borrow_date, old_receipt.return_date, old_receipt.due_date):
+            DailyCirculationRollup.record_receipts([self], removed=[old_receipt])
+        
+        # Cập nhật trạng thái sách (UPDATE nguyên tử, không đọc-sửa-ghi)
+        from .services import record_checkout, record_checkin, adjust_reader_debt
         if is_new:
             # Mượn sách mới
-            self.book_item.is_borrowed = True
-            self.book_item.save(update_fields=['is_borrowed'])
-            self.book_item.book.remaining_quantity -= 1
-            self.book_item.book.save(update_fields=['remaining_quantity'])
+            record_checkout(self.book_item)
         elif is_first_return:
             # Trả sách LẦN ĐẦU TIÊN
-            self.book_item.is_borrowed = False
-            self.book_item.save(update_fields=['is_borrowed'])
-            self.book_item.book.remaining_quantity += 1
-            self.book_item.book.save(update_fields=['remaining_quantity'])
+            record_checkin(self.book_item)
             
             # Cập nhật nợ của độc giả (chỉ cộng tiền phạt 1 lần)
             if self.fine_amount > 0:
-                self.reader.total_debt += self.fine_amount
-                self.reader.save(update_fields=['total_debt'])
+                adjust_reader_debt(self.reader_id, self.fine_amount)
+                if BorrowReturnReceipt.reader.is_cached(self):
+                    self.reader.total_debt += self.fine_amount
 
 
 # ==================== PAYMENT MANAGEMENT ====================
@@ -1077,7 +1306,7 @@ class Receipt(models.Model):
         ordering = ['-created_date']
         indexes = [
             models.Index(fields=['reader']),
-            models.Index(fields=['-created_date']),
+            models.Index(fields=['-created_date', '-id']),
         ]
     
     def __str__(self):
@@ -1086,7 +1315,7 @@ class Receipt(models.Model):
     def clean(self):
         """Validate số tiền thu"""
         try:
-            param = Parameter.objects.first()
+            param = Parameter.get_current()
             if param and param.enable_receipt_amount_validation:
                 if self.collected_amount > self.reader.total_debt:
                     raise ValidationError({
@@ -1101,31 +1330,219 @@ class Receipt(models.Model):
         
         # Check if this is an existing receipt being cancelled
         is_being_cancelled = False
+        old_receipt = None
         if not is_new:
-            try:
-                old_receipt = Receipt.objects.get(pk=self.pk)
-                # If old receipt was not cancelled, but current one is, it's being cancelled
-                if not old_receipt.is_cancelled and self.is_cancelled:
-                    is_being_cancelled = True
-            except Receipt.DoesNotExist:
-                pass
+            old_receipt = Receipt.objects.filter(pk=self.pk).first()
+            # If old receipt was not cancelled, but current one is, it's being cancelled
+            if old_receipt and not old_receipt.is_cancelled and self.is_cancelled:
+                is_being_cancelled = True
         
         self.full_clean()
         super().save(*args, **kwargs)
         
+        # Bảng tổng hợp theo ngày: tiền thu mới / hủy phiếu / sửa số tiền, ngày lập
+        values = (self.collected_amount, self.created_date, self.is_cancelled)
+        if old_receipt is None:
+            DailyPaymentRollup.record_payments([self])
+        elif values != (old_receipt.collected_amount, old_receipt.created_date, old_receipt.is_cancelled):
+            DailyPaymentRollup.record_payments([self], removed=[old_receipt])
+        
         # Trừ nợ của độc giả
         # - Chỉ trừ khi tạo mới phiếu thu (is_new=True)
         # - KHÔNG trừ khi đang hủy phiếu (is_being_cancelled=True) vì cancellation view đã cộng lại debt
         if is_new and not self.is_cancelled:
             # Phiếu mới và không bị hủy -> trừ nợ
+            from .services import adjust_reader_debt
+            adjust_reader_debt(self.reader_id, -self.collected_amount)
+            # Đồng bộ giá trị trên instance để hiển thị nợ còn lại
             self.reader.total_debt -= self.collected_amount
-            self.reader.save(update_fields=['total_debt'])
         elif is_being_cancelled:
             # Đang hủy phiếu -> KHÔNG làm gì (cancellation view đã xử lý)
             pass
         # else: Cập nhật phiếu thường -> KHÔNG trừ nợ thêm
 
 
+# ==================== CIRCULATION SUMMARY ====================
+
+class ReaderCirculationSummary(models.Model):
+    """
+    Bảng tổng hợp tình trạng mượn của từng độc giả (1 dòng / độc giả)
+    Được cập nhật trong cùng transaction với mượn, trả, hủy phiếu và thu tiền
+    (xem signals.py), dùng để kiểm tra QĐ4 mà không cần đếm lại phiếu mượn.
+    
+    overdue_count là số phiếu quá hạn tại lần cập nhật gần nhất; để kiểm tra
+    "đang có sách quá hạn" dùng has_overdue (so earliest_due_date với hôm nay).
+    Tính lại toàn bộ: python manage.py rebuild_circulation_summary
+    """
+    reader = models.OneToOneField(
+        Reader,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='circulation_summary',
+        verbose_name='Độc giả'
+    )
+    open_loan_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Số sách đang mượn'
+    )
+    overdue_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Số sách quá hạn'
+    )
+    earliest_due_date = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Hạn trả sớm nhất'
+    )
+    latest_due_date = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Hạn trả muộn nhất'
+    )
+    accrued_debt = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Nợ đã chốt (VNĐ)'
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Ngày cập nhật')
+    
+    class Meta:
+        db_table = 'reader_circulation_summary'
+        verbose_name = 'Tổng hợp mượn trả theo độc giả'
+        verbose_name_plural = 'Tổng hợp mượn trả theo độc giả'
+        indexes = [
+            models.Index(fields=['open_loan_count']),
+            models.Index(fields=['earliest_due_date']),
+            models.Index(fields=['-latest_due_date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.reader_id}: {self.open_loan_count} đang mượn, {self.overdue_count} quá hạn"
+    
+    @property
+    def has_overdue(self):
+        """Có sách đang mượn quá hạn không (theo ngày địa phương)"""
+        if not self.open_loan_count or not self.earliest_due_date:
+            return False
+        return timezone.localtime(self.earliest_due_date).date() < timezone.localdate()
+    
+    @classmethod
+    def open_loans_aggregate(cls):
+        """Truy vấn gộp phiếu đang mượn (chưa trả, chưa hủy) theo độc giả"""
+        _, start_of_today = local_today_range()
+        return BorrowReturnReceipt.objects.filter(
+            return_date__isnull=True,
+            is_cancelled=False,
+        ).order_by().values('reader_id').annotate(
+            open_loan_count=models.Count('id'),
+            overdue_count=models.Count('id', filter=models.Q(due_date__lt=start_of_today)),
+            earliest_due_date=models.Min('due_date'),
+            latest_due_date=models.Max('due_date'),
+        )
+    
+    @classmethod
+    def refresh(cls, reader_id):
+        """Tính lại dòng tổng hợp của 1 độc giả (1 truy vấn gộp + 1 ghi)"""
+        rows = list(cls.open_loans_aggregate().filter(reader_id=reader_id))
+        row = rows[0] if rows else {}
+        total_debt = Reader.objects.filter(pk=reader_id).values_list('total_debt', flat=True).first() or 0
+        summary, _ = cls.objects.update_or_create(
+            reader_id=reader_id,
+            defaults={
+                'open_loan_count': row.get('open_loan_count', 0),
+                'overdue_count': row.get('overdue_count', 0),
+                'earliest_due_date': row.get('earliest_due_date'),
+                'latest_due_date': row.get('latest_due_date'),
+                'accrued_debt': total_debt,
+            }
+        )
+        return summary
+    
+    @classmethod
+    def for_reader(cls, reader_id):
+        """Lấy dòng tổng hợp của độc giả, tự tạo nếu chưa có"""
+        summary = cls.objects.filter(reader_id=reader_id).first()
+        if summary is None:
+            summary = cls.refresh(reader_id)
+        return summary
+    
+    @classmethod
+    def record_borrow(cls, reader_id, due_date):
+        """Cập nhật tăng dần khi lập phiếu mượn mới"""
+        updated = cls.objects.filter(reader_id=reader_id).update(
+            open_loan_count=models.F('open_loan_count') + 1,
+            earliest_due_date=models.Case(
+                models.When(earliest_due_date__isnull=True, then=models.Value(due_date)),
+                models.When(earliest_due_date__gt=due_date, then=models.Value(due_date)),
+                default=models.F('earliest_due_date'),
+            ),
+            latest_due_date=models.Case(
+                models.When(latest_due_date__isnull=True, then=models.Value(due_date)),
+                models.When(latest_due_date__lt=due_date, then=models.Value(due_date)),
+                default=models.F('latest_due_date'),
+            ),
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            cls.refresh(reader_id)
+    
+    @classmethod
+    def record_debt(cls, reader_id, total_debt):
+        """Đồng bộ nợ đã chốt khi Reader.total_debt thay đổi"""
+        updated = cls.objects.filter(reader_id=reader_id).update(
+            accrued_debt=total_debt,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            cls.refresh(reader_id)
+    
+    @classmethod
+    def add_debt(cls, reader_id, delta):
+        """Cộng/trừ nợ đã chốt cùng lúc với Reader.total_debt (UPDATE nguyên tử)"""
+        updated = cls.objects.filter(reader_id=reader_id).update(
+            accrued_debt=models.F('accrued_debt') + delta,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            cls.refresh(reader_id)
+    
+    @classmethod
+    def rebuild_all(cls):
+        """
+        Tính lại toàn bộ bảng tổng hợp theo tập (set-based):
+        1 truy vấn gộp phiếu mượn + 1 truy vấn độc giả + ghi theo lô
+        Trả về số dòng đã ghi
+        """
+        from django.db import transaction
+        
+        aggregates = {row['reader_id']: row for row in cls.open_loans_aggregate()}
+        now = timezone.now()
+        summaries = []
+        for reader_id, total_debt in Reader.objects.values_list('id', 'total_debt').iterator():
+            row = aggregates.get(reader_id, {})
+            summaries.append(cls(
+                reader_id=reader_id,
+                open_loan_count=row.get('open_loan_count', 0),
+                overdue_count=row.get('overdue_count', 0),
+                earliest_due_date=row.get('earliest_due_date'),
+                latest_due_date=row.get('latest_due_date'),
+                accrued_debt=total_debt,
+                updated_at=now,
+            ))
+        
+        with transaction.atomic():
+            cls.objects.bulk_create(
+                summaries,
+                batch_size=500,
+                update_conflicts=True,
+                unique_fields=['reader'],
+                update_fields=[
+                    'open_loan_count', 'overdue_count', 'earliest_due_date',
+                    'latest_due_date', 'accrued_debt', 'updated_at',
+                ],
+            )
+        return len(summaries)
+
+
 # ==================== REPORTING ====================
 
 class ReportDetailByCategory(models.Model):
@@ -1260,6 +1677,254 @@ class LateReturnReport(models.Model):
         return f"Báo cáo {self.date.strftime('%d/%m/%Y')} - {self.book_item} - Trễ {self.late_return_days} ngày"
 
 
+def _apply_rollup_deltas(model, deltas):
+    """
+    Cộng dồn deltas {khóa (theo model.KEY_FIELDS): Counter} vào bảng tổng hợp
+    (UPDATE nguyên tử, chưa có dòng -> tạo mới).
+    Chỉ số có thể âm tạm thời nếu bảng chưa được backfill; tổng trên báo cáo vẫn đúng.
+    """
+    from django.db import IntegrityError, transaction
+    
+    for key, values in deltas.items():
+        values = {field: value for field, value in values.items() if value}
+        if not values:
+            continue
+        key = dict(zip(model.KEY_FIELDS, key))
+        updates = {field: models.F(field) + value for field, value in values.items()}
+        if model.objects.filter(**key).update(**updates):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(**key, **values)
+        except IntegrityError:
+            # Transaction khác vừa tạo dòng này
+            model.objects.filter(**key).update(**updates)
+
+
+class DailyCirculationRollup(models.Model):
+    """
+    Bảng tổng hợp mượn trả theo ngày (1 dòng / ngày x thể loại x đầu sách x loại độc giả)
+    Được cập nhật tăng dần (UPDATE x = x + n) trong cùng transaction với mượn, trả,
+    hoàn tác trả, xóa phiếu; các báo cáo theo khoảng thời gian
+    đọc bảng này thay vì quét từng phiếu.
+    
+    - Lượt mượn tính theo ngày mượn (kể cả phiếu đã hủy, như các báo cáo mượn)
+    - Lượt trả, số lượt trả trễ, số ngày trễ tính theo ngày trả
+    - Tiền thu (không gắn với sách) nằm ở bảng DailyPaymentRollup
+    Các cột khóa đều NOT NULL để ràng buộc unique chặn 2 transaction cùng tạo 1 dòng.
+    Ngày là ngày địa phương (TIME_ZONE). Dòng cũ giữ thể loại / loại độc giả tại thời điểm ghi;
+    tính lại toàn bộ (VD: sau khi đổi thể loại của đầu sách): python manage.py backfill_circulation_rollup
+    """
+    KEY_FIELDS = ('date', 'category_id', 'book_title_id', 'reader_type_id')
+    MEASURES = ('borrow_count', 'return_count', 'late_count', 'late_days')
+    
+    date = models.DateField(verbose_name='Ngày')
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name='daily_rollups',
+        verbose_name='Thể loại'
+    )
+    book_title = models.ForeignKey(
+        BookTitle,
+        on_delete=models.CASCADE,
+        related_name='daily_rollups',
+        verbose_name='Tựa sách'
+    )
+    reader_type = models.ForeignKey(
+        ReaderType,
+        on_delete=models.CASCADE,
+        related_name='daily_rollups',
+        verbose_name='Loại độc giả'
+    )
+    borrow_count = models.IntegerField(default=0, verbose_name='Số lượt mượn')
+    return_count = models.IntegerField(default=0, verbose_name='Số lượt trả')
+    late_count = models.IntegerField(default=0, verbose_name='Số lượt trả trễ')
+    late_days = models.IntegerField(default=0, verbose_name='Tổng số ngày trễ')
+    
+    class Meta:
+        db_table = 'daily_circulation_rollup'
+        verbose_name = 'Tổng hợp mượn trả theo ngày'
+        verbose_name_plural = 'Tổng hợp mượn trả theo ngày'
+        unique_together = [['date', 'category', 'book_title', 'reader_type']]
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.date:%d/%m/%Y} - {self.book_title_id}: {self.borrow_count} mượn, {self.return_count} trả"
+    
+    @staticmethod
+    def local_date(value):
+        """Ngày địa phương của 1 thời điểm"""
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return timezone.localtime(value).date()
+    
+    @classmethod
+    def receipt_deltas(cls, receipts, removed=(), returns_only=False):
+        """
+        Phần đóng góp của các phiếu mượn trừ đi phần của `removed` (trạng thái cũ / phiếu đã xóa):
+        {(ngày, category_id, book_title_id, reader_type_id): Counter}
+        returns_only: chỉ tính lượt trả (phiếu vừa được trả, lượt mượn đã ghi từ trước)
+        2 truy vấn lấy đầu sách / thể loại theo cuốn sách và loại độc giả theo độc giả.
+        """
+        from collections import Counter, defaultdict
+        
+        all_receipts = [*receipts, *removed]
+        titles = {
+            item_id: (category_id, title_id)
+            for item_id, title_id, category_id in BookItem.objects.filter(
+                pk__in={receipt.book_item_id for receipt in all_receipts}
+            ).values_list('id', 'book__book_title_id', 'book__book_title__category_id')
+        }
+        reader_types = dict(Reader.objects.filter(
+            pk__in={receipt.reader_id for receipt in all_receipts}
+        ).values_list('id', 'reader_type_id'))
+        
+        deltas = defaultdict(Counter)
+        for sign, items in ((1, receipts), (-1, removed)):
+            for receipt in items:
+                dims = (*titles[receipt.book_item_id], reader_types[receipt.reader_id])
+                if not returns_only:
+                    deltas[(cls.local_date(receipt.borrow_date), *dims)]['borrow_count'] += sign
+                if receipt.return_date:
+                    row = deltas[(cls.local_date(receipt.return_date), *dims)]
+                    row['return_count'] += sign
+                    days = receipt.days_overdue
+                    if days:
+                        row['late_count'] += sign
+                        row['late_days'] += sign * days
+        return deltas
+    
+    @classmethod
+    def record_receipts(cls, receipts, removed=(), returns_only=False):
+        """Cập nhật bảng khi lập / trả / sửa / xóa phiếu mượn (xem receipt_deltas)"""
+        if receipts or removed:
+            _apply_rollup_deltas(cls, cls.receipt_deltas(receipts, removed, returns_only))
+    
+    @classmethod
+    def rebuild_all(cls):
+        """
+        Tính lại toàn bộ bảng theo tập (set-based): 2 truy vấn gộp
+        (lượt mượn theo ngày mượn, lượt trả theo ngày trả) + ghi theo lô.
+        Xóa luôn các bản lưu báo cáo theo thể loại (có thể đã lưu từ bảng chưa đầy đủ,
+        VD: tháng được xem sau migrate, trước khi backfill); lần xem sau lưu lại.
+        Trả về số dòng đã ghi
+        """
+        from collections import Counter, defaultdict
+        from django.db import transaction
+        
+        dims = {
+            'category_id': models.F('book_item__book__book_title__category_id'),
+            'title_id': models.F('book_item__book__book_title_id'),
+            'type_id': models.F('reader__reader_type_id'),
+        }
+        receipts = BorrowReturnReceipt.objects.order_by()
+        borrows = receipts.values(day=TruncDate('borrow_date'), **dims).annotate(
+            borrow_count=models.Count('id'),
+        )
+        late_days = Greatest(DaysBetween(TruncDate('return_date'), TruncDate('due_date')), models.Value(0))
+        returns = receipts.filter(return_date__isnull=False).annotate(
+            late=late_days,
+        ).values(day=TruncDate('return_date'), **dims).annotate(
+            return_count=models.Count('id'),
+            late_count=models.Count('id', filter=models.Q(late__gt=0)),
+            late_days=models.Sum('late'),
+        )
+        
+        totals = defaultdict(Counter)
+        for rows in (borrows, returns):
+            for row in rows:
+                key = (row['day'], row['category_id'], row['title_id'], row['type_id'])
+                totals[key].update({field: row[field] or 0 for field in cls.MEASURES if field in row})
+        
+        with transaction.atomic():
+            cls.objects.all().delete()
+            ReportDetailByCategory.objects.all().delete()
+            cls.objects.bulk_create(
+                [
+                    cls(
+                        date=day, category_id=category_id, book_title_id=title_id,
+                        reader_type_id=reader_type_id, **values,
+                    )
+                    for (day, category_id, title_id, reader_type_id), values in totals.items()
+                ],
+                batch_size=500,
+            )
+        return len(totals)
+
+class DailyPaymentRollup(models.Model):
+    """
+    Bảng tổng hợp tiền phạt đã thu theo ngày (1 dòng / ngày x loại độc giả)
+    Cập nhật tăng dần trong cùng transaction với lập / sửa / hủy / xóa phiếu thu.
+    Tiền thu tính theo ngày lập phiếu (ngày địa phương), không tính phiếu đã hủy.
+    """
+    KEY_FIELDS = ('date', 'reader_type_id')
+    MEASURES = ('collected_amount',)
+    
+    date = models.DateField(verbose_name='Ngày')
+    reader_type = models.ForeignKey(
+        ReaderType,
+        on_delete=models.CASCADE,
+        related_name='daily_payment_rollups',
+        verbose_name='Loại độc giả'
+    )
+    collected_amount = models.IntegerField(default=0, verbose_name='Tiền phạt đã thu')
+    
+    class Meta:
+        db_table = 'daily_payment_rollup'
+        verbose_name = 'Tổng hợp tiền thu theo ngày'
+        verbose_name_plural = 'Tổng hợp tiền thu theo ngày'
+        unique_together = [['date', 'reader_type']]
+    
+    def __str__(self):
+        return f"{self.date:%d/%m/%Y} - {self.reader_type_id}: {self.collected_amount}"
+    
+    @classmethod
+    def payment_deltas(cls, receipts, removed=()):
+        """
+        Tiền thu của các phiếu thu (không tính phiếu đã hủy) trừ đi phần của `removed`:
+        {(ngày, reader_type_id): Counter}
+        """
+        from collections import Counter, defaultdict
+        
+        reader_types = dict(Reader.objects.filter(
+            pk__in={receipt.reader_id for receipt in [*receipts, *removed]}
+        ).values_list('id', 'reader_type_id'))
+        
+        deltas = defaultdict(Counter)
+        for sign, items in ((1, receipts), (-1, removed)):
+            for receipt in items:
+                if not receipt.is_cancelled:
+                    key = (DailyCirculationRollup.local_date(receipt.created_date), reader_types[receipt.reader_id])
+                    deltas[key]['collected_amount'] += sign * receipt.collected_amount
+        return deltas
+    
+    @classmethod
+    def record_payments(cls, receipts, removed=()):
+        """Cập nhật bảng khi lập / hủy / sửa / xóa phiếu thu"""
+        if receipts or removed:
+            _apply_rollup_deltas(cls, cls.payment_deltas(receipts, removed))
+    
+    @classmethod
+    def rebuild_all(cls):
+        """Tính lại toàn bộ bảng (1 truy vấn gộp theo ngày lập phiếu), trả về số dòng đã ghi"""
+        from django.db import transaction
+        
+        rows = Receipt.objects.filter(is_cancelled=False).order_by().values(
+            day=TruncDate('created_date'), type_id=models.F('reader__reader_type_id'),
+        ).annotate(amount=models.Sum('collected_amount'))
+        rollups = [
+            cls(date=row['day'], reader_type_id=row['type_id'], collected_amount=row['amount'] or 0)
+            for row in rows
+        ]
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rollups, batch_size=500)
+        return len(rollups)
+
+
 # ==================== USER & PERMISSION MANAGEMENT ====================
 
 class UserGroup(models.Model):
@@ -1378,6 +2043,65 @@ class Permission(models.Model):
         if self.can_edit: permissions.append('Sửa')
         if self.can_delete: permissions.append('Xóa')
         return f"{self.user_group.user_group_name} - {self.function.function_name} [{', '.join(permissions)}]"
+    
+    FLAG_FIELDS = {
+        'view': 'can_view',
+        'add': 'can_add',
+        'edit': 'can_edit',
+        'delete': 'can_delete',
+    }
+    
+    @classmethod
+    def apply_matrix(cls, user_group, matrix, overwrite=True):
+        """
+        Ghi ma trận quyền của 1 nhóm theo lô (1 truy vấn đọc + bulk_create/bulk_update)
+        
+        matrix: {function_id: {'view': bool, 'add': bool, 'edit': bool, 'delete': bool}}
+        overwrite: False -> chỉ tạo quyền còn thiếu, giữ nguyên quyền đã có
+        Trả về (số quyền tạo mới, số quyền cập nhật)
+        """
+        from django.db import transaction
+        from functools import partial
+        from .caching import invalidate_group_permissions
+        
+        with transaction.atomic():
+            existing = {
+                p.function_id: p
+                for p in cls.objects.select_for_update().filter(
+                    user_group=user_group,
+                    function_id__in=list(matrix.keys())
+                )
+            }
+            
+            now = timezone.now()
+            to_create = []
+            to_update = []
+            for function_id, flags in matrix.items():
+                values = {
+                    field: bool(flags.get(key, False))
+                    for key, field in cls.FLAG_FIELDS.items()
+                }
+                permission = existing.get(function_id)
+                if permission is None:
+                    to_create.append(cls(user_group=user_group, function_id=function_id, **values))
+                elif overwrite and any(getattr(permission, f) != v for f, v in values.items()):
+                    for field, value in values.items():
+                        setattr(permission, field, value)
+                    permission.updated_at = now
+                    to_update.append(permission)
+            
+            if to_create:
+                cls.objects.bulk_create(to_create)
+            if to_update:
+                cls.objects.bulk_update(
+                    to_update, list(cls.FLAG_FIELDS.values()) + ['updated_at']
+                )
+            
+            # bulk_create/bulk_update không phát signal -> tự vô hiệu hóa cache
+            if to_create or to_update:
+                transaction.on_commit(partial(invalidate_group_permissions, user_group.pk))
+        
+        return len(to_create), len(to_update)
 
 
 class LibraryUser(models.Model):
@@ -1464,29 +2188,29 @@ class LibraryUser(models.Model):
             age -= 1
         return age
     
+    def get_permission_snapshot(self):
+        """
+        Lấy toàn bộ quyền của nhóm người dùng (cache dùng chung theo version,
+        chỉ đọc database khi quyền của nhóm thay đổi).
+        Kết quả được ghi nhớ trên instance (sống trong 1 request qua request.user):
+        {function_name: {'view': bool, 'add': bool, 'edit': bool, 'delete': bool}}
+        """
+        snapshot = getattr(self, '_permission_snapshot', None)
+        if snapshot is None:
+            from .caching import get_group_permission_map
+            snapshot = get_group_permission_map(self.user_group_id)
+            self._permission_snapshot = snapshot
+        return snapshot
+    
     def has_permission(self, function_name, permission_type='view'):
         """
         Kiểm tra quyền truy cập chức năng
         permission_type: 'view', 'add', 'edit', 'delete'
         """
-        try:
-            permission = Permission.objects.get(
-                user_group=self.user_group,
-                function__function_name=function_name
-            )
-            
-            if permission_type == 'view':
-                return permission.can_view
-            elif permission_type == 'add':
-                return permission.can_add
-            elif permission_type == 'edit':
-                return permission.can_edit
-            elif permission_type == 'delete':
-                return permission.can_delete
-            
-            return False
-        except Permission.DoesNotExist:
+        flags = self.get_permission_snapshot().get(function_name)
+        if flags is None:
             return False
+        return flags.get(permission_type, False)
     
     def get_allowed_functions(self):
         """Lấy danh sách chức năng được phép sử dụng"""
@@ -1495,3 +2219,142 @@ class LibraryUser(models.Model):
             permissions__can_view=True
         ).distinct()
 
+
+
+# ==================== REQUEST IDEMPOTENCY ====================
+
+class IdempotencyKey(models.Model):
+    """
+    Khóa chống gửi trùng cho các POST ghi dữ liệu (mượn sách, trả sách, thu tiền).
+    Lần gửi đầu tiên được xử lý và lưu kết quả (redirect + thông báo);
+    gửi lại cùng khóa trong thời hạn TTL nhận lại kết quả đã lưu, không xử lý lại.
+    Xóa khóa hết hạn: python manage.py purge_idempotency_keys
+    """
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_PROCESSING, 'Đang xử lý'),
+        (STATUS_COMPLETED, 'Đã xử lý'),
+    ]
+    TTL = timezone.timedelta(hours=24)
+    
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='idempotency_keys',
+        verbose_name='Người gửi'
+    )
+    scope = models.CharField(max_length=100, verbose_name='Chức năng')
+    key = models.CharField(max_length=64, verbose_name='Khóa')
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=STATUS_PROCESSING,
+        verbose_name='Trạng thái'
+    )
+    location = models.CharField(max_length=500, blank=True, verbose_name='Chuyển hướng')
+    messages = models.JSONField(default=list, blank=True, verbose_name='Thông báo')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Ngày tạo')
+    expires_at = models.DateTimeField(verbose_name='Hết hạn')
+    
+    class Meta:
+        db_table = 'idempotency_key'
+        verbose_name = 'Khóa chống gửi trùng'
+        verbose_name_plural = 'Khóa chống gửi trùng'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='idempotency_key_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.scope}:{self.key} ({self.get_status_display()})"
+    
+    @property
+    def is_completed(self):
+        return self.status == self.STATUS_COMPLETED
+    
+    @classmethod
+    def claim(cls, user, scope, key):
+        """
+        Giành khóa trước khi xử lý (ghi ngay, ngoài transaction của nghiệp vụ).
+        Trả về (record, True) nếu là lần gửi đầu, (record đã có, False) nếu gửi trùng.
+        """
+        from django.db import IntegrityError, transaction
+        
+        now = timezone.now()
+        while True:
+            try:
+                with transaction.atomic():
+                    record = cls.objects.create(user=user, scope=scope, key=key, expires_at=now + cls.TTL)
+                return record, True
+            except IntegrityError:
+                record = cls.objects.filter(user=user, scope=scope, key=key).first()
+                if record is None:
+                    # Worker khác vừa xóa khóa (hết hạn / xử lý lỗi) -> thử tạo lại
+                    continue
+                if record.expires_at > now:
+                    return record, False
+                # Khóa đã hết hạn -> xóa và giành lại
+                record.delete()
+    
+    def complete(self, location, messages):
+        """Lưu kết quả của lần xử lý đầu tiên"""
+        self.status = self.STATUS_COMPLETED
+        self.location = location
+        self.messages = messages
+        self.save(update_fields=['status', 'location', 'messages'])
+    
+    @classmethod
+    def purge_expired(cls):
+        """Xóa các khóa đã hết hạn, trả về số dòng đã xóa"""
+        deleted, _ = cls.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+
+# ==================== AUTOCOMPLETE INDEX ====================
+
+class AutocompleteToken(models.Model):
+    """
+    Bảng chỉ mục gợi ý (autocomplete) cho ô chọn độc giả / sách.
+    Mỗi đối tượng có các dòng:
+    - key: toàn bộ chuỗi đã chuẩn hóa (tên, email, tên sách) -> khớp tiền tố cả chuỗi
+    - word: từng từ (tên, tên tác giả) -> khớp tiền tố từng từ
+    - trigram: từng cụm 3 ký tự -> khớp chuỗi con
+    Tra cứu chỉ dùng index (kind, token_type, token, object_id).
+    Xây lại: python manage.py rebuild_autocomplete_index
+    """
+    KIND_READER = 'reader'
+    KIND_BOOK = 'book'
+    KIND_CHOICES = [
+        (KIND_READER, 'Độc giả'),
+        (KIND_BOOK, 'Sách'),
+    ]
+    TYPE_KEY = 'k'
+    TYPE_WORD = 'w'
+    TYPE_TRIGRAM = 't'
+    TYPE_CHOICES = [
+        (TYPE_KEY, 'Cả chuỗi'),
+        (TYPE_WORD, 'Từ'),
+        (TYPE_TRIGRAM, 'Trigram'),
+    ]
+    
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name='Loại đối tượng')
+    token_type = models.CharField(max_length=1, choices=TYPE_CHOICES, verbose_name='Loại token')
+    token = models.CharField(max_length=255, verbose_name='Token')
+    object_id = models.PositiveIntegerField(verbose_name='Mã đối tượng')
+    
+    class Meta:
+        db_table = 'autocomplete_token'
+        verbose_name = 'Token gợi ý'
+        verbose_name_plural = 'Token gợi ý'
+        indexes = [
+            # Index phủ: tra tiền tố / trigram không cần đọc bảng
+            models.Index(fields=['kind', 'token_type', 'token', 'object_id'], name='autocomplete_lookup_idx'),
+            # Index phủ theo đối tượng: đánh lại chỉ mục, đối chiếu token của ứng viên
+            models.Index(fields=['kind', 'object_id', 'token_type', 'token'], name='autocomplete_object_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind}:{self.token_type}:{self.token} -> {self.object_id}"
@@ -0,0 +1,146 @@
+"""
+Phân trang theo keyset (cursor) cho API và danh sách lớn.
+
+Cursor là chuỗi base64 (an toàn cho URL) của các giá trị cột sắp xếp
+của dòng cuối trang trước; trang tiếp theo lọc "sau" bộ giá trị đó
+thay vì OFFSET, nên chi phí không tăng theo số trang.
+CursorPaginator dùng cơ chế này cho các danh sách HTML (trang trước / sau).
+"""
+import base64
+import json
+from datetime import datetime
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+def encode_cursor(*values):
+    """Mã hóa bộ giá trị sắp xếp thành cursor (datetime -> ISO 8601)"""
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, *types):
+    """
+    Giải mã cursor thành tuple giá trị theo `types` (datetime, int, str, ...).
+    Cursor không hợp lệ -> None (coi như trang đầu).
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if not isinstance(payload, list) or len(payload) != len(types):
+            return None
+        return tuple(
+            datetime.fromisoformat(value) if type_ is datetime else type_(value)
+            for type_, value in zip(types, payload)
+        )
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_limit(value, default, maximum):
+    """Đọc tham số limit từ query string, giới hạn trong [1, maximum]"""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, maximum))
+
+
+class CursorPage:
+    """Một trang của CursorPaginator, dùng trong template tương tự Page của Django"""
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Phân trang keyset cho danh sách HTML, thay cho Paginator (không COUNT(*) mỗi lần xem trang).
+    ordering: các cột sắp xếp (tiền tố '-' = giảm dần), cột cuối phải duy nhất (VD: '-id').
+    types: kiểu giá trị của từng cột để giải mã cursor (datetime, int, ...).
+    Tổng số chỉ đếm tối đa count_limit dòng (count_capped = True -> hiển thị "1000+").
+    """
+
+    def __init__(self, queryset, ordering, types, per_page=20, count_limit=1000):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.types = tuple(types)
+        self.per_page = per_page
+        self.count_limit = count_limit
+
+    def _beyond(self, values, backward=False):
+        """Điều kiện các dòng nằm sau (backward: trước) bộ giá trị theo thứ tự sắp xếp"""
+        conditions = []
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') != backward else 'gt'
+            conditions.append(Q(**equal, **{f'{name}__{lookup}': value}))
+            equal[name] = value
+        return reduce(or_, conditions)
+
+    def _cursor(self, obj):
+        return encode_cursor(*(getattr(obj, field.lstrip('-')) for field in self.ordering))
+
+    def get_page(self, after=None, before=None):
+        """
+        Trang sau cursor `after` hoặc trước cursor `before` (không có -> trang đầu).
+        Lấy dư 1 dòng để biết còn trang tiếp theo theo chiều đang đi.
+        """
+        after = decode_cursor(after, *self.types)
+        before = decode_cursor(before, *self.types) if after is None else None
+
+        if before is not None:
+            reverse_ordering = [field[1:] if field.startswith('-') else '-' + field for field in self.ordering]
+            rows = list(
+                self.queryset.filter(self._beyond(before, backward=True)).order_by(*reverse_ordering)[:self.per_page + 1]
+            )
+            has_previous, has_next = len(rows) > self.per_page, True
+            rows = rows[:self.per_page][::-1]
+        else:
+            queryset = self.queryset if after is None else self.queryset.filter(self._beyond(after))
+            rows = list(queryset.order_by(*self.ordering)[:self.per_page + 1])
+            has_previous, has_next = after is not None, len(rows) > self.per_page
+            rows = rows[:self.per_page]
+
+        return CursorPage(
+            rows,
+            next_cursor=self._cursor(rows[-1]) if has_next and rows else None,
+            previous_cursor=self._cursor(rows[0]) if has_previous and rows else None,
+        )
+
+    @cached_property
+    def _limited_count(self):
+        # COUNT trên subquery LIMIT count_limit + 1: chi phí có chặn trên dù bảng lớn
+        return self.queryset.order_by().values('pk')[:self.count_limit + 1].count()
+
+    @property
+    def count(self):
+        return min(self._limited_count, self.count_limit)
+
+    @property
+    def count_capped(self):
+        return self._limited_count > self.count_limit
@@ -0,0 +1,204 @@
+"""
+Số liệu các báo cáo mượn trả, dùng chung cho trang báo cáo và file Excel.
+
+Các báo cáo theo khoảng thời gian đọc bảng tổng hợp theo ngày DailyCirculationRollup
+(ngày x thể loại x đầu sách x loại độc giả, cập nhật trong cùng transaction với mượn,
+trả) và DailyPaymentRollup (ngày x loại độc giả, tiền thu) thay vì quét từng phiếu: báo cáo 1 năm chỉ đọc các dòng của những ngày
+có phát sinh. Số độc giả (không cộng dồn được theo ngày) vẫn đếm DISTINCT trên phiếu mượn.
+
+Báo cáo theo thể loại (BM7.1): tháng đã kết thúc được lưu lại 1 lần vào
+ReportDetailByCategory (tổng) và BorrowReportDetailByCategory (theo đầu sách); các lần
+xem sau đọc bản lưu và gộp theo thể loại. Tháng hiện tại luôn tính từ bảng tổng hợp.
+Phiếu mượn được thêm / xóa trong tháng đã kết thúc -> xóa bản lưu của tháng đó
+(signals); tính lại bảng tổng hợp (backfill) -> xóa mọi bản lưu. Lần xem sau tính lại.
+"""
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+
+def is_closed_month(year, month):
+    """Tháng đã kết thúc (trước tháng hiện tại theo giờ địa phương)"""
+    today = timezone.localdate()
+    return (year, month) < (today.year, today.month)
+
+
+def _rollups(first_day, last_day):
+    """Dòng tổng hợp mượn trả của các ngày trong [first_day, last_day]"""
+    from .models import DailyCirculationRollup
+
+    return DailyCirculationRollup.objects.filter(date__gte=first_day, date__lte=last_day).order_by()
+
+
+def _month_rollups(year, month):
+    first_day = date(year, month, 1)
+    last_day = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return _rollups(first_day, last_day)
+
+
+def _live_category_counts(year, month):
+    """[(tên thể loại, số lượt mượn)] cộng từ bảng tổng hợp theo ngày (1 truy vấn)"""
+    rows = _month_rollups(year, month).values(
+        category_name=F('category__category_name')
+    ).annotate(borrows=Sum('borrow_count')).filter(borrows__gt=0).order_by('category_name')
+    return [(row['category_name'], row['borrows']) for row in rows]
+
+
+def save_snapshot(year, month):
+    """
+    Lưu số lượt mượn theo đầu sách của tháng (đã có bản lưu -> giữ nguyên).
+    Trả về ReportDetailByCategory.
+    """
+    from .models import ReportDetailByCategory, BorrowReportDetailByCategory
+
+    rows = list(
+        _month_rollups(year, month).values('book_title_id').annotate(
+            borrows=Sum('borrow_count')
+        ).filter(borrows__gt=0)
+    )
+    total = sum(row['borrows'] for row in rows)
+
+    with transaction.atomic():
+        report, created = ReportDetailByCategory.objects.get_or_create(
+            month=month, year=year, defaults={'total_borrow_count': total}
+        )
+        if created:
+            # bulk_create không gọi save() -> tự tính tỉ lệ
+            BorrowReportDetailByCategory.objects.bulk_create([
+                BorrowReportDetailByCategory(
+                    report=report,
+                    book_title_id=row['book_title_id'],
+                    borrow_count=row['borrows'],
+                    rate=(Decimal(row['borrows'] * 100) / total).quantize(Decimal('0.01')),
+                )
+                for row in rows
+            ])
+    return report
+
+
+def _snapshot_category_counts(report):
+    """[(tên thể loại, số lượt mượn)] gộp từ bản lưu theo đầu sách (1 truy vấn)"""
+    rows = report.borrow_details.values(
+        category_name=F('book_title__category__category_name')
+    ).annotate(borrow_count=Sum('borrow_count')).order_by('category_name')
+    return [(row['category_name'], row['borrow_count']) for row in rows]
+
+
+def borrow_by_category(year, month):
+    """
+    Số liệu BM7.1: (report_data, total_borrows)
+    report_data: [{'stt', 'category_name', 'borrow_count', 'percentage'}] theo tên thể loại
+    """
+    from .models import ReportDetailByCategory
+
+    if is_closed_month(year, month):
+        report = ReportDetailByCategory.objects.filter(month=month, year=year).first()
+        if report is None:
+            report = save_snapshot(year, month)
+        counts = _snapshot_category_counts(report)
+    else:
+        counts = _live_category_counts(year, month)
+
+    total_borrows = sum(count for _, count in counts)
+    report_data = [
+        {
+            'stt': index,
+            'category_name': category_name,
+            'borrow_count': borrow_count,
+            'percentage': round(borrow_count / total_borrows * 100, 2) if total_borrows else 0,
+        }
+        for index, (category_name, borrow_count) in enumerate(counts, start=1)
+    ]
+    return report_data, total_borrows
+
+
+def invalidate_snapshot(borrow_date):
+    """Phiếu mượn của tháng đã kết thúc thay đổi -> xóa bản lưu của tháng đó"""
+    from .models import ReportDetailByCategory
+
+    if timezone.is_naive(borrow_date):
+        borrow_date = timezone.make_aware(borrow_date)
+    local = timezone.localtime(borrow_date)
+    if is_closed_month(local.year, local.month):
+        ReportDetailByCategory.objects.filter(month=local.month, year=local.year).delete()
+
+
+def day_bounds(from_date, to_date):
+    """Ngày địa phương đầu / cuối của khoảng và [00:00 ngày đầu, 00:00 ngày sau ngày cuối) (aware)"""
+    from .models import DailyCirculationRollup
+
+    first_day = DailyCirculationRollup.local_date(from_date)
+    last_day = DailyCirculationRollup.local_date(to_date)
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+    end = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time.min))
+    return first_day, last_day, start, end
+
+
+def borrow_situation(from_date, to_date):
+    """
+    Số liệu báo cáo tình hình mượn sách theo các ngày từ from_date đến to_date:
+    (report_data, total_borrows), report_data theo số lượt mượn giảm dần:
+    [{'stt', 'category_name', 'borrow_count', 'percentage', 'book_count',
+      'reader_count', 'top_book', 'top_book_count'}]
+    2 truy vấn: lượt mượn theo đầu sách (bảng tổng hợp), số độc giả theo thể loại (phiếu mượn).
+    """
+    from .models import BorrowReturnReceipt
+
+    first_day, last_day, start, end = day_bounds(from_date, to_date)
+    titles = _rollups(first_day, last_day).values(
+        'category_id', 'category__category_name', 'book_title__book_title'
+    ).annotate(borrows=Sum('borrow_count')).filter(borrows__gt=0)
+
+    categories = {}
+    for row in titles:
+        stats = categories.setdefault(row['category_id'], {
+            'category_name': row['category__category_name'],
+            'borrow_count': 0,
+            'book_count': 0,
+            'top_book': '',
+            'top_book_count': 0,
+        })
+        stats['borrow_count'] += row['borrows']
+        stats['book_count'] += 1
+        # Sách được mượn nhiều nhất (bằng nhau -> theo tên)
+        if (-row['borrows'], row['book_title__book_title']) < (-stats['top_book_count'], stats['top_book']):
+            stats['top_book'] = row['book_title__book_title']
+            stats['top_book_count'] = row['borrows']
+
+    readers = dict(
+        BorrowReturnReceipt.objects.filter(
+            borrow_date__gte=start, borrow_date__lt=end
+        ).order_by().values_list('book_item__book__book_title__category_id').annotate(
+            Count('reader_id', distinct=True)
+        )
+    )
+
+    total_borrows = sum(stats['borrow_count'] for stats in categories.values())
+    ordered = sorted(categories.items(), key=lambda item: (-item[1]['borrow_count'], item[1]['category_name']))
+    report_data = []
+    for index, (category_id, stats) in enumerate(ordered, start=1):
+        report_data.append({
+            'stt': index,
+            **stats,
+            'percentage': round(stats['borrow_count'] / total_borrows * 100, 2) if total_borrows else 0,
+            'reader_count': readers.get(category_id, 0),
+        })
+    return report_data, total_borrows
+
+
+def fine_collection(from_date, to_date):
+    """
+    Tiền phạt đã thu theo các ngày từ from_date đến to_date (không tính phiếu thu đã hủy):
+    (tổng tiền thu, [(ngày, tiền thu)] theo ngày tăng dần), 1 truy vấn trên bảng tổng hợp tiền thu
+    """
+    from .models import DailyPaymentRollup
+
+    first_day, last_day, _, _ = day_bounds(from_date, to_date)
+    rows = DailyPaymentRollup.objects.filter(
+        date__gte=first_day, date__lte=last_day
+    ).values('date').annotate(amount=Sum('collected_amount')).filter(amount__gt=0).order_by('date')
+    daily = [(row['date'], row['amount']) for row in rows]
+    return sum(amount for _, amount in daily), daily
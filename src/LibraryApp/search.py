@@ -0,0 +1,361 @@
+"""
+Chỉ mục toàn văn (full-text) cho tra cứu sách.
+
+Mỗi sách (Book) là 1 tài liệu gồm: tên đầu sách, tác giả, nhà xuất bản,
+ISBN và thể loại. Backend được chọn theo database đang dùng:
+- SQLite: bảng ảo FTS5 (rowid = book.id), tokenizer unicode61 bỏ dấu,
+  xếp hạng bằng bm25 có trọng số theo cột.
+- PostgreSQL: bảng tsvector (config 'simple') + chỉ mục GIN, xếp hạng ts_rank.
+- Database khác / SQLite không có FTS5: search_book_ids() trả về None,
+  view tự quay về lọc icontains.
+
+Bảng chỉ mục được tạo sau migrate (signal post_migrate) hoặc bằng lệnh
+`python manage.py rebuild_search_index`; signals cập nhật chỉ mục trong cùng
+transaction với thay đổi dữ liệu sách.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.db import connection
+
+INDEX_TABLE = 'book_search_index'
+
+# Số kết quả liên quan nhất mặc định của search_book_ids()
+# (trang tra cứu dùng filter_books(): lọc trong truy vấn chỉ mục, không giới hạn)
+SEARCH_RESULT_LIMIT = 1000
+
+# Cột của Book ảnh hưởng tới nội dung chỉ mục
+INDEXED_BOOK_FIELDS = {'book_title', 'book_title_id', 'publisher', 'isbn'}
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+# 'đ' là chữ cái riêng, không tách được thành 'd' + dấu khi chuẩn hóa NFKD
+_FOLD_TABLE = str.maketrans({'đ': 'd', 'Đ': 'd'})
+
+
+def fold_text(value):
+    """
+    Chuẩn hóa chuỗi để so khớp không dấu, không phân biệt hoa thường:
+    'Đắc  Nhân Tâm' -> 'dac nhan tam'
+    """
+    if not value:
+        return ''
+    value = unicodedata.normalize('NFKD', value.translate(_FOLD_TABLE))
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    return ' '.join(value.casefold().split())
+
+
+def tokenize_query(text):
+    """Tách chuỗi tìm kiếm thành các từ đã chuẩn hóa (bỏ ký tự đặc biệt của cú pháp truy vấn)"""
+    return _TOKEN_RE.findall(fold_text(text))
+
+
+class SQLiteFTS5Backend:
+    """Chỉ mục FTS5: mỗi dòng có rowid = book.id"""
+
+    # Trọng số bm25 theo thứ tự cột: title, authors, publisher, isbn, category
+    WEIGHTS = (10.0, 5.0, 1.0, 1.0, 2.0)
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5("
+            "title, authors, publisher, isbn, category, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+
+    def delete(self, cursor, book_ids):
+        cursor.executemany(f'DELETE FROM {INDEX_TABLE} WHERE rowid = %s', [(i,) for i in book_ids])
+
+    def replace(self, cursor, documents):
+        self.delete(cursor, [doc['book_id'] for doc in documents])
+        cursor.executemany(
+            f'INSERT INTO {INDEX_TABLE} (rowid, title, authors, publisher, isbn, category) '
+            'VALUES (%s, %s, %s, %s, %s, %s)',
+            [
+                (doc['book_id'], doc['title'], doc['authors'], doc['publisher'], doc['isbn'], doc['category'])
+                for doc in documents
+            ]
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f'DELETE FROM {INDEX_TABLE}')
+
+    def count(self, cursor):
+        cursor.execute(f'SELECT COUNT(*) FROM {INDEX_TABLE}')
+        return cursor.fetchone()[0]
+
+    def _match(self, tokens):
+        # Mỗi từ là 1 chuỗi trong ngoặc kép + tìm theo tiền tố, các từ nối AND
+        return ' '.join('"%s"*' % token for token in tokens)
+
+    def match_sql(self, tokens):
+        """Truy vấn con: id các sách khớp (không xếp hạng)"""
+        return f'SELECT rowid FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s', [self._match(tokens)]
+
+    def search(self, cursor, tokens, limit, within=None):
+        weights = ', '.join(str(w) for w in self.WEIGHTS)
+        sql = f'SELECT rowid FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s'
+        params = [self._match(tokens)]
+        if within is not None:
+            # '+rowid': không để FTS5 dùng điều kiện rowid làm chỉ mục (chạy lại MATCH cho từng id)
+            sql += f' AND +rowid IN ({within[0]})'
+            params.extend(within[1])
+        sql += f' ORDER BY bm25({INDEX_TABLE}, {weights}), rowid'
+        if limit is not None:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresBackend:
+    """Chỉ mục tsvector: title (A), authors (B), category (C), publisher/isbn (D)"""
+
+    DOCUMENT_SQL = (
+        "setweight(to_tsvector('simple', %s), 'A') || "
+        "setweight(to_tsvector('simple', %s), 'B') || "
+        "setweight(to_tsvector('simple', %s), 'C') || "
+        "setweight(to_tsvector('simple', %s), 'D')"
+    )
+
+    def create(self, cursor):
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {INDEX_TABLE} ('
+            'book_id integer PRIMARY KEY REFERENCES book(id) ON DELETE CASCADE, '
+            'document tsvector NOT NULL)'
+        )
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_document ON {INDEX_TABLE} USING GIN (document)'
+        )
+
+    def delete(self, cursor, book_ids):
+        cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE book_id = ANY(%s)', [list(book_ids)])
+
+    def replace(self, cursor, documents):
+        cursor.executemany(
+            f'INSERT INTO {INDEX_TABLE} (book_id, document) VALUES (%s, {self.DOCUMENT_SQL}) '
+            'ON CONFLICT (book_id) DO UPDATE SET document = EXCLUDED.document',
+            [
+                (
+                    doc['book_id'], doc['title'], doc['authors'], doc['category'],
+                    f"{doc['publisher']} {doc['isbn']}",
+                )
+                for doc in documents
+            ]
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f'TRUNCATE {INDEX_TABLE}')
+
+    def count(self, cursor):
+        cursor.execute(f'SELECT COUNT(*) FROM {INDEX_TABLE}')
+        return cursor.fetchone()[0]
+
+    def _query(self, tokens):
+        return ' & '.join(f'{token}:*' for token in tokens)
+
+    def match_sql(self, tokens):
+        """Truy vấn con: id các sách khớp (không xếp hạng)"""
+        return (
+            f"SELECT book_id FROM {INDEX_TABLE} WHERE document @@ to_tsquery('simple', %s)",
+            [self._query(tokens)],
+        )
+
+    def search(self, cursor, tokens, limit, within=None):
+        sql = (
+            f"SELECT book_id FROM {INDEX_TABLE}, to_tsquery('simple', %s) AS query "
+            'WHERE document @@ query'
+        )
+        params = [self._query(tokens)]
+        if within is not None:
+            sql += f' AND book_id IN ({within[0]})'
+            params.extend(within[1])
+        sql += ' ORDER BY ts_rank(document, query) DESC, book_id'
+        if limit is not None:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+_backends = {}
+
+
+def _sqlite_has_fts5():
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        options = {row[0] for row in cursor.fetchall()}
+    return 'ENABLE_FTS5' in options
+
+
+def get_backend():
+    """Backend chỉ mục cho database hiện tại, None nếu không hỗ trợ"""
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == 'sqlite':
+            _backends[vendor] = SQLiteFTS5Backend() if _sqlite_has_fts5() else None
+        elif vendor == 'postgresql':
+            _backends[vendor] = PostgresBackend()
+        else:
+            _backends[vendor] = None
+    return _backends[vendor]
+
+
+def ensure_search_index():
+    """
+    Tạo bảng chỉ mục nếu chưa có, nạp toàn bộ sách nếu chỉ mục đang trống.
+    Trả về False nếu database không hỗ trợ.
+    """
+    from .models import Book
+
+    backend = get_backend()
+    if backend is None:
+        return False
+    with connection.cursor() as cursor:
+        backend.create(cursor)
+        empty = backend.count(cursor) == 0
+    if empty and Book.objects.exists():
+        rebuild_search_index()
+    return True
+
+
+def build_documents(book_ids=None):
+    """Nội dung chỉ mục (đã chuẩn hóa bằng fold_text) của các sách (2 truy vấn: sách + tác giả)"""
+    from .models import Book, AuthorDetail
+
+    books = Book.objects.values(
+        'id', 'book_title_id', 'book_title__book_title', 'publisher', 'isbn',
+        'book_title__category__category_name',
+    )
+    if book_ids is not None:
+        books = books.filter(id__in=book_ids)
+    books = list(books)
+
+    authors = defaultdict(list)
+    details = AuthorDetail.objects.values_list(
+        'book_title_id', 'author__author_name'
+    ).order_by('book_title_id', 'author__author_name')
+    if book_ids is not None:
+        details = details.filter(book_title_id__in={book['book_title_id'] for book in books})
+    for title_id, author_name in details:
+        authors[title_id].append(author_name)
+
+    return [
+        {
+            'book_id': book['id'],
+            'title': fold_text(book['book_title__book_title']),
+            'authors': fold_text(', '.join(authors[book['book_title_id']])),
+            'publisher': fold_text(book['publisher']),
+            'isbn': book['isbn'] or '',
+            'category': fold_text(book['book_title__category__category_name']),
+        }
+        for book in books
+    ]
+
+
+def index_books(book_ids):
+    """Cập nhật chỉ mục của các sách (sách đã bị xóa -> xóa khỏi chỉ mục)"""
+    backend = get_backend()
+    book_ids = set(book_ids)
+    if backend is None or not book_ids:
+        return
+    documents = build_documents(book_ids)
+    missing = book_ids - {doc['book_id'] for doc in documents}
+    with connection.cursor() as cursor:
+        if documents:
+            backend.replace(cursor, documents)
+        if missing:
+            backend.delete(cursor, missing)
+
+
+def remove_books(book_ids):
+    """Xóa sách khỏi chỉ mục"""
+    backend = get_backend()
+    if backend is None or not book_ids:
+        return
+    with connection.cursor() as cursor:
+        backend.delete(cursor, list(book_ids))
+
+
+def rebuild_search_index():
+    """Xóa và nạp lại toàn bộ chỉ mục, trả về số sách đã nạp"""
+    backend = get_backend()
+    if backend is None:
+        return 0
+    documents = build_documents()
+    with connection.cursor() as cursor:
+        backend.create(cursor)
+        backend.clear(cursor)
+        if documents:
+            backend.replace(cursor, documents)
+    return len(documents)
+
+
+def search_book_ids(text, limit=SEARCH_RESULT_LIMIT, within=None):
+    """
+    Tìm sách theo chỉ mục, trả về list book_id theo độ liên quan giảm dần.
+    within: queryset sách (đã lọc) -> chỉ xếp hạng các sách này, lọc ngay trong truy vấn chỉ mục
+    limit: None -> toàn bộ kết quả
+    Chuỗi là số -> sách có mã đó được đưa lên đầu.
+    Trả về None nếu database không hỗ trợ chỉ mục (caller tự dùng icontains).
+    """
+    from .models import Book
+
+    backend = get_backend()
+    if backend is None:
+        return None
+    tokens = tokenize_query(text)
+    if not tokens:
+        return []
+    books = Book.objects.all() if within is None else within
+    subquery = None if within is None else within.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        ids = backend.search(cursor, tokens, limit, subquery)
+
+    text = text.strip()
+    if text.isdigit():
+        book_id = int(text)
+        if books.filter(id=book_id).exists():
+            ids = [book_id] + [i for i in ids if i != book_id]
+    return ids
+
+
+def filter_books(search_text=None, category=None, author=None, status=None):
+    """
+    Queryset sách theo bộ lọc của trang tra cứu, kèm list id theo độ liên quan
+    (None nếu không tìm theo chỉ mục: không có từ khóa hoặc database không hỗ trợ).
+    Thể loại / tác giả / tình trạng được lọc ngay trong truy vấn chỉ mục, list id là
+    toàn bộ sách khớp (không cắt ở SEARCH_RESULT_LIMIT).
+    """
+    from django.db.models import Q
+    from django.db.models.expressions import RawSQL
+    from .models import Book
+
+    books = Book.objects.all()
+    if category:
+        books = books.filter(book_title__category=category)
+    if author:
+        books = books.filter(book_title__authors=author)
+    if status == 'available':
+        books = books.filter(remaining_quantity__gt=0)
+    elif status == 'unavailable':
+        books = books.filter(remaining_quantity=0)
+
+    # Tìm kiếm theo tên sách, tác giả, NXB, ISBN, thể loại (chỉ mục toàn văn) hoặc mã sách
+    ranked_ids = None
+    if search_text:
+        backend = get_backend()
+        if backend is not None:
+            ranked_ids = search_book_ids(search_text, limit=None, within=books)
+            tokens = tokenize_query(search_text)
+            # Tập sách khớp dạng truy vấn con trên chỉ mục (không truyền list id vào IN)
+            condition = Q(id__in=RawSQL(*backend.match_sql(tokens))) if tokens else Q(pk__in=[])
+        else:
+            # Database không hỗ trợ chỉ mục toàn văn
+            condition = Q(book_title__search_key__contains=fold_text(search_text))
+        if search_text.strip().isdigit():
+            condition |= Q(id=int(search_text))
+        books = books.filter(condition)
+    return books, ranked_ids
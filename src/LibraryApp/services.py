@@ -0,0 +1,443 @@
+"""
+Nghiệp vụ mượn/trả sách dùng chung cho views, forms và API
+
+Mọi thay đổi bộ đếm tồn kho (Book.quantity, Book.remaining_quantity) và nợ
+(Reader.total_debt) đi qua các hàm INVENTORY bên dưới: mỗi thay đổi là 1 câu
+UPDATE ... SET x = x + n, không đọc giá trị lên Python rồi ghi lại nên không mất
+cập nhật khi nhiều transaction chạy đồng thời. CHECK constraint trên database
+chặn giá trị âm (IntegrityError -> transaction bị rollback).
+"""
+from collections import Counter
+from functools import partial
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, FilteredRelation, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .caching import invalidate_search_results
+from .models import (
+    Parameter, Reader, Book, BookItem, BorrowReturnReceipt, ReaderCirculationSummary, DailyCirculationRollup
+)
+
+
+def check_reader_eligibility(reader_id, borrow_count, params):
+    """
+    Kiểm tra điều kiện mượn của độc giả (QĐ4.1, QĐ4.2, QĐ4.4) với 1 truy vấn
+    (độc giả + bảng tổng hợp). Trả về (reader hoặc None, số sách đang mượn, [lỗi]).
+    """
+    errors = []
+    reader = Reader.objects.select_related('circulation_summary').filter(id=reader_id).first()
+    if reader is None:
+        return None, 0, ['Độc giả không tồn tại.']
+    
+    try:
+        summary = reader.circulation_summary
+    except ReaderCirculationSummary.DoesNotExist:
+        summary = ReaderCirculationSummary.refresh(reader.id)
+    current_borrowed = summary.open_loan_count
+    
+    # QĐ4.1: Kiểm tra thẻ còn hạn
+    today = timezone.localdate()
+    if reader.expiration_date and timezone.localtime(reader.expiration_date).date() < today:
+        errors.append(
+            f'Thẻ độc giả đã hết hạn (hết hạn: {timezone.localtime(reader.expiration_date).strftime("%d/%m/%Y")}).'
+        )
+    
+    # QĐ4.2: Kiểm tra độc giả không có sách mượn quá hạn (nếu setting yêu cầu)
+    if not params.allow_borrow_when_overdue and summary.has_overdue:
+        errors.append('Độc giả có sách mượn quá hạn. Vui lòng trả sách trước khi mượn thêm.')
+    
+    # QĐ4.4: Kiểm tra số sách đang mượn + số sách chọn không vượt quá tối đa
+    if current_borrowed + borrow_count > params.max_borrowed_books:
+        errors.append(
+            f'Độc giả đang mượn {current_borrowed} quyển. Chỉ có thể mượn thêm '
+            f'{max(0, params.max_borrowed_books - current_borrowed)} quyển nữa (tối đa {params.max_borrowed_books}).'
+        )
+    
+    return reader, current_borrowed, errors
+
+
+def check_borrow_eligibility(reader_id, book_ids):
+    """
+    Kiểm tra điều kiện mượn (QĐ4) cho cả giỏ sách bằng số truy vấn cố định:
+    1 truy vấn độc giả + bảng tổng hợp, 1 truy vấn sách + số cuốn còn sẵn
+    (Parameter lấy từ cache).
+
+    Trả về dict:
+    {
+        'eligible': bool,
+        'reader': Reader hoặc None,
+        'reader_errors': [str],         # QĐ4.1, QĐ4.2, QĐ4.4
+        'books': [                      # Theo thứ tự book_ids, mỗi sách 1 dòng
+            {'book_id', 'title', 'requested', 'available_count', 'ok', 'error'}
+        ],
+        'current_borrowed': int,
+        'max_borrowed_books': int,
+    }
+    """
+    result = {
+        'eligible': False,
+        'reader': None,
+        'reader_errors': [],
+        'books': [],
+        'current_borrowed': 0,
+        'max_borrowed_books': 0,
+    }
+
+    params = Parameter.get_current()
+    if not params:
+        result['reader_errors'].append('Hệ thống chưa được cấu hình.')
+        return result
+    result['max_borrowed_books'] = params.max_borrowed_books
+
+    # Độc giả + tình trạng mượn (1 truy vấn)
+    reader, result['current_borrowed'], result['reader_errors'] = check_reader_eligibility(
+        reader_id, len(book_ids), params
+    )
+    result['reader'] = reader
+
+    # Sách + số cuốn còn sẵn (1 truy vấn)
+    requested = Counter(book_ids)
+    books = Book.objects.filter(id__in=list(requested)).select_related('book_title').annotate(
+        available_count=Count('book_items', filter=Q(book_items__is_borrowed=False))
+    ).in_bulk()
+
+    for book_id, count in requested.items():
+        book = books.get(book_id)
+        row = {
+            'book_id': book_id,
+            'title': book.book_title.book_title if book else None,
+            'requested': count,
+            'available_count': book.available_count if book else 0,
+            'ok': True,
+            'error': None,
+        }
+        if book is None:
+            row['error'] = f'Sách (ID: {book_id}) không tồn tại.'
+        elif book.available_count < count:
+            # QĐ4.3: Kiểm tra sách không đang được mượn (còn sách có sẵn)
+            row['error'] = f'Sách "{book.book_title.book_title}" hiện đang không có sẵn (tất cả đang được mượn).'
+        row['ok'] = row['error'] is None
+        result['books'].append(row)
+
+    result['book_objects'] = books
+    result['eligible'] = (
+        reader is not None
+        and not result['reader_errors']
+        and bool(result['books'])
+        and all(row['ok'] for row in result['books'])
+    )
+    return result
+
+
+def allocate_book_items(book_id, count=1):
+    """
+    Cấp `count` cuốn còn sẵn của 1 đầu sách cho transaction hiện tại
+    (phải gọi trong transaction.atomic()). Các cuốn được đánh dấu is_borrowed=True.
+
+    - Backend hỗ trợ SKIP LOCKED (PostgreSQL, MySQL 8, Oracle): mỗi transaction
+      đồng thời khóa và nhận các cuốn khác nhau, không phải chờ cùng 1 dòng.
+    - SQLite: không có khóa dòng, giành từng cuốn bằng UPDATE có điều kiện
+      (is_borrowed=False -> True), cuốn đã bị transaction khác giành thì bỏ qua.
+
+    Trả về list BookItem (ít hơn count nếu không đủ sách).
+    """
+    if count <= 0:
+        return []
+    
+    available = BookItem.objects.filter(book_id=book_id, is_borrowed=False).order_by('id')
+    
+    if connection.features.has_select_for_update_skip_locked:
+        items = list(available.select_for_update(skip_locked=True)[:count])
+        if items:
+            BookItem.objects.filter(id__in=[item.id for item in items]).update(is_borrowed=True)
+    else:
+        claimed = []
+        while len(claimed) < count:
+            candidates = list(available.values_list('id', flat=True)[:count - len(claimed)])
+            if not candidates:
+                break
+            for item_id in candidates:
+                if BookItem.objects.filter(id=item_id, is_borrowed=False).update(is_borrowed=True):
+                    claimed.append(item_id)
+        items = list(BookItem.objects.filter(id__in=claimed).order_by('id'))
+    
+    for item in items:
+        item.is_borrowed = True
+    return items
+
+
+# ==================== INVENTORY ====================
+
+def adjust_remaining_quantity(book_id, delta):
+    """Tăng/giảm số lượng còn lại của sách"""
+    adjust_remaining_quantities({book_id: delta})
+
+
+def adjust_remaining_quantities(deltas):
+    """
+    Tăng/giảm số lượng còn lại của nhiều sách bằng 1 câu UPDATE
+    deltas: {book_id: delta}
+    """
+    deltas = {book_id: delta for book_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    if len(deltas) == 1:
+        (book_id, delta), = deltas.items()
+        change = Value(delta)
+    else:
+        change = Case(
+            *[When(pk=book_id, then=Value(delta)) for book_id, delta in deltas.items()],
+            output_field=IntegerField(),
+        )
+    Book.objects.filter(pk__in=list(deltas)).update(
+        remaining_quantity=F('remaining_quantity') + change,
+        updated_at=timezone.now(),
+    )
+    # UPDATE trực tiếp không phát signal -> tự tăng version kết quả tra cứu sách
+    transaction.on_commit(partial(invalidate_search_results, 'book'))
+
+
+def add_stock(book_id, quantity, unit_price=None):
+    """
+    Nhập thêm sách: tăng tổng số lượng và số lượng còn lại, cập nhật đơn giá mới nhất.
+    quantity âm: bớt sách rảnh khỏi kho (hủy phiếu nhập)
+    """
+    values = {
+        'quantity': F('quantity') + quantity,
+        'remaining_quantity': F('remaining_quantity') + quantity,
+        'updated_at': timezone.now(),
+    }
+    if unit_price is not None:
+        values['unit_price'] = unit_price
+    Book.objects.filter(pk=book_id).update(**values)
+    transaction.on_commit(partial(invalidate_search_results, 'book'))
+
+
+def record_checkout(book_item):
+    """Cuốn sách được cho mượn: đánh dấu đang mượn, giảm số lượng còn lại"""
+    BookItem.objects.filter(pk=book_item.pk).update(is_borrowed=True)
+    book_item.is_borrowed = True
+    adjust_remaining_quantity(book_item.book_id, -1)
+
+
+def record_checkin(book_item):
+    """Cuốn sách được trả lại / hủy mượn: đánh dấu sẵn sàng, tăng số lượng còn lại"""
+    BookItem.objects.filter(pk=book_item.pk).update(is_borrowed=False)
+    book_item.is_borrowed = False
+    adjust_remaining_quantity(book_item.book_id, 1)
+
+
+def adjust_reader_debt(reader_id, delta):
+    """Cộng (tiền phạt) / trừ (thu tiền, hủy) nợ của độc giả và bảng tổng hợp"""
+    if delta:
+        Reader.objects.filter(pk=reader_id).update(total_debt=F('total_debt') + delta)
+        ReaderCirculationSummary.add_debt(reader_id, delta)
+
+
+# ==================== RETURN ====================
+
+def return_books(reader_id, book_item_ids, return_date):
+    """
+    Trả nhiều sách của 1 độc giả theo tập (YC5), số truy vấn không phụ thuộc số sách:
+    - 1 truy vấn khóa các phiếu đang mượn
+    - tiền phạt tính trong Python theo cùng quy tắc với BorrowReturnReceipt.calculate_fine()
+    - 1 bulk_update phiếu, 1 UPDATE cuốn sách, 1 UPDATE số lượng còn lại (gộp theo sách),
+      1 lần cộng nợ độc giả, 1 lần tính lại bảng tổng hợp, 1 lần cập nhật tổng hợp theo ngày
+
+    Trả về list phiếu đã trả (rỗng nếu không có phiếu nào đang mượn).
+    Ngày trả nhỏ hơn ngày mượn -> ValidationError, không phiếu nào được cập nhật.
+    """
+    with transaction.atomic():
+        receipts = list(
+            BorrowReturnReceipt.objects.select_for_update().select_related('book_item').filter(
+                reader_id=reader_id,
+                book_item_id__in=book_item_ids,
+                return_date__isnull=True,
+                is_cancelled=False,
+            ).order_by('id')
+        )
+        if not receipts:
+            return []
+        
+        book_deltas = Counter()
+        total_fine = 0
+        now = timezone.now()
+        for receipt in receipts:
+            if return_date < receipt.borrow_date:
+                raise ValidationError({
+                    'return_date': 'Ngày thực trả không được nhỏ hơn ngày mượn'
+                })
+            receipt.return_date = return_date
+            receipt.fine_amount = receipt.calculate_fine() if receipt.is_overdue else 0
+            # bulk_update không tự cập nhật auto_now
+            receipt.updated_at = now
+            receipt.book_item.is_borrowed = False
+            book_deltas[receipt.book_item.book_id] += 1
+            total_fine += receipt.fine_amount
+        
+        BorrowReturnReceipt.objects.bulk_update(receipts, ['return_date', 'fine_amount', 'updated_at'])
+        BookItem.objects.filter(pk__in=[r.book_item_id for r in receipts]).update(is_borrowed=False)
+        adjust_remaining_quantities(book_deltas)
+        adjust_reader_debt(reader_id, total_fine)
+        
+        # bulk_update không gửi post_save -> tự cập nhật bảng tổng hợp
+        ReaderCirculationSummary.refresh(reader_id)
+        DailyCirculationRollup.record_receipts(receipts, returns_only=True)
+    
+    return receipts
+
+
+# ==================== BARCODE SCAN ====================
+
+# Số mã vạch tối đa trong 1 lần quét theo lô
+SCAN_BATCH_LIMIT = 50
+
+
+def resolve_barcodes(barcodes):
+    """
+    Tra cứu cuốn sách, phiếu đang mượn và độc giả theo mã vạch bằng 1 truy vấn
+    (barcode unique -> dùng index, phiếu đang mượn nối bằng LEFT JOIN có điều kiện).
+    Trả về {barcode: dict}, mã vạch không tồn tại không có trong kết quả.
+    """
+    rows = BookItem.objects.filter(barcode__in=barcodes).annotate(
+        open_loan=FilteredRelation(
+            'borrow_receipts',
+            condition=Q(borrow_receipts__return_date__isnull=True, borrow_receipts__is_cancelled=False),
+        )
+    ).values(
+        'id', 'barcode', 'is_borrowed', 'book_id',
+        'book__book_title__book_title',
+        'open_loan__id', 'open_loan__due_date',
+        'open_loan__reader_id', 'open_loan__reader__reader_name',
+    )
+    return {
+        row['barcode']: {
+            'book_item_id': row['id'],
+            'barcode': row['barcode'],
+            'is_borrowed': row['is_borrowed'],
+            'book_id': row['book_id'],
+            'title': row['book__book_title__book_title'],
+            'receipt_id': row['open_loan__id'],
+            'due_date': row['open_loan__due_date'],
+            'reader_id': row['open_loan__reader_id'],
+            'reader_name': row['open_loan__reader__reader_name'],
+        }
+        for row in rows
+    }
+
+
+def scan_checkout(reader_id, barcodes, borrow_date=None):
+    """
+    Cho mượn theo mã vạch (1 hoặc nhiều cuốn) trong 1 transaction.
+    Mọi mã vạch phải hợp lệ và độc giả đủ điều kiện (QĐ4), nếu không thì không ghi gì.
+
+    Trả về dict {'success', 'errors', 'items': [{barcode, ok, error, title, receipt_id, due_date}]}
+    """
+    result = {'success': False, 'errors': [], 'items': []}
+    params = Parameter.get_current()
+    if not params:
+        result['errors'].append('Hệ thống chưa được cấu hình.')
+        return result
+    
+    borrow_date = borrow_date or timezone.now()
+    due_date = borrow_date + timezone.timedelta(days=params.max_borrow_days)
+    
+    resolved = resolve_barcodes(barcodes)
+    reader, _, result['errors'] = check_reader_eligibility(reader_id, len(barcodes), params)
+    
+    seen = set()
+    for barcode in barcodes:
+        row = resolved.get(barcode)
+        item = {'barcode': barcode, 'ok': False, 'error': None, 'title': row['title'] if row else None}
+        if row is None:
+            item['error'] = f'Không tìm thấy cuốn sách có mã vạch {barcode}.'
+        elif barcode in seen:
+            item['error'] = f'Mã vạch {barcode} bị quét trùng.'
+        elif row['is_borrowed'] or row['receipt_id']:
+            item['error'] = f'Cuốn "{row["title"]}" ({barcode}) đang được mượn.'
+        else:
+            item['ok'] = True
+        seen.add(barcode)
+        result['items'].append(item)
+    
+    if result['errors'] or not all(item['ok'] for item in result['items']):
+        return result
+    
+    rows = [resolved[barcode] for barcode in barcodes]
+    with transaction.atomic():
+        # Giành tất cả cuốn bằng 1 UPDATE có điều kiện; thiếu cuốn nào -> rollback
+        claimed = BookItem.objects.filter(
+            pk__in=[row['book_item_id'] for row in rows], is_borrowed=False
+        ).update(is_borrowed=True)
+        if claimed != len(rows):
+            transaction.set_rollback(True)
+            result['errors'].append('Có cuốn sách vừa được cho mượn ở quầy khác. Vui lòng quét lại.')
+            return result
+        
+        receipts = BorrowReturnReceipt.objects.bulk_create([
+            BorrowReturnReceipt(
+                reader=reader,
+                book_item_id=row['book_item_id'],
+                borrow_date=borrow_date,
+                due_date=due_date,
+            )
+            for row in rows
+        ])
+        adjust_remaining_quantities({
+            book_id: -count for book_id, count in Counter(row['book_id'] for row in rows).items()
+        })
+        # bulk_create không gửi post_save -> tự cập nhật bảng tổng hợp
+        ReaderCirculationSummary.refresh(reader.id)
+        DailyCirculationRollup.record_receipts(receipts)
+    
+    for item, receipt in zip(result['items'], receipts):
+        item['receipt_id'] = receipt.id
+        item['due_date'] = receipt.due_date
+    result['success'] = True
+    return result
+
+
+def scan_checkin(barcodes, return_date=None):
+    """
+    Nhận trả theo mã vạch (1 hoặc nhiều cuốn, có thể của nhiều độc giả) trong 1 transaction.
+    Mã vạch không tồn tại, không đang mượn hoặc bị quét trùng được báo lỗi riêng,
+    các cuốn còn lại vẫn được trả.
+
+    Trả về dict {'success', 'errors', 'items': [{barcode, ok, error, title, receipt_id, reader_name, fine}]}
+    """
+    return_date = return_date or timezone.now()
+    result = {'success': False, 'errors': [], 'items': []}
+    resolved = resolve_barcodes(barcodes)
+    
+    by_reader = {}
+    seen = set()
+    for barcode in barcodes:
+        row = resolved.get(barcode)
+        item = {'barcode': barcode, 'ok': False, 'error': None, 'title': row['title'] if row else None}
+        if row is None:
+            item['error'] = f'Không tìm thấy cuốn sách có mã vạch {barcode}.'
+        elif barcode in seen:
+            item['error'] = f'Mã vạch {barcode} bị quét trùng.'
+        elif not row['receipt_id']:
+            item['error'] = f'Cuốn "{row["title"]}" ({barcode}) không có phiếu mượn đang mở.'
+        else:
+            item['receipt_id'] = row['receipt_id']
+            item['reader_name'] = row['reader_name']
+            by_reader.setdefault(row['reader_id'], []).append(row['book_item_id'])
+        seen.add(barcode)
+        result['items'].append(item)
+    
+    fines = {}
+    with transaction.atomic():
+        for reader_id, book_item_ids in by_reader.items():
+            for receipt in return_books(reader_id, book_item_ids, return_date):
+                fines[receipt.id] = receipt.fine_amount
+    
+    for item in result['items']:
+        if item.get('receipt_id') in fines:
+            item['ok'] = True
+            item['fine'] = fines[item['receipt_id']]
+    result['success'] = bool(fines)
+    return result
@@ -0,0 +1,187 @@
+"""
+Signals đồng bộ dữ liệu phụ khi dữ liệu chính thay đổi:
+- Vô hiệu hóa cache quyền. Version chỉ được tăng sau khi transaction commit,
+  tránh worker khác nạp lại dữ liệu cũ (chưa commit) vào version mới.
+- Cập nhật bảng tổng hợp mượn trả theo độc giả trong cùng transaction, trừ phần của
+  phiếu mượn / phiếu thu bị xóa khỏi bảng tổng hợp theo ngày;
+  xóa bản lưu báo cáo theo thể loại của tháng đã kết thúc có phiếu mượn thay đổi.
+- Cập nhật chỉ mục toàn văn tra cứu sách và chỉ mục gợi ý (autocomplete)
+  trong cùng transaction. Sửa đầu sách / tác giả / thể loại ghi lại updated_at của
+  các sách liên quan; chỉ xóa sách mới tăng version danh mục (sau khi commit).
+- Tăng version kết quả tra cứu đã cache (sách, độc giả) sau khi commit.
+"""
+from functools import partial
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    Permission, Function, UserGroup,
+    Reader, BorrowReturnReceipt, Receipt, ReaderCirculationSummary, DailyCirculationRollup, DailyPaymentRollup,
+    Category, Author, BookTitle, AuthorDetail, Book, AutocompleteToken
+)
+from .caching import (
+    invalidate_group_permissions, invalidate_all_group_permissions, invalidate_catalog,
+    invalidate_search_results
+)
+from .reports import invalidate_snapshot as invalidate_report_snapshot
+from .search import INDEXED_BOOK_FIELDS, ensure_search_index, index_books, remove_books
+from . import autocomplete
+
+
+@receiver([post_save, post_delete], sender=Permission)
+def permission_changed(sender, instance, **kwargs):
+    """Quyền thay đổi -> tăng version quyền của nhóm"""
+    transaction.on_commit(partial(invalidate_group_permissions, instance.user_group_id))
+
+
+@receiver([post_save, post_delete], sender=UserGroup)
+def user_group_changed(sender, instance, **kwargs):
+    """Nhóm người dùng thay đổi -> tăng version quyền của nhóm"""
+    transaction.on_commit(partial(invalidate_group_permissions, instance.pk))
+
+
+@receiver([post_save, post_delete], sender=Function)
+def function_changed(sender, instance, **kwargs):
+    """Chức năng thay đổi (đổi tên, xóa) -> ảnh hưởng tất cả nhóm"""
+    transaction.on_commit(invalidate_all_group_permissions)
+
+
+@receiver(post_save, sender=BorrowReturnReceipt)
+def borrow_receipt_saved(sender, instance, created, **kwargs):
+    """Mượn mới -> cập nhật tăng dần; trả / hủy / hoàn tác -> tính lại dòng của độc giả"""
+    if created:
+        ReaderCirculationSummary.record_borrow(instance.reader_id, instance.due_date)
+        invalidate_report_snapshot(instance.borrow_date)
+    else:
+        ReaderCirculationSummary.refresh(instance.reader_id)
+
+
+@receiver(post_delete, sender=BorrowReturnReceipt)
+def borrow_receipt_deleted(sender, instance, **kwargs):
+    ReaderCirculationSummary.refresh(instance.reader_id)
+    DailyCirculationRollup.record_receipts([], removed=[instance])
+    invalidate_report_snapshot(instance.borrow_date)
+
+
+@receiver(post_delete, sender=Receipt)
+def payment_receipt_deleted(sender, instance, **kwargs):
+    DailyPaymentRollup.record_payments([], removed=[instance])
+
+
+@receiver(post_save, sender=Reader)
+def reader_saved(sender, instance, created, update_fields=None, **kwargs):
+    """Độc giả mới -> tạo dòng tổng hợp; nợ thay đổi (trả trễ, thu tiền, hủy) -> đồng bộ nợ"""
+    if created:
+        ReaderCirculationSummary.objects.create(reader=instance, accrued_debt=instance.total_debt)
+    elif update_fields is None or 'total_debt' in update_fields:
+        ReaderCirculationSummary.record_debt(instance.pk, instance.total_debt)
+
+
+# ==================== SEARCH INDEX ====================
+
+def create_search_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """Sau migrate: tạo bảng chỉ mục toàn văn (không nằm trong migration), nạp chỉ mục đang trống"""
+    if using == DEFAULT_DB_ALIAS:
+        ensure_search_index()
+        autocomplete.ensure_autocomplete_index()
+
+
+def _reindex_books(book_ids, touch=True):
+    """
+    Đánh lại chỉ mục toàn văn / gợi ý của các sách.
+    touch: đầu sách, tác giả, thể loại thay đổi -> ghi lại updated_at của các sách liên quan
+    để chỉ mục trong bộ nhớ cập nhật riêng các sách này theo watermark (không xây lại toàn bộ)
+    """
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    index_books(book_ids)
+    autocomplete.reindex(AutocompleteToken.KIND_BOOK, book_ids)
+    if touch:
+        # UPDATE trực tiếp: không phát post_save của Book
+        Book.objects.filter(id__in=book_ids).update(updated_at=timezone.now())
+        transaction.on_commit(partial(invalidate_search_results, 'book'))
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, update_fields=None, raw=False, **kwargs):
+    """Chỉ đánh lại chỉ mục khi cột được index thay đổi (cập nhật số lượng chỉ bỏ kết quả tra cứu đã cache)"""
+    if raw:
+        return
+    transaction.on_commit(partial(invalidate_search_results, 'book'))
+    if update_fields is not None and not INDEXED_BOOK_FIELDS & set(update_fields):
+        return
+    # updated_at (auto_now) đã đổi -> chỉ mục trong bộ nhớ tự cập nhật theo watermark
+    _reindex_books([instance.pk], touch=False)
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    """Sách bị xóa không còn dòng để đọc theo watermark -> tăng version danh mục"""
+    remove_books([instance.pk])
+    autocomplete.remove(AutocompleteToken.KIND_BOOK, [instance.pk])
+    transaction.on_commit(invalidate_catalog)
+
+
+@receiver(post_save, sender=BookTitle)
+def book_title_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        _reindex_books(Book.objects.filter(book_title=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        _reindex_books(Book.objects.filter(book_title__category=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Author)
+def author_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        _reindex_books(Book.objects.filter(book_title__authors=instance).values_list('id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=AuthorDetail)
+def author_detail_changed(sender, instance, raw=False, **kwargs):
+    """Gán / bỏ tác giả của đầu sách -> đánh lại chỉ mục các sách của đầu sách"""
+    if not raw:
+        _reindex_books(Book.objects.filter(book_title_id=instance.book_title_id).values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=BookTitle.authors.through)
+def book_title_authors_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """BookTitle.authors.add/remove/clear dùng bulk -> không phát post_save của AuthorDetail"""
+    if reverse and action == 'pre_clear':
+        # author.book_titles.clear(): ghi nhớ các đầu sách sắp bị gỡ
+        instance._cleared_book_title_ids = list(instance.book_titles.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        title_ids = [instance.pk]
+    elif action == 'post_clear':
+        title_ids = instance.__dict__.pop('_cleared_book_title_ids', [])
+    else:
+        title_ids = pk_set
+    _reindex_books(Book.objects.filter(book_title_id__in=title_ids).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Reader)
+def reader_autocomplete_saved(sender, instance, update_fields=None, raw=False, **kwargs):
+    """Tên / email thay đổi -> đánh lại token gợi ý; trạng thái hoạt động thay đổi -> bỏ gợi ý đã cache"""
+    if raw:
+        return
+    fields = None if update_fields is None else set(update_fields)
+    if fields is None or {'reader_name', 'email', 'is_active'} & fields:
+        transaction.on_commit(partial(invalidate_search_results, 'reader'))
+    if fields is None or {'reader_name', 'email'} & fields:
+        autocomplete.reindex(AutocompleteToken.KIND_READER, [instance.pk])
+
+
+@receiver(post_delete, sender=Reader)
+def reader_deleted(sender, instance, **kwargs):
+    autocomplete.remove(AutocompleteToken.KIND_READER, [instance.pk])
+    transaction.on_commit(partial(invalidate_search_results, 'reader'))
@@ -1,7 +1,20 @@
-from django.test import TestCase, Client, override_settings
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.contrib.auth.models import User
 from django.urls import reverse
-from .models import LibraryUser, UserGroup
+from django.core.cache import cache
+from datetime import datetime, timedelta
+from django.utils import timezone
+from .models import (
+    LibraryUser, UserGroup, Function, Permission, Parameter,
+    ReaderType, Reader, Category, BookTitle, Book, BookItem, BorrowReturnReceipt,
+    ReaderCirculationSummary, Receipt, DailyCirculationRollup, DailyPaymentRollup
+)
+from .decorators import check_permission
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'search': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'search'},
+}
 
 @override_settings(RATELIMIT_ENABLE=False)
 class LoginTest(TestCase):
@@ -102,3 +115,1050 @@ class LoginTest(TestCase):
         self.lib_user.refresh_from_db()
         self.assertEqual(self.lib_user.failed_login_attempts, 0)
         self.assertTrue(response.context['user'].is_authenticated)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PermissionSnapshotTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.group = UserGroup.objects.create(user_group_name='Thủ thư test')
+        self.user = User.objects.create_user(username='librarian', password='password123', is_staff=True)
+        LibraryUser.objects.create(
+            user=self.user,
+            full_name='Librarian',
+            date_of_birth='1990-01-01',
+            user_group=self.group
+        )
+        for name in ['Quản lý độc giả', 'Lập phiếu mượn sách', 'Quản lý kho sách']:
+            function = Function.objects.create(function_name=name, screen_name=name)
+            Permission.objects.create(user_group=self.group, function=function, can_view=True, can_add=True)
+
+    def test_snapshot_loaded_once(self):
+        user = User.objects.select_related('library_user').get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(check_permission(user, 'Quản lý độc giả', 'view'))
+            self.assertTrue(check_permission(user, 'Lập phiếu mượn sách', 'add'))
+            self.assertFalse(check_permission(user, 'Quản lý kho sách', 'delete'))
+            self.assertFalse(check_permission(user, 'Không tồn tại', 'view'))
+            # 'change' không phải loại quyền hợp lệ
+            self.assertFalse(check_permission(user, 'Quản lý độc giả', 'change'))
+
+    def test_cache_shared_and_invalidated_by_signal(self):
+        user = User.objects.select_related('library_user').get(pk=self.user.pk)
+        self.assertFalse(check_permission(user, 'Quản lý kho sách', 'delete'))
+
+        # Request mới: đọc từ cache, không truy vấn quyền
+        user = User.objects.select_related('library_user').get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(check_permission(user, 'Quản lý kho sách', 'delete'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            permission = Permission.objects.get(function__function_name='Quản lý kho sách')
+            permission.can_delete = True
+            permission.save()
+
+        user = User.objects.select_related('library_user').get(pk=self.user.pk)
+        self.assertTrue(check_permission(user, 'Quản lý kho sách', 'delete'))
+
+    def test_evicted_version_does_not_restore_revoked_permission(self):
+        from .caching import PERMISSION_VERSION_KEY, get_group_permission_map
+
+        self.assertTrue(get_group_permission_map(self.group.pk)['Quản lý độc giả']['view'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Permission.objects.filter(function__function_name='Quản lý độc giả').update(can_view=False)
+            Permission.objects.get(function__function_name='Quản lý độc giả').save()
+        # Version key bị loại khỏi cache (cull) -> không được trùng version cũ
+        cache.delete(PERMISSION_VERSION_KEY.format(group_id=self.group.pk))
+        self.assertFalse(get_group_permission_map(self.group.pk)['Quản lý độc giả']['view'])
+
+    def test_apply_matrix_bulk_upsert(self):
+        functions = {f.function_name: f for f in Function.objects.all()}
+        new_function = Function.objects.create(function_name='Báo cáo sách trả trễ', screen_name='Báo cáo')
+        matrix = {
+            functions['Quản lý kho sách'].id: {'view': True, 'add': True, 'edit': True, 'delete': True},
+            functions['Quản lý độc giả'].id: {'view': True, 'add': True, 'edit': False, 'delete': False},
+            new_function.id: {'view': True, 'add': False, 'edit': False, 'delete': False},
+        }
+        # 1 SELECT + INSERT + UPDATE (cộng savepoint của transaction)
+        with self.assertNumQueries(5):
+            created, updated = Permission.apply_matrix(self.group, matrix)
+        self.assertEqual((created, updated), (1, 1))
+        self.assertTrue(Permission.objects.get(user_group=self.group, function=new_function).can_view)
+        self.assertTrue(Permission.objects.get(user_group=self.group, function=functions['Quản lý kho sách']).can_delete)
+
+        # overwrite=False không ghi đè quyền đã có
+        matrix[functions['Quản lý kho sách'].id] = {'view': False}
+        self.assertEqual(Permission.apply_matrix(self.group, matrix, overwrite=False), (0, 0))
+        self.assertTrue(Permission.objects.get(user_group=self.group, function=functions['Quản lý kho sách']).can_view)
+
+    def test_template_flags_resolved_lazily(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['can_view_readers']())
+        self.assertFalse(response.context['can_view_reports']())
+        # Chỉ những cờ được template đọc mới được tính
+        request = response.wsgi_request
+        self.assertLessEqual(request._permission_flags_read, request._permission_flags_defined)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ParameterCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Parameter.invalidate_cache()
+        self.parameter = Parameter.objects.create(fine_rate=1000)
+
+    def test_get_current_cached_and_invalidated_on_save(self):
+        self.assertEqual(Parameter.get_current().fine_rate, 1000)
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                self.assertEqual(Parameter.get_current().fine_rate, 1000)
+
+        self.parameter.fine_rate = 2000
+        self.parameter.save()
+        self.assertEqual(Parameter.get_current().fine_rate, 2000)
+
+
+class CirculationDataMixin:
+    """Dữ liệu mẫu cho các test mượn/trả"""
+    def create_circulation_data(self, copies=3):
+        Parameter.invalidate_cache()
+        self.parameter = Parameter.objects.create(fine_rate=1000, max_borrowed_books=5, max_borrow_days=4)
+        self.reader_type = ReaderType.objects.create(reader_type_name='Sinh viên')
+        self.reader = Reader.objects.create(
+            reader_name='Nguyễn Văn A',
+            reader_type=self.reader_type,
+            date_of_birth='2000-01-01',
+            address='TP.HCM',
+            email='a@example.com'
+        )
+        self.category = Category.objects.create(category_name='Tin học')
+        self.book_title = BookTitle.objects.create(book_title='Lập trình Python', category=self.category)
+        self.book = Book.objects.create(
+            book_title=self.book_title,
+            quantity=copies,
+            remaining_quantity=copies,
+            unit_price=100000,
+            publish_year=timezone.localdate().year,
+            publisher='NXB Trẻ'
+        )
+        self.items = [
+            BookItem.objects.create(book=self.book, barcode=f'0001-{i:03d}')
+            for i in range(1, copies + 1)
+        ]
+
+    def borrow(self, item, days_ago, due_days=4):
+        borrow_date = timezone.now() - timedelta(days=days_ago)
+        return BorrowReturnReceipt.objects.create(
+            reader=self.reader,
+            book_item=item,
+            borrow_date=borrow_date,
+            due_date=borrow_date + timedelta(days=due_days)
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PendingDebtTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data()
+
+    def test_pending_debt_matches_python_rules(self):
+        overdue_1 = self.borrow(self.items[0], days_ago=10)
+        overdue_2 = self.borrow(self.items[1], days_ago=7)
+        self.borrow(self.items[2], days_ago=1)
+        expected = overdue_1.calculate_fine() + overdue_2.calculate_fine()
+        self.assertGreater(expected, 0)
+
+        with self.assertNumQueries(1):
+            reader = Reader.objects.with_pending_debt().get(pk=self.reader.pk)
+            self.assertEqual(reader.pending_fine, expected)
+            self.assertEqual(reader.pending_debt, expected)
+            self.assertEqual(reader.total_debt_with_pending, reader.total_debt + expected)
+        self.assertEqual(reader.pending_overdue_days, overdue_1.days_overdue + overdue_2.days_overdue)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CirculationSummaryTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data()
+
+    def assertSummaryMatchesRebuild(self):
+        incremental = ReaderCirculationSummary.objects.get(reader=self.reader)
+        ReaderCirculationSummary.rebuild_all()
+        rebuilt = ReaderCirculationSummary.objects.get(reader=self.reader)
+        for field in ['open_loan_count', 'overdue_count', 'earliest_due_date', 'latest_due_date', 'accrued_debt']:
+            self.assertEqual(getattr(incremental, field), getattr(rebuilt, field), field)
+        return rebuilt
+
+    def test_summary_tracks_borrow_and_return(self):
+        overdue = self.borrow(self.items[0], days_ago=10)
+        self.borrow(self.items[1], days_ago=1)
+        summary = ReaderCirculationSummary.objects.get(reader=self.reader)
+        self.assertEqual(summary.open_loan_count, 2)
+        self.assertEqual(summary.earliest_due_date, overdue.due_date)
+        self.assertTrue(summary.has_overdue)
+
+        overdue.return_date = timezone.now()
+        overdue.save()
+        summary = self.assertSummaryMatchesRebuild()
+        self.assertEqual(summary.open_loan_count, 1)
+        self.assertFalse(summary.has_overdue)
+        self.assertEqual(summary.accrued_debt, overdue.fine_amount)
+        self.assertGreater(summary.accrued_debt, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OverdueAnnotationTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data()
+
+    def test_annotations_match_python_rules(self):
+        receipts = [
+            self.borrow(self.items[0], days_ago=10),
+            self.borrow(self.items[1], days_ago=1),
+            self.borrow(self.items[2], days_ago=9),
+        ]
+        receipts[2].return_date = timezone.now() - timedelta(days=1)
+        receipts[2].save()
+
+        annotated = {r.pk: r for r in BorrowReturnReceipt.objects.with_overdue()}
+        for receipt in BorrowReturnReceipt.objects.all():
+            row = annotated[receipt.pk]
+            self.assertEqual(row.days_overdue, receipt.days_overdue)
+            self.assertEqual(row.is_overdue, receipt.is_overdue)
+            self.assertEqual(row.fine, receipt.calculate_fine())
+            self.assertEqual(row.local_due_date, timezone.localtime(receipt.due_date).date())
+
+        ordered = list(BorrowReturnReceipt.objects.with_overdue().order_by('-days_overdue', 'pk'))
+        self.assertEqual(ordered[0].pk, receipts[0].pk)
+
+    def test_list_views_sort_by_days_overdue(self):
+        self.borrow(self.items[0], days_ago=10)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('borrow_book_list'), {'sort': 'days_overdue', 'status': 'overdue'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_results'], 1)
+        response = self.client.get(reverse('return_book_list'), {'sort': 'days_overdue'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('api_reader_borrowed_books', args=[self.reader.pk]))
+        book = response.json()['data'][0]
+        self.assertTrue(book['is_overdue'])
+        self.assertEqual(book['fine'], book['days_overdue'] * self.parameter.fine_rate)
+        response = self.client.get(reverse('report_overdue_books_excel'))
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BorrowEligibilityTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=1)
+        self.other_book = Book.objects.create(
+            book_title=BookTitle.objects.create(book_title='Cấu trúc dữ liệu', category=self.category),
+            quantity=2,
+            remaining_quantity=2,
+            unit_price=50000,
+            publish_year=timezone.localdate().year,
+            publisher='NXB Trẻ'
+        )
+        BookItem.objects.create(book=self.other_book, barcode='0002-001')
+
+    def test_basket_checked_in_constant_queries(self):
+        from .services import check_borrow_eligibility
+
+        self.borrow(self.items[0], days_ago=1)
+        Parameter.get_current()
+        with self.assertNumQueries(2):
+            result = check_borrow_eligibility(self.reader.pk, [self.book.pk, self.other_book.pk, 999])
+        self.assertFalse(result['eligible'])
+        self.assertEqual(result['reader_errors'], [])
+        self.assertEqual(result['current_borrowed'], 1)
+        rows = {row['book_id']: row for row in result['books']}
+        self.assertFalse(rows[self.book.pk]['ok'])
+        self.assertTrue(rows[self.other_book.pk]['ok'])
+        self.assertEqual(rows[self.other_book.pk]['available_count'], 1)
+        self.assertIn('999', rows[999]['error'])
+
+    def test_precheck_api(self):
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+        url = reverse('api_borrow_precheck')
+        response = self.client.get(url, {'reader_id': self.reader.pk, 'book_ids': f'{self.other_book.pk}'})
+        self.assertTrue(response.json()['data']['eligible'])
+        # 2 cuốn cùng đầu sách nhưng chỉ còn 1 cuốn
+        response = self.client.get(url, {'reader_id': self.reader.pk, 'book_ids': f'{self.other_book.pk},{self.other_book.pk}'})
+        data = response.json()['data']
+        self.assertFalse(data['eligible'])
+        self.assertEqual(len(data['errors']), 1)
+
+    def test_allocator_hands_out_distinct_free_copies(self):
+        from django.db import transaction
+        from .services import allocate_book_items
+
+        BookItem.objects.create(book=self.other_book, barcode='0002-002')
+        with transaction.atomic():
+            first = allocate_book_items(self.other_book.pk)
+            second = allocate_book_items(self.other_book.pk, count=5)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first[0].pk, second[0].pk)
+        self.assertFalse(BookItem.objects.filter(book=self.other_book, is_borrowed=False).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BulkReturnTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=4)
+
+    def return_items(self, items):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .services import return_books
+
+        with CaptureQueriesContext(connection) as ctx:
+            returned = return_books(self.reader.pk, [item.pk for item in items], timezone.now())
+        return returned, len(ctx.captured_queries)
+
+    def test_fines_and_counters_in_constant_queries(self):
+        receipts = [self.borrow(item, days_ago=days) for item, days in zip(self.items, [10, 7, 1, 0])]
+        expected_fine = sum(r.calculate_fine() for r in receipts[1:])
+        Parameter.get_current()
+
+        _, single_queries = self.return_items(self.items[:1])
+        returned, batch_queries = self.return_items(self.items[1:])
+        self.assertEqual(len(returned), 3)
+        self.assertEqual(single_queries, batch_queries)
+
+        self.book.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertEqual(self.book.remaining_quantity, 4)
+        self.assertFalse(BookItem.objects.filter(is_borrowed=True).exists())
+        self.assertEqual(
+            self.reader.total_debt,
+            receipts[0].calculate_fine() + expected_fine
+        )
+        summary = ReaderCirculationSummary.objects.get(pk=self.reader.pk)
+        self.assertEqual(summary.open_loan_count, 0)
+        self.assertEqual(summary.accrued_debt, self.reader.total_debt)
+        for receipt in BorrowReturnReceipt.objects.all():
+            self.assertEqual(receipt.fine_amount, receipt.calculate_fine())
+            self.assertGreaterEqual(receipt.updated_at, receipt.return_date)
+
+    def test_return_before_borrow_date_rejected(self):
+        from django.core.exceptions import ValidationError
+        from .services import return_books
+
+        self.borrow(self.items[0], days_ago=0)
+        with self.assertRaises(ValidationError):
+            return_books(self.reader.pk, [self.items[0].pk], timezone.now() - timedelta(days=1))
+        self.assertTrue(BookItem.objects.get(pk=self.items[0].pk).is_borrowed)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BarcodeScanTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=3)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def post_json(self, name, payload):
+        import json
+        return self.client.post(reverse(name), json.dumps(payload), content_type='application/json')
+
+    def test_batch_checkout_and_checkin(self):
+        response = self.post_json('api_scan_checkout', {
+            'reader_id': self.reader.pk,
+            'barcodes': ['0001-001', '0001-002'],
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(BorrowReturnReceipt.objects.filter(return_date__isnull=True).count(), 2)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.remaining_quantity, 1)
+        self.assertEqual(ReaderCirculationSummary.objects.get(pk=self.reader.pk).open_loan_count, 2)
+
+        # Cuốn đang mượn không thể mượn lại, không ghi gì cả
+        response = self.post_json('api_scan_checkout', {
+            'reader_id': self.reader.pk,
+            'barcodes': ['0001-002', '0001-003'],
+        })
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(BookItem.objects.get(barcode='0001-003').is_borrowed)
+
+        response = self.client.get(reverse('api_scan_lookup'), {'barcode': '0001-001'})
+        self.assertEqual(response.json()['data']['reader_id'], self.reader.pk)
+
+        # Mã vạch quét trùng trong 1 lô -> báo lỗi, chỉ trả 1 lần
+        response = self.post_json('api_scan_checkin', {'barcodes': ['0001-001', '0001-002', 'missing', '0001-001']})
+        items = response.json()['data']['items']
+        self.assertEqual([item['ok'] for item in items], [True, True, False, False])
+        self.assertIn('quét trùng', items[3]['error'])
+        self.assertNotIn('receipt_id', items[3])
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.remaining_quantity, 3)
+
+    def test_malformed_payload_rejected(self):
+        for payload in [{'barcodes': '0001-001'}, [], 'x']:
+            response = self.post_json('api_scan_checkin', payload)
+            self.assertEqual(response.status_code, 400, payload)
+        self.assertFalse(BorrowReturnReceipt.objects.exists())
+
+    def test_resolve_barcodes_single_query(self):
+        from .services import resolve_barcodes
+
+        self.borrow(self.items[0], days_ago=1)
+        with self.assertNumQueries(1):
+            resolved = resolve_barcodes(['0001-001', '0001-002'])
+        self.assertEqual(resolved['0001-001']['reader_id'], self.reader.pk)
+        self.assertIsNone(resolved['0001-002']['receipt_id'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BorrowingReadersApiTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=6)
+        self.readers = [self.reader] + [
+            Reader.objects.create(
+                reader_name=f'Độc giả {i}',
+                reader_type=self.reader_type,
+                date_of_birth='2000-01-01',
+                address='TP.HCM',
+                email=f'reader{i}@example.com'
+            )
+            for i in range(1, 5)
+        ]
+        for i, reader in enumerate(self.readers):
+            self.reader = reader
+            self.borrow(self.items[i], days_ago=i)
+        # Phiếu đã hủy không được tính
+        cancelled = self.borrow(self.items[5], days_ago=0)
+        BorrowReturnReceipt.objects.filter(pk=cancelled.pk).update(is_cancelled=True)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def fetch_all(self, limit):
+        url = reverse('api_borrowing_readers')
+        seen, cursor, pages = [], None, 0
+        while True:
+            params = {'limit': limit}
+            if cursor:
+                params['cursor'] = cursor
+            body = self.client.get(url, params).json()
+            seen.extend(body['data'])
+            pages += 1
+            cursor = body['next_cursor']
+            if not cursor:
+                return seen, pages
+
+    def test_keyset_pages_cover_all_readers(self):
+        readers, pages = self.fetch_all(limit=2)
+        self.assertEqual(pages, 3)
+        self.assertEqual(
+            sorted(r['reader_id'] for r in readers),
+            sorted(r.pk for r in self.readers)
+        )
+        self.assertEqual(sum(len(r['books']) for r in readers), 5)
+
+    def test_constant_query_count(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        url = reverse('api_borrowing_readers')
+        self.client.get(url)  # nạp session, user, cache quyền
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url, {'limit': 1})
+        few = len(ctx.captured_queries)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+        self.assertEqual(len(ctx.captured_queries), few)
+        endpoint_queries = [q for q in ctx.captured_queries if 'borrow_return_receipt' in q['sql']]
+        self.assertEqual(len(endpoint_queries), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CursorPaginatorTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=5)
+        # Cùng ngày mượn cho 2 phiếu -> thứ tự phụ thuộc id
+        self.receipts = [self.borrow(item, days_ago=days) for item, days in zip(self.items, [1, 2, 2, 3, 4])]
+
+    def test_walk_forward_and_back_without_count(self):
+        from .pagination import CursorPaginator
+
+        queryset = BorrowReturnReceipt.objects.all()
+        expected = [r.pk for r in sorted(self.receipts, key=lambda r: (r.borrow_date, r.pk), reverse=True)]
+        paginator = CursorPaginator(queryset, ('-borrow_date', '-id'), (datetime, int), per_page=2, count_limit=3)
+
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(after=pages[-1].next_cursor))
+        self.assertEqual([r.pk for page in pages for r in page], expected)
+        self.assertFalse(pages[0].has_previous())
+
+        back = paginator.get_page(before=pages[-1].previous_cursor)
+        self.assertEqual([r.pk for r in back], expected[2:4])
+        back = paginator.get_page(before=back.previous_cursor)
+        self.assertEqual([r.pk for r in back], expected[:2])
+        self.assertFalse(back.has_previous())
+
+        # Tổng số có chặn trên
+        self.assertEqual((paginator.count, paginator.count_capped), (3, True))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UnreturnedReceiptsApiTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=5)
+        self.receipts = [self.borrow(item, days_ago=i % 2) for i, item in enumerate(self.items)]
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def get_page(self, **params):
+        import json
+        response = self.client.get(reverse('api_unreturned_receipts'), params)
+        self.assertTrue(response.streaming)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_keyset_pages(self):
+        ids, cursor = [], None
+        for _ in range(3):
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            body = self.get_page(**params)
+            ids.extend(item['id'] for item in body['data'])
+            cursor = body['next_cursor']
+        self.assertIsNone(cursor)
+        expected = sorted(self.receipts, key=lambda r: (r.borrow_date, r.id), reverse=True)
+        self.assertEqual(ids, [r.id for r in expected])
+
+    def test_search(self):
+        body = self.get_page(search='Python', limit=10)
+        self.assertEqual(len(body['data']), 5)
+        self.assertIsNone(body['next_cursor'])
+        self.assertEqual(self.get_page(search='không có')['data'], [])
+
+
+@override_settings(RATELIMIT_ENABLE=False, CACHES=LOCMEM_CACHES)
+class IdempotencyKeyTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=3)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def test_duplicate_borrow_submission_replayed(self):
+        from .models import IdempotencyKey
+
+        data = {
+            'reader_id': self.reader.pk,
+            'book_id': str(self.book.pk),
+            'borrow_date': timezone.localtime().strftime('%Y-%m-%dT%H:%M'),
+            'idempotency_key': 'abc123',
+        }
+        first = self.client.post(reverse('borrow_book'), data)
+        second = self.client.post(reverse('borrow_book'), data)
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(BorrowReturnReceipt.objects.count(), 1)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.remaining_quantity, 2)
+        record = IdempotencyKey.objects.get(key='abc123')
+        self.assertTrue(record.is_completed)
+        self.assertEqual(len(record.messages), 1)
+        self.assertIn('Cho mượn thành công', record.messages[0]['message'])
+
+        # Khóa mới -> xử lý bình thường
+        data['idempotency_key'] = 'def456'
+        self.client.post(reverse('borrow_book'), data)
+        self.assertEqual(BorrowReturnReceipt.objects.count(), 2)
+
+    def test_invalid_form_releases_key(self):
+        from .models import IdempotencyKey
+
+        self.client.post(reverse('borrow_book'), {'reader_id': self.reader.pk, 'idempotency_key': 'k1'})
+        self.assertFalse(IdempotencyKey.objects.filter(key='k1').exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchKeyTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_circulation_data(copies=1)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def test_search_key_maintained_and_used(self):
+        from .search import fold_text
+
+        self.assertEqual(fold_text('  Đắc  Nhân TÂM '), 'dac nhan tam')
+        self.assertEqual(self.reader.search_key, 'nguyen van a')
+        self.assertEqual(BookTitle.objects.get(pk=self.book_title.pk).search_key, 'lap trinh python')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reader.reader_name = 'Trần Thị Đào'
+            self.reader.save(update_fields=['reader_name'])
+        self.assertEqual(Reader.objects.get(pk=self.reader.pk).search_key, 'tran thi dao')
+
+        response = self.client.get(reverse('api_readers'), {'search': 'thi dao'})
+        self.assertEqual([row['id'] for row in response.json()['data']], [self.reader.pk])
+
+    def test_backfill_command(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        Category.objects.filter(pk=self.category.pk).update(search_key='')
+        call_command('backfill_search_keys', batch_size=1, stdout=StringIO())
+        self.assertEqual(Category.objects.get(pk=self.category.pk).search_key, 'tin hoc')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AutocompleteTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_circulation_data(copies=1)
+        self.other = Reader.objects.create(
+            reader_name='Trần Văn Nguyên', reader_type=self.reader_type,
+            date_of_birth='2000-01-01', address='TP.HCM', email='tran@example.com'
+        )
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def suggest_ids(self, search):
+        response = self.client.get(reverse('api_readers'), {'search': search})
+        return [row['id'] for row in response.json()['data']]
+
+    def test_reader_suggestions_ranked(self):
+        # Tiền tố cả tên xếp trước tiền tố từ
+        self.assertEqual(self.suggest_ids('nguy'), [self.reader.pk, self.other.pk])
+        # Tiền tố từng từ, không phụ thuộc thứ tự từ
+        self.assertEqual(self.suggest_ids('a van'), [self.reader.pk])
+        self.assertEqual(self.suggest_ids('tran@'), [self.other.pk])
+        # Chuỗi con (trigram)
+        self.assertEqual(self.suggest_ids('an nguy'), [self.other.pk])
+
+        # Đổi tên / vô hiệu hóa -> chỉ mục, bộ lọc và gợi ý đã cache cập nhật
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.reader_name = 'Lê Thị Hoa'
+            self.other.save()
+        self.assertEqual(self.suggest_ids('nguy'), [self.reader.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reader.is_active = False
+            self.reader.save()
+        self.assertEqual(self.suggest_ids('nguy'), [])
+
+    def test_inactive_readers_do_not_use_up_candidates(self):
+        from .autocomplete import suggest
+        from .models import AutocompleteToken
+
+        # Độc giả ngừng hoạt động đứng trước trên index, chiếm hết trang ứng viên đầu
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(12):
+                Reader.objects.create(
+                    reader_name=f'Ngà {i:02d}', reader_type=self.reader_type, is_active=False,
+                    date_of_birth='2000-01-01', address='TP.HCM', email=f'a{i}@example.com'
+                )
+        readers = Reader.objects.filter(is_active=True)
+        results = suggest(AutocompleteToken.KIND_READER, 'ng', readers, limit=2)
+        self.assertEqual([reader.pk for reader in results], [self.reader.pk, self.other.pk])
+
+    def test_book_suggestions_skip_unavailable(self):
+        from .services import record_checkout
+
+        response = self.client.get(reverse('api_books'), {'search': 'python'})
+        self.assertEqual([row['id'] for row in response.json()['data']], [self.book.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            record_checkout(self.items[0])
+        response = self.client.get(reverse('api_books'), {'search': 'python'})
+        self.assertEqual(response.json()['data'], [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BookSearchIndexTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        from .search import get_backend
+
+        if get_backend() is None:
+            self.skipTest('Database không hỗ trợ chỉ mục toàn văn')
+        cache.clear()
+        self.create_circulation_data(copies=1)
+        from .models import Author, AuthorDetail
+        self.author = Author.objects.create(author_name='Guido van Rossum')
+        AuthorDetail.objects.create(author=self.author, book_title=self.book_title)
+        other_title = BookTitle.objects.create(book_title='Cấu trúc dữ liệu', category=self.category)
+        self.other = Book.objects.create(
+            book_title=other_title, quantity=1, remaining_quantity=1, unit_price=50000,
+            publish_year=2020, publisher='NXB Python Việt Nam'
+        )
+
+    def test_signals_keep_index_in_sync_and_rank(self):
+        from .search import search_book_ids
+
+        # Bỏ dấu, tìm theo tiền tố; tên sách xếp trên nhà xuất bản
+        self.assertEqual(search_book_ids('lap trinh'), [self.book.pk])
+        self.assertEqual(search_book_ids('pyth'), [self.book.pk, self.other.pk])
+        self.assertEqual(search_book_ids('guido'), [self.book.pk])
+
+        self.author.author_name = 'Rossum'
+        self.author.save()
+        self.assertEqual(search_book_ids('guido'), [])
+
+        self.category.category_name = 'Khoa học máy tính'
+        self.category.save()
+        self.assertEqual(search_book_ids('may tinh'), [self.book.pk, self.other.pk])
+
+        self.other.delete()
+        self.assertEqual(search_book_ids('cau truc'), [])
+
+    def test_search_views_use_index(self):
+        response = self.client.get(reverse('book_search'), {'search_text': 'python'})
+        self.assertEqual([book.pk for book in response.context['books']], [self.book.pk, self.other.pk])
+        self.assertEqual(response.context['total_results'], 2)
+
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('api_books'), {'search': 'rossum'})
+        self.assertEqual([row['id'] for row in response.json()['data']], [self.book.pk])
+
+    def test_filters_applied_inside_index_query(self):
+        from .search import filter_books
+
+        # Sách xếp hạng thấp hơn vẫn có khi lọc theo tình trạng (lọc trong truy vấn chỉ mục)
+        Book.objects.filter(pk=self.book.pk).update(remaining_quantity=0)
+        books, ranked_ids = filter_books('python', status='available')
+        self.assertEqual(ranked_ids, [self.other.pk])
+        self.assertEqual(list(books.values_list('id', flat=True)), [self.other.pk])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BorrowByCategoryReportTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=3)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+        # Tháng trước (đã kết thúc)
+        first_of_month = timezone.localdate().replace(day=1)
+        self.last_month = (first_of_month - timedelta(days=1)).replace(day=15)
+        borrow_date = timezone.make_aware(datetime.combine(self.last_month, datetime.min.time()))
+        for item in self.items[:2]:
+            BorrowReturnReceipt.objects.create(
+                reader=self.reader, book_item=item, borrow_date=borrow_date, due_date=borrow_date + timedelta(days=4)
+            )
+
+    def report(self):
+        response = self.client.get(
+            reverse('report_borrow_by_category'), {'month': self.last_month.month, 'year': self.last_month.year}
+        )
+        return [(row['category_name'], row['borrow_count']) for row in response.context['report_data']]
+
+    def test_closed_month_snapshot(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import ReportDetailByCategory
+
+        self.assertEqual(self.report(), [('Tin học', 2)])
+        snapshot = ReportDetailByCategory.objects.get(month=self.last_month.month, year=self.last_month.year)
+        self.assertEqual(snapshot.total_borrow_count, 2)
+        self.assertEqual(snapshot.borrow_details.get().rate, 100)
+
+        # Đọc lại từ bản lưu: không cộng lại bảng tổng hợp theo ngày
+        DailyCirculationRollup.objects.all().delete()
+        self.assertEqual(self.report(), [('Tin học', 2)])
+
+        # Xem tháng khi bảng tổng hợp chưa backfill -> bản lưu rỗng; backfill xóa bản lưu, lần xem sau tính lại
+        ReportDetailByCategory.objects.all().delete()
+        self.assertEqual(self.report(), [])
+        call_command('backfill_circulation_rollup', stdout=StringIO())
+        self.assertFalse(ReportDetailByCategory.objects.exists())
+        self.assertEqual(self.report(), [('Tin học', 2)])
+
+        # Phiếu mượn mới trong tháng đã kết thúc -> tính lại
+        self.borrow(self.items[2], days_ago=(timezone.localdate() - self.last_month).days)
+        self.assertFalse(ReportDetailByCategory.objects.exists())
+        self.assertEqual(self.report(), [('Tin học', 3)])
+
+        response = self.client.get(
+            reverse('report_borrow_by_category_excel'), {'month': self.last_month.month, 'year': self.last_month.year}
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DailyCirculationRollupTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        self.create_circulation_data(copies=3)
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.force_login(admin)
+
+    def rollup_rows(self):
+        rows = {}
+        for model in (DailyCirculationRollup, DailyPaymentRollup):
+            for row in model.objects.values(*model.KEY_FIELDS, *model.MEASURES):
+                key = (model, *(row.pop(field) for field in model.KEY_FIELDS))
+                if any(row.values()):
+                    rows[key] = row
+        return rows
+
+    def rebuild(self):
+        DailyCirculationRollup.rebuild_all()
+        DailyPaymentRollup.rebuild_all()
+
+    def test_incremental_rollup_matches_backfill(self):
+        from .services import return_books, scan_checkout
+
+        late = self.borrow(self.items[0], days_ago=10)
+        self.borrow(self.items[1], days_ago=2)
+        late.return_date = timezone.now()
+        late.save()
+        return_books(self.reader.pk, [self.items[1].pk], timezone.now())
+        # Hoàn tác trả
+        undone = BorrowReturnReceipt.objects.get(book_item=self.items[1])
+        undone.return_date = None
+        undone.save(update_fields=['return_date'])
+        scan_checkout(self.reader.pk, [self.items[2].barcode])
+
+        self.reader.refresh_from_db()
+        kept = Receipt.objects.create(reader=self.reader, collected_amount=1000)
+        cancelled = Receipt.objects.create(reader=self.reader, collected_amount=500)
+        cancelled.is_cancelled = True
+        cancelled.save()
+
+        incremental = self.rollup_rows()
+        self.rebuild()
+        self.assertEqual(incremental, self.rollup_rows())
+
+        today = timezone.localdate()
+        returned = DailyCirculationRollup.objects.get(date=today, book_title=self.book_title)
+        self.assertEqual((returned.return_count, returned.late_count), (1, 1))
+        self.assertEqual(returned.late_days, late.days_overdue)
+        self.assertEqual(
+            DailyPaymentRollup.objects.get(date=today).collected_amount,
+            kept.collected_amount
+        )
+
+        # Xóa phiếu -> trừ khỏi bảng
+        kept.delete()
+        BorrowReturnReceipt.objects.filter(pk=late.pk).delete()
+        incremental = self.rollup_rows()
+        self.rebuild()
+        self.assertEqual(incremental, self.rollup_rows())
+
+    def test_reports_read_rollup(self):
+        for item in self.items:
+            self.borrow(item, days_ago=3)
+        response = self.client.get(reverse('report_borrow_situation'))
+        row, = response.context['report_data']
+        self.assertEqual(
+            (row['category_name'], row['borrow_count'], row['book_count'], row['reader_count'], row['top_book_count']),
+            ('Tin học', 3, 1, 1, 3)
+        )
+
+        from .services import adjust_reader_debt
+
+        adjust_reader_debt(self.reader.pk, 3000)
+        self.reader.refresh_from_db()
+        Receipt.objects.create(reader=self.reader, collected_amount=2000)
+        response = self.client.get(reverse('report_fine_collection'))
+        self.assertEqual(response.context['total_collected'], 2000)
+        self.assertEqual(len(response.context['report_data']), 1)
+
+        # Phiếu thu đầu ngày đầu tiên của khoảng mặc định (30 ngày trước, giữa ngày):
+        # danh sách, tổng tiền và file Excel cùng làm tròn theo ngày
+        first_day = timezone.localdate() - timedelta(days=30)
+        Receipt.objects.create(
+            reader=self.reader, collected_amount=1000,
+            created_date=timezone.make_aware(datetime.combine(first_day, datetime.min.time())),
+        )
+        response = self.client.get(reverse('report_fine_collection'))
+        rows = response.context['report_data']
+        self.assertEqual(response.context['total_collected'], 3000)
+        self.assertEqual(sum(row['collected_amount'] for row in rows), 3000)
+        self.assertEqual(response.context['avg_per_receipt'], 1500)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchResultCacheTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_circulation_data(copies=1)
+
+    def search_ids(self, **params):
+        response = self.client.get(reverse('book_search'), params)
+        return [book.pk for book in response.context['books']], response.context['total_results']
+
+    def test_results_cached_until_inventory_changes(self):
+        from .services import record_checkout
+
+        self.assertEqual(self.search_ids(status='available'), ([self.book.pk], 1))
+        # Lần sau (thứ tự tham số khác, chuỗi rỗng) dùng kết quả đã cache
+        BookTitle.objects.filter(pk=self.book_title.pk).update(book_title='Không đổi cache')
+        self.assertEqual(self.search_ids(search_text='', status='available'), ([self.book.pk], 1))
+
+        # Mượn cuốn duy nhất -> version tăng sau commit -> tính lại
+        with self.captureOnCommitCallbacks(execute=True):
+            record_checkout(self.items[0])
+        self.assertEqual(self.search_ids(status='available'), ([], 0))
+        self.assertEqual(self.search_ids(status='unavailable'), ([self.book.pk], 1))
+
+    def test_facets_count_current_results(self):
+        from .models import Author, AuthorDetail
+
+        author = Author.objects.create(author_name='Guido van Rossum')
+        AuthorDetail.objects.create(author=author, book_title=self.book_title)
+        other_title = BookTitle.objects.create(book_title='Văn học', category=Category.objects.create(category_name='Văn'))
+        Book.objects.create(
+            book_title=other_title, quantity=1, remaining_quantity=0, unit_price=1, publish_year=2020, publisher='NXB'
+        )
+
+        response = self.client.get(reverse('book_search'))
+        facets = lambda name: [(row['name'], row['count']) for row in response.context[name]]
+        self.assertEqual(facets('category_facets'), [('Tin học', 1), ('Văn', 1)])
+        self.assertEqual(facets('author_facets'), [('Guido van Rossum', 1)])
+        self.assertEqual(facets('status_facets'), [('Còn sách', 1), ('Hết sách', 1)])
+
+        # Thu hẹp theo thể loại: facet tính trên kết quả mới
+        response = self.client.get(reverse('book_search'), {'category': self.category.pk})
+        self.assertEqual(facets('status_facets'), [('Còn sách', 1), ('Hết sách', 0)])
+        self.assertTrue(response.context['category_facets'][0]['active'])
+
+
+@override_settings(
+    CATALOG_SEARCH_ENGINE='memory',
+    CACHES=LOCMEM_CACHES
+)
+class MemoryCatalogEngineTest(CirculationDataMixin, TestCase):
+    def setUp(self):
+        from unittest import mock
+        from . import catalog_engine
+        from .models import Author, AuthorDetail
+
+        cache.clear()
+        self.index = catalog_engine.CatalogIndex()
+        patcher = mock.patch.object(catalog_engine, '_catalog_index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.create_circulation_data(copies=1)
+        self.author = Author.objects.create(author_name='Guido van Rossum')
+        AuthorDetail.objects.create(author=self.author, book_title=self.book_title)
+        other_title = BookTitle.objects.create(book_title='Python cho người mới', category=self.category)
+        self.other = Book.objects.create(
+            book_title=other_title, quantity=1, remaining_quantity=1, unit_price=50000,
+            publish_year=2020, publisher='NXB Trẻ'
+        )
+
+    def search(self, **params):
+        self.index.checked_at = 0
+        response = self.client.get(reverse('book_search'), params)
+        return [book.pk for book in response.context['books']]
+
+    def test_search_filters_and_refresh(self):
+        from .services import record_checkout
+
+        # Khớp tên sách xếp trước khớp tác giả / NXB, sau đó theo tên sách
+        self.assertEqual(self.search(search_text='python'), [self.book.pk, self.other.pk])
+        self.assertEqual(self.search(search_text='rossum'), [self.book.pk])
+        self.assertEqual(self.search(author=self.author.pk), [self.book.pk])
+        self.assertEqual(self.search(category=self.category.pk, search_text='nguoi moi'), [self.other.pk])
+        response = self.client.get(reverse('book_search'), {'search_text': 'python'})
+        self.assertEqual([(row['name'], row['count']) for row in response.context['author_facets']], [('Guido van Rossum', 1)])
+        self.assertEqual([row['count'] for row in response.context['status_facets']], [2, 0])
+
+        # Mượn cuốn duy nhất (UPDATE trực tiếp, không signal) -> cập nhật theo watermark
+        record_checkout(self.items[0])
+        self.assertEqual(self.search(status='available'), [self.other.pk])
+        self.assertEqual(self.search(status='unavailable'), [self.book.pk])
+
+        # Đổi tên tác giả -> updated_at của sách liên quan -> cập nhật theo watermark, không xây lại
+        from unittest import mock
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.author_name = 'Tác giả khác'
+            self.author.save()
+        with mock.patch.object(self.index, 'rebuild', side_effect=AssertionError('full rebuild')):
+            self.assertEqual(self.search(search_text='rossum'), [])
+            self.assertEqual(self.search(search_text='tac gia'), [self.book.pk])
+
+        # Xóa sách -> version danh mục tăng -> xây lại
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.delete()
+        self.assertEqual(self.search(search_text='python'), [self.book.pk])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class InventoryCounterTest(CirculationDataMixin, TransactionTestCase):
+    """Mượn/trả đồng thời từ nhiều luồng không được mất cập nhật bộ đếm"""
+    THREADS = 4
+    ROUNDS = 5
+
+    def setUp(self):
+        self.create_circulation_data(copies=self.THREADS)
+
+    def run_with_retry(self, func):
+        """SQLite khóa cả database khi ghi -> thử lại khi bị khóa"""
+        import time
+        from django.db import OperationalError
+        for _ in range(200):
+            try:
+                return func()
+            except OperationalError:
+                time.sleep(0.005)
+        raise AssertionError('Database stayed locked')
+
+    def test_concurrent_borrow_return_keeps_counters(self):
+        import threading
+        from django.db import connection, transaction
+        from .services import allocate_book_items
+
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('Cần database test dạng file hoặc PostgreSQL để chạy nhiều kết nối')
+
+        fine_per_return = 2000
+        errors = []
+
+        def borrow():
+            with transaction.atomic():
+                item = allocate_book_items(self.book.pk)[0]
+                return self.borrow(item, days_ago=0)
+
+        def give_back(receipt):
+            with transaction.atomic():
+                receipt = BorrowReturnReceipt.objects.get(pk=receipt.pk)
+                receipt.return_date = timezone.now()
+                receipt.save()
+                from .services import adjust_reader_debt
+                adjust_reader_debt(receipt.reader_id, fine_per_return)
+
+        def worker():
+            try:
+                for _ in range(self.ROUNDS):
+                    receipt = self.run_with_retry(borrow)
+                    self.run_with_retry(lambda: give_back(receipt))
+            except Exception as e:  # noqa: BLE001 - báo lỗi về luồng chính
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.book.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertEqual(self.book.remaining_quantity, self.THREADS)
+        self.assertFalse(BookItem.objects.filter(is_borrowed=True).exists())
+        self.assertEqual(self.reader.total_debt, self.THREADS * self.ROUNDS * fine_per_return)
+        self.assertEqual(ReaderCirculationSummary.objects.get(pk=self.reader.pk).accrued_debt, self.reader.total_debt)
+
+    def test_check_constraint_rejects_negative_stock(self):
+        from django.db import IntegrityError, transaction
+        from .services import adjust_remaining_quantity, adjust_reader_debt
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            adjust_remaining_quantity(self.book.pk, -(self.THREADS + 1))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            adjust_reader_debt(self.reader.pk, -1)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.remaining_quantity, self.THREADS)
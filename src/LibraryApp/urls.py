@@ -64,6 +64,12 @@ urlpatterns = [
     path('api/readers/', views.api_readers_list, name='api_readers'),
     path('api/books/', views.api_books_list, name='api_books'),
     path('api/borrowing-readers/', views.api_borrowing_readers, name='api_borrowing_readers'),
+    path('api/borrow/precheck/', views.api_borrow_precheck, name='api_borrow_precheck'),
+    
+    # API quét mã vạch (mượn/trả nhanh tại quầy)
+    path('api/scan/', views.api_scan_lookup, name='api_scan_lookup'),
+    path('api/scan/checkout/', views.api_scan_checkout, name='api_scan_checkout'),
+    path('api/scan/checkin/', views.api_scan_checkin, name='api_scan_checkin'),
     
     # API endpoints for return book
     path('api/unreturned-receipts/', views.api_unreturned_receipts, name='api_unreturned_receipts'),
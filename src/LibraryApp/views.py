@@ -12,9 +12,14 @@ from django.db.models import Count, Q
 from django.conf import settings as django_settings
 from datetime import datetime, timedelta
 from django_ratelimit.decorators import ratelimit
-from .models import BankAccount, Reader, ReaderType, Parameter, BookTitle, Author, BookImportReceipt, BookImportDetail, Book, AuthorDetail, BookItem, BorrowReturnReceipt, Receipt, Category, UserGroup, Function, Permission
+from .models import BankAccount, Reader, ReaderType, Parameter, BookTitle, Author, BookImportReceipt, BookImportDetail, Book, AuthorDetail, BookItem, BorrowReturnReceipt, Receipt, Category, UserGroup, Function, Permission, ReaderCirculationSummary
 from .forms import ReaderForm, LibraryLoginForm, BookImportForm, BookImportExcelForm, BookSearchForm, BorrowBookForm, ReturnBookForm, ReceiptForm, ParameterForm, BookEditForm, ReaderTypeForm, UserGroupForm, FunctionForm
-from .decorators import manager_required, staff_required, permission_required
+from .decorators import manager_required, staff_required, permission_required, idempotent, new_idempotency_key
+from .search import fold_text
+from .caching import get_search_results
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def home_view(request):
@@ -348,7 +353,7 @@ def reader_create_view(request):
         return render(request, 'errors/429.html', status=429)
     
     # Kiểm tra hệ thống đã được cấu hình chưa
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     if not params:
         messages.error(request, 'Hệ thống chưa được cấu hình. Vui lòng liên hệ quản trị viên.')
         return redirect('home')
@@ -397,7 +402,7 @@ def reader_edit_view(request, reader_id):
     - Ngày lập thẻ (sẽ tự động tính lại ngày hết hạn)
     """
     reader = get_object_or_404(Reader, id=reader_id)
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     
     if not params:
         messages.error(request, 'Hệ thống chưa được cấu hình. Vui lòng liên hệ quản trị viên.')
@@ -439,7 +444,7 @@ def reader_detail_view(request, reader_id):
     """
     Xem chi tiết thẻ độc giả - Hiển thị thông tin sau khi lập thẻ
     """
-    reader = get_object_or_404(Reader, id=reader_id)
+    reader = get_object_or_404(Reader.objects.with_pending_debt(), id=reader_id)
     
     # Check permissions for actions
     from .decorators import check_permission
@@ -474,9 +479,8 @@ def reader_list_view(request):
     search_query = request.GET.get('search')
     if search_query:
         readers = readers.filter(
-            reader_name__icontains=search_query
-        ) | readers.filter(
-            email__icontains=search_query
+            Q(search_key__contains=fold_text(search_query)) |
+            Q(email__icontains=search_query)
         )
     
     context = {
@@ -503,10 +507,7 @@ def reader_delete_view(request, reader_id):
     if request.method == 'POST':
         try:
             # Kiểm tra sách đang mượn
-            borrowing_count = BorrowReturnReceipt.objects.filter(
-                reader=reader,
-                return_date__isnull=True
-            ).count()
+            borrowing_count = ReaderCirculationSummary.for_reader(reader.id).open_loan_count
             
             if borrowing_count > 0:
                 messages.error(
@@ -607,7 +608,7 @@ def book_import_view(request):
         return render(request, 'errors/429.html', status=429)
     
     # Kiểm tra hệ thống đã được cấu hình chưa
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     if not params:
         messages.error(request, 'Hệ thống chưa được cấu hình. Vui lòng liên hệ quản trị viên.')
         return redirect('home')
@@ -1142,7 +1143,7 @@ def book_import_cancel_view(request, import_id):
         return redirect('book_import_detail', import_id=receipt.id)
     
     # Kiểm tra thời hạn hủy (sử dụng tham số từ CSDL)
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     cancellation_hours = params.cancellation_time_limit if params else 24
     
     time_since_import = timezone.now() - receipt.import_date
@@ -1194,6 +1195,7 @@ def book_import_cancel_view(request, import_id):
         
         try:
             from django.db import transaction
+            from .services import add_stock
             
             with transaction.atomic():
                 # Track số liệu để báo cáo
@@ -1227,16 +1229,8 @@ def book_import_cancel_view(request, import_id):
                     BookItem.objects.filter(id__in=items_to_delete_ids).delete()
                     deleted_items_count += items_deleted
                     
-                    # Cập nhật số lượng Book
-                    new_quantity = max(0, book.quantity - quantity_to_remove)
-                    new_remaining = max(0, book.remaining_quantity - quantity_to_remove)
-                    
-                    # Sử dụng update() để bypass model validation
-                    # (vì quantity có MinValueValidator(1) nhưng khi hủy phiếu có thể về 0)
-                    Book.objects.filter(pk=book.pk).update(
-                        quantity=new_quantity,
-                        remaining_quantity=new_remaining
-                    )
+                    # Bớt tổng số lượng và số lượng còn lại (UPDATE nguyên tử, cuốn bị xóa đều đang rảnh)
+                    add_stock(book.pk, -quantity_to_remove)
                     updated_books.append(f"{book.book_title.book_title} (-{quantity_to_remove} cuốn)")
                 
                 # Đánh dấu phiếu đã hủy với audit trail
@@ -1400,51 +1394,85 @@ def book_search_view(request):
     Tra cứu sách - YC3
     Chức năng công khai - ai cũng có thể tra cứu
     """
-    from django.db.models import Q
+    from django.core.paginator import Paginator
+    from .caching import get_search_facets
+    from .facets import database_facets, memory_facets
+    from .search import filter_books
     
     form = BookSearchForm(request.GET)
-    books = Book.objects.all().select_related('book_title', 'book_title__category').prefetch_related('book_title__authors')
-    
-    if form.is_valid():
-        # Tìm kiếm theo tên sách hoặc mã sách
-        search_text = form.cleaned_data.get('search_text')
-        if search_text:
-            books = books.filter(
-                Q(book_title__book_title__icontains=search_text) |
-                Q(id__icontains=search_text)
-            )
-        
-        # Lọc theo thể loại
-        category = form.cleaned_data.get('category')
-        if category:
-            books = books.filter(book_title__category=category)
-        
-        # Lọc theo tác giả
-        author = form.cleaned_data.get('author')
-        if author:
-            books = books.filter(book_title__authors=author)
-        
-        # Lọc theo tình trạng
-        status = form.cleaned_data.get('status')
-        if status == 'available':
-            books = books.filter(remaining_quantity__gt=0)
-        elif status == 'unavailable':
-            books = books.filter(remaining_quantity=0)
-    
-    # Sắp xếp theo tên sách
-    books = books.order_by('book_title__book_title')
+    filters = form.cleaned_data if form.is_valid() else {}
+    search_text = filters.get('search_text')
+    category = filters.get('category')
+    author = filters.get('author')
+    status = filters.get('status')
+    # Bộ lọc đã chuẩn hóa: khóa cache của kết quả và facet
+    signature = {
+        'text': fold_text(search_text),
+        'category': category.pk if category else None,
+        'author': author.pk if author else None,
+        'status': status,
+    }
     
-    # Phân trang (20 cuốn/trang)
-    from django.core.paginator import Paginator
-    paginator = Paginator(books, 20)
-    page_num = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_num)
+    if getattr(django_settings, 'CATALOG_SEARCH_ENGINE', 'database') == 'memory':
+        # Chỉ mục trong bộ nhớ của worker: trả về toàn bộ id đã sắp xếp, không truy vấn database
+        from .catalog_engine import get_catalog_index
+        index = get_catalog_index()
+        matched_ids = index.search(
+            search_text,
+            category_id=category.pk if category else None,
+            author_id=author.pk if author else None,
+            status=status,
+        )
+        facets = get_search_facets('book', signature, lambda: memory_facets(index, matched_ids))
+    else:
+        def load_matched_ids():
+            books, ranked_ids = filter_books(search_text, category, author, status)
+            if ranked_ids is not None:
+                # Toàn bộ sách khớp đã lọc và xếp theo độ liên quan trong truy vấn chỉ mục
+                return ranked_ids
+            # Sắp xếp theo tên sách
+            return books.order_by('book_title__book_title').values_list('id', flat=True)
+        
+        # Cache theo bộ lọc đã chuẩn hóa + version (tồn kho / danh mục thay đổi -> version mới)
+        matched_ids, _ = get_search_results('book', signature, load_matched_ids)
+        facets = get_search_facets(
+            'book', signature,
+            lambda: database_facets(filter_books(search_text, category, author, status)[0])
+        )
     
+    # Phân trang trên danh sách id (20 cuốn/trang), chỉ nạp sách của trang hiện tại
+    paginator = Paginator(matched_ids, 20)
+    page_obj = paginator.get_page(request.GET.get('page', 1))
+    page_books = Book.objects.select_related('book_title', 'book_title__category').prefetch_related(
+        'book_title__authors'
+    ).in_bulk(page_obj.object_list)
+    page_obj.object_list = [page_books[book_id] for book_id in page_obj.object_list if book_id in page_books]
+    
+    def refine_url(name, value):
+        """Link thu hẹp kết quả: giữ bộ lọc hiện tại, thay 1 tham số, về trang 1"""
+        query = request.GET.copy()
+        query.pop('page', None)
+        query[name] = value
+        return '?' + query.urlencode()
+    
+    status_labels = {'available': 'Còn sách', 'unavailable': 'Hết sách'}
     context = {
         'form': form,
         'page_obj': page_obj,
         'books': page_obj.object_list,
         'total_results': paginator.count,
+        'category_facets': [
+            dict(row, url=refine_url('category', row['id']), active=signature['category'] == row['id'])
+            for row in facets['categories']
+        ],
+        'author_facets': [
+            dict(row, url=refine_url('author', row['id']), active=signature['author'] == row['id'])
+            for row in facets['authors']
+        ],
+        'status_facets': [
+            {'name': label, 'count': facets['status'][value], 'url': refine_url('status', value), 'active': status == value}
+            for value, label in status_labels.items()
+        ],
         'page_title': 'Tra cứu sách'
     }
     
@@ -1455,6 +1483,7 @@ def book_search_view(request):
 
 @ratelimit(key='ip', rate='20/m', method='POST', block=False)
 @permission_required('Lập phiếu mượn sách', 'add')
+@idempotent
 def borrow_book_view(request):
     """
     Cho mượn sách - YC4
@@ -1466,7 +1495,7 @@ def borrow_book_view(request):
         messages.error(request, 'Quá nhiều yêu cầu. Vui lòng thử lại sau.')
         return render(request, 'errors/429.html', status=429)
     
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     
     if request.method == 'POST':
         form = BorrowBookForm(request.POST)
@@ -1478,8 +1507,8 @@ def borrow_book_view(request):
                     borrow_date = form.cleaned_data['borrow_date']
                     books = form.cleaned_data['books']  # Dict of Book objects
                     
-                    # Lấy độc giả
-                    reader = Reader.objects.get(id=reader_id)
+                    # Độc giả đã được nạp khi kiểm tra điều kiện mượn
+                    reader = form.cleaned_data['reader']
                     
                     # Xử lý datetime từ form (đã là datetime, chỉ cần make_aware nếu cần)
                     from datetime import timedelta
@@ -1491,15 +1520,19 @@ def borrow_book_view(request):
                     due_date = borrow_datetime + timedelta(days=params.max_borrow_days)
                     
                     # Tạo phiếu mượn cho từng sách
+                    from .services import allocate_book_items
                     receipts = []
                     for book_id in book_ids:
                         book = books[book_id]
                         
-                        # Lấy cuốn sách còn sẵn (lock row to prevent race condition)
-                        book_item = BookItem.objects.select_for_update().filter(book=book, is_borrowed=False).first()
-                        if not book_item:
+                        # Cấp 1 cuốn còn sẵn (transaction đồng thời nhận cuốn khác, không chờ khóa)
+                        allocated = allocate_book_items(book.id)
+                        if not allocated:
+                            transaction.set_rollback(True)
                             messages.error(request, f'Không tìm thấy cuốn "{book.book_title.book_title}" còn sẵn.')
                             return redirect('borrow_book')
+                        book_item = allocated[0]
+                        book_item.book = book
                         
                         # Tạo phiếu mượn
                         borrow_receipt = BorrowReturnReceipt.objects.create(
@@ -1509,15 +1542,8 @@ def borrow_book_view(request):
                             due_date=due_date,
                             notes=''
                         )
+                        # Trạng thái cuốn sách và số lượng còn lại được cập nhật trong BorrowReturnReceipt.save()
                         receipts.append(borrow_receipt)
-                        
-                        # Cập nhật trạng thái cuốn sách
-                        book_item.is_borrowed = True
-                        book_item.save(update_fields=['is_borrowed'])
-                        
-                        # Cập nhật số lượng còn lại của sách
-                        book.remaining_quantity -= 1
-                        book.save(update_fields=['remaining_quantity'])
                     
                     # Thông báo thành công
                     if len(receipts) == 1:
@@ -1550,6 +1576,7 @@ def borrow_book_view(request):
     context = {
         'form': form,
         'params': params,
+        'idempotency_key': new_idempotency_key(),
         'page_title': 'Cho mượn sách'
     }
     
@@ -1601,7 +1628,7 @@ def borrow_cancel_view(request, receipt_id):
         return redirect('borrow_book_detail', receipt_id=receipt.id)
     
     # Kiểm tra thời gian: chỉ hủy trong vòng N giờ kể từ khi mượn (N từ tham số hệ thống)
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     cancellation_hours = params.cancellation_time_limit if params else 24
     
     time_since_borrow = timezone.now() - receipt.borrow_date
@@ -1621,24 +1648,21 @@ def borrow_cancel_view(request, receipt_id):
             return render(request, 'app/borrowing/borrow_cancel_confirm.html', context)
         
         try:
-            # Đánh dấu phiếu đã hủy với audit trail
-            receipt.is_cancelled = True
-            receipt.cancelled_at = timezone.now()
-            receipt.cancelled_by = request.user
-            receipt.cancel_reason = cancel_reason
-            receipt.save(update_fields=['is_cancelled', 'cancelled_at', 'cancelled_by', 'cancel_reason'])
-            
-            # Rollback: Un-borrow book
-            receipt.book_item.is_borrowed = False
-            receipt.book_item.save(update_fields=['is_borrowed'])
-            
-            receipt.book_item.book.remaining_quantity += 1
-            receipt.book_item.book.save(update_fields=['remaining_quantity'])
-            
-            # Nếu có fine, trừ khỏi reader debt
-            if receipt.fine_amount > 0:
-                receipt.reader.total_debt -= receipt.fine_amount
-                receipt.reader.save(update_fields=['total_debt'])
+            from .services import record_checkin, adjust_reader_debt
+            with transaction.atomic():
+                # Đánh dấu phiếu đã hủy với audit trail
+                receipt.is_cancelled = True
+                receipt.cancelled_at = timezone.now()
+                receipt.cancelled_by = request.user
+                receipt.cancel_reason = cancel_reason
+                receipt.save(update_fields=['is_cancelled', 'cancelled_at', 'cancelled_by', 'cancel_reason'])
+                
+                # Rollback: Un-borrow book
+                record_checkin(receipt.book_item)
+                
+                # Nếu có fine, trừ khỏi reader debt
+                if receipt.fine_amount > 0:
+                    adjust_reader_debt(receipt.reader_id, -receipt.fine_amount)
             
             messages.success(
                 request,
@@ -1667,8 +1691,17 @@ def borrow_book_list_view(request):
     from django.db.models import Q
     from django.utils import timezone
     
-    # Mặc định sort
-    receipts = BorrowReturnReceipt.objects.all().order_by('-borrow_date')
+    # Số ngày trễ / tiền phạt tính trong database
+    receipts = BorrowReturnReceipt.objects.with_overdue().select_related(
+        'reader', 'book_item__book__book_title'
+    )
+    
+    # Sắp xếp: mặc định mới nhất, hoặc quá hạn nhiều nhất (id cuối để thứ tự duy nhất cho cursor)
+    sort = request.GET.get('sort', '')
+    if sort == 'days_overdue':
+        ordering, types = ('-days_overdue', '-borrow_date', '-id'), (int, datetime, int)
+    else:
+        ordering, types = ('-borrow_date', '-id'), (datetime, int)
     
     # Filter theo trạng thái (nhận cả 'filter' và 'status' param)
     status = request.GET.get('filter') or request.GET.get('status', 'all')
@@ -1676,7 +1709,7 @@ def borrow_book_list_view(request):
     if status == 'unreturned':
         receipts = receipts.filter(return_date__isnull=True, is_cancelled=False)
     elif status == 'overdue':
-        receipts = receipts.filter(return_date__isnull=True, due_date__lt=timezone.now(), is_cancelled=False)
+        receipts = receipts.filter(return_date__isnull=True, days_overdue__gt=0, is_cancelled=False)
     elif status == 'returned':
         receipts = receipts.filter(return_date__isnull=False, is_cancelled=False)
     elif status == 'cancelled':
@@ -1686,30 +1719,33 @@ def borrow_book_list_view(request):
     # Search
     search = request.GET.get('search', '')
     if search:
-        receipts = receipts.filter(
-            Q(reader__reader_name__icontains=search) |
-            Q(book_item__book__book_title__book_title__icontains=search) |
-            Q(reader__email__icontains=search) |
-            Q(id__icontains=search)
+        condition = (
+            Q(reader__search_key__contains=fold_text(search)) |
+            Q(book_item__book__book_title__search_key__contains=fold_text(search)) |
+            Q(reader__email__icontains=search)
         )
+        if search.strip().isdigit():
+            condition |= Q(id=int(search))
+        receipts = receipts.filter(condition)
     
     # Filter theo độc giả (giữ lại logic cũ phòng khi dùng)
     reader_id = request.GET.get('reader_id')
     if reader_id:
         receipts = receipts.filter(reader_id=reader_id)
         
-    # Phân trang
-    from django.core.paginator import Paginator
-    paginator = Paginator(receipts, 20)
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    # Phân trang keyset (20 phiếu/trang), tổng số đếm có chặn trên
+    from .pagination import CursorPaginator
+    paginator = CursorPaginator(receipts, ordering, types)
+    page_obj = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
     
     context = {
         'page_obj': page_obj,
         'receipts': page_obj.object_list,
         'current_status': status,
+        'current_sort': sort,
         'search': search,
         'total_results': paginator.count,
+        'total_capped': paginator.count_capped,
         'page_title': 'Danh sách phiếu mượn sách'
     }
     
@@ -1726,19 +1762,28 @@ from django.db.models import Q
 @require_http_methods(["GET"])
 def api_readers_list(request):
     """
-    API lấy danh sách độc giả với tìm kiếm
-    Query params: search (tìm kiếm theo tên hoặc email)
+    API gợi ý độc giả cho ô chọn độc giả
+    Query params: search (tên hoặc email, không dấu), limit (mặc định 50)
+    Có search -> tra chỉ mục gợi ý, khớp tiền tố xếp trước
     """
+    from .autocomplete import suggest
+    from .models import AutocompleteToken
+    from .pagination import parse_limit
+    
     search = request.GET.get('search', '').strip()
+    limit = parse_limit(request.GET.get('limit'), default=50, maximum=50)
     
     # Chỉ hiện độc giả hoạt động
-    readers = Reader.objects.filter(is_active=True).order_by('reader_name')
+    readers = Reader.objects.filter(is_active=True)
     
-    if search:
-        readers = readers.filter(
-            Q(reader_name__icontains=search) | 
-            Q(email__icontains=search)
-        )
+    def load_reader_ids():
+        if search:
+            return [reader.id for reader in suggest(AutocompleteToken.KIND_READER, search, readers, limit)]
+        return readers.order_by('reader_name').values_list('id', flat=True)[:limit]
+    
+    # Gợi ý đã cache theo chuỗi nhập + version độc giả, chỉ nạp các dòng theo id
+    reader_ids, _ = get_search_results('reader', {'text': fold_text(search), 'limit': limit}, load_reader_ids)
+    page_readers = readers.in_bulk(reader_ids)
     
     data = [
         {
@@ -1747,7 +1792,7 @@ def api_readers_list(request):
             'email': reader.email,
             'display': f"{reader.reader_name} - {reader.email}"
         }
-        for reader in readers[:50]  # Giới hạn 50 kết quả
+        for reader in (page_readers[reader_id] for reader_id in reader_ids if reader_id in page_readers)
     ]
     
     return JsonResponse({'success': True, 'data': data})
@@ -1757,21 +1802,32 @@ def api_readers_list(request):
 @require_http_methods(["GET"])
 def api_books_list(request):
     """
-    API lấy danh sách sách còn sẵn với tìm kiếm
-    Query params: search (tìm kiếm theo tên sách hoặc tác giả)
+    API gợi ý sách còn sẵn cho ô chọn sách
+    Query params: search (tên sách hoặc tác giả, không dấu), limit (mặc định 50)
+    Có search -> tra chỉ mục gợi ý, khớp tiền tố xếp trước
     """
+    from .autocomplete import suggest
+    from .models import AutocompleteToken
+    from .pagination import parse_limit
+    
     search = request.GET.get('search', '').strip()
+    limit = parse_limit(request.GET.get('limit'), default=50, maximum=50)
     
     # Chỉ hiện sách còn sẵn
     books = Book.objects.filter(remaining_quantity__gt=0).select_related(
         'book_title', 'book_title__category'
-    ).order_by('book_title__book_title')
+    )
     
-    if search:
-        books = books.filter(
-            Q(book_title__book_title__icontains=search) |
-            Q(book_title__authors__author_name__icontains=search)
-        ).distinct()
+    def load_book_ids():
+        if search:
+            return [book.id for book in suggest(AutocompleteToken.KIND_BOOK, search, books, limit)]
+        return books.order_by('book_title__book_title').values_list('id', flat=True)[:limit]
+    
+    # Gợi ý đã cache theo chuỗi nhập + version sách (tồn kho thay đổi -> version mới)
+    book_ids, _ = get_search_results(
+        'book', {'view': 'picker', 'text': fold_text(search), 'limit': limit}, load_book_ids
+    )
+    page_books = books.in_bulk(book_ids)
     
     data = [
         {
@@ -1782,7 +1838,7 @@ def api_books_list(request):
             'remaining': book.remaining_quantity,
             'display': f"{book.book_title.book_title} ({book.publish_year}) - Còn {book.remaining_quantity} quyển"
         }
-        for book in books[:50]  # Giới hạn 50 kết quả
+        for book in (page_books[book_id] for book_id in book_ids if book_id in page_books)
     ]
     
     return JsonResponse({'success': True, 'data': data})
@@ -1793,59 +1849,208 @@ def api_books_list(request):
 def api_borrowing_readers(request):
     """
     API lấy danh sách độc giả đang mượn sách (chưa trả)
+    Query params: limit (mặc định 100), cursor (next_cursor của trang trước)
+    Sắp xếp theo hạn trả muộn nhất giảm dần, phân trang keyset
     """
-    # Lấy tất cả phiếu mượn chưa trả, group by reader
-    from django.db.models import Count, Max
+    from datetime import datetime
+    from .pagination import encode_cursor, decode_cursor, parse_limit
     
-    borrowing_records = BorrowReturnReceipt.objects.filter(
-        return_date__isnull=True
-    ).values('reader_id').annotate(
-        count=Count('id'),
-        latest_due=Max('due_date')
-    ).order_by('-latest_due')
+    limit = parse_limit(request.GET.get('limit'), default=100, maximum=100)
     
-    records = list(borrowing_records[:100])  # Giới hạn 100 kết quả
-    reader_ids = [r['reader_id'] for r in records]
-    readers_map = Reader.objects.filter(id__in=reader_ids).in_bulk()
+    # Trang độc giả lấy từ bảng tổng hợp (subquery, lấy dư 1 để biết còn trang sau)
+    page_readers = ReaderCirculationSummary.objects.filter(
+        open_loan_count__gt=0,
+        latest_due_date__isnull=False
+    )
+    after = decode_cursor(request.GET.get('cursor'), datetime, int)
+    if after:
+        last_due_date, last_reader_id = after
+        page_readers = page_readers.filter(
+            Q(latest_due_date__lt=last_due_date) |
+            Q(latest_due_date=last_due_date, reader_id__gt=last_reader_id)
+        )
+    page_readers = page_readers.order_by('-latest_due_date', 'reader_id').values('reader_id')[:limit + 1]
+    
+    # 1 truy vấn duy nhất: sách đang mượn của các độc giả trong trang + độc giả + tổng hợp
+    borrows = BorrowReturnReceipt.objects.filter(
+        reader_id__in=page_readers,
+        return_date__isnull=True,
+        is_cancelled=False
+    ).select_related(
+        'reader__circulation_summary', 'book_item__book__book_title'
+    ).order_by(
+        '-reader__circulation_summary__latest_due_date', 'reader_id', 'due_date'
+    )
+    
+    today = timezone.localdate()
     
     data = []
-    for record in records:
-        if record['reader_id'] not in readers_map:
-            continue
-            
-        reader = readers_map[record['reader_id']]
-        
-        # Lấy danh sách sách đang mượn
-        borrows = BorrowReturnReceipt.objects.filter(
-            reader_id=reader.id,
-            return_date__isnull=True
-        ).select_related('book_item__book__book_title')
-        
-        # Kiểm tra có quá hạn không
-        from django.utils import timezone
-        today = timezone.now().date()
-        is_overdue = any(b.due_date.date() < today for b in borrows)
-        
-        data.append({
-            'reader_id': reader.id,
-            'reader_name': reader.reader_name,
-            'reader_email': reader.email,
-            'borrowed_count': record['count'],
-            'latest_due_date': record['latest_due'].strftime('%d/%m/%Y'),
-            'is_overdue': is_overdue,
-            'books': [
-                {
-                    'id': b.book_item.book.id,
-                    'title': b.book_item.book.book_title.book_title,
-                    'borrow_date': b.borrow_date.strftime('%d/%m/%Y'),
-                    'due_date': b.due_date.strftime('%d/%m/%Y'),
-                    'is_overdue': b.due_date.date() < today
-                }
-                for b in borrows
-            ]
+    by_reader = {}
+    for b in borrows:
+        entry = by_reader.get(b.reader_id)
+        if entry is None:
+            reader = b.reader
+            summary = reader.circulation_summary
+            entry = by_reader[b.reader_id] = {
+                'reader_id': reader.id,
+                'reader_name': reader.reader_name,
+                'reader_email': reader.email,
+                'borrowed_count': summary.open_loan_count,
+                'latest_due_date': timezone.localtime(summary.latest_due_date).strftime('%d/%m/%Y'),
+                'is_overdue': summary.has_overdue,
+                'books': [],
+                '_cursor': (summary.latest_due_date, reader.id),
+            }
+            data.append(entry)
+        entry['books'].append({
+            'id': b.book_item.book.id,
+            'title': b.book_item.book.book_title.book_title,
+            'borrow_date': b.borrow_date.strftime('%d/%m/%Y'),
+            'due_date': b.due_date.strftime('%d/%m/%Y'),
+            'is_overdue': timezone.localtime(b.due_date).date() < today
         })
     
+    next_cursor = None
+    if len(data) > limit:
+        data = data[:limit]
+        next_cursor = encode_cursor(*data[-1]['_cursor'])
+    for entry in data:
+        del entry['_cursor']
+    
+    return JsonResponse({'success': True, 'data': data, 'next_cursor': next_cursor})
+
+
+@permission_required('Lập phiếu mượn sách', 'add')
+@require_http_methods(["GET"])
+def api_borrow_precheck(request):
+    """
+    API kiểm tra trước điều kiện mượn cho cả giỏ sách (QĐ4), gọi trước khi submit
+    Query params: reader_id, book_ids (VD: 1,2,3)
+    """
+    try:
+        reader_id = int(request.GET.get('reader_id', ''))
+        book_ids = [int(bid) for bid in request.GET.get('book_ids', '').split(',') if bid.strip()]
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Dữ liệu không hợp lệ.'}, status=400)
+    
+    if not book_ids:
+        return JsonResponse({'success': False, 'error': 'Vui lòng chọn ít nhất 1 quyển sách.'}, status=400)
+    
+    from .services import check_borrow_eligibility
+    result = check_borrow_eligibility(reader_id, book_ids)
+    
+    data = {
+        'eligible': result['eligible'],
+        'reader_errors': result['reader_errors'],
+        'books': result['books'],
+        'current_borrowed': result['current_borrowed'],
+        'max_borrowed_books': result['max_borrowed_books'],
+        'errors': result['reader_errors'] + [row['error'] for row in result['books'] if not row['ok']],
+    }
+    
     return JsonResponse({'success': True, 'data': data})
+
+
+# ==================== BARCODE SCAN API ====================
+
+def _scan_barcodes(request):
+    """
+    Lấy danh sách mã vạch từ request quét (JSON hoặc form):
+    {"barcode": "0001-001"} hoặc {"barcodes": ["0001-001", "0001-002"]}
+    Trả về (payload, barcodes, lỗi)
+    """
+    import json
+    from .services import SCAN_BATCH_LIMIT
+    
+    if request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            return {}, [], 'Dữ liệu JSON không hợp lệ.'
+        if not isinstance(payload, dict):
+            return {}, [], 'Dữ liệu JSON không hợp lệ.'
+        barcodes = payload.get('barcodes') or ([payload['barcode']] if payload.get('barcode') else [])
+        if not isinstance(barcodes, list):
+            return payload, [], 'Trường "barcodes" phải là danh sách mã vạch.'
+    else:
+        payload = request.POST
+        barcodes = payload.getlist('barcodes') or ([payload['barcode']] if payload.get('barcode') else [])
+    
+    barcodes = [str(barcode).strip() for barcode in barcodes if str(barcode).strip()]
+    if not barcodes:
+        return payload, [], 'Vui lòng quét ít nhất 1 mã vạch.'
+    if len(barcodes) > SCAN_BATCH_LIMIT:
+        return payload, [], f'Chỉ quét tối đa {SCAN_BATCH_LIMIT} mã vạch mỗi lần.'
+    return payload, barcodes, None
+
+
+def _scan_response(result, started):
+    """Chuyển kết quả quét sang JSON (kèm thời gian xử lý phía server)"""
+    import time
+    
+    for item in result['items']:
+        if item.get('due_date'):
+            item['due_date'] = item['due_date'].strftime('%d/%m/%Y')
+    data = dict(result, server_ms=round((time.perf_counter() - started) * 1000, 2))
+    return JsonResponse({'success': result['success'], 'data': data}, status=200 if result['success'] else 409)
+
+
+@permission_required('Quản lý mượn/trả', 'view')
+@require_http_methods(["GET"])
+def api_scan_lookup(request):
+    """
+    API tra cứu theo mã vạch: cuốn sách, phiếu đang mượn và độc giả (1 truy vấn)
+    Query params: barcode
+    """
+    from .services import resolve_barcodes
+    
+    barcode = request.GET.get('barcode', '').strip()
+    row = resolve_barcodes([barcode]).get(barcode) if barcode else None
+    if row is None:
+        return JsonResponse({'success': False, 'error': 'Không tìm thấy mã vạch.'}, status=404)
+    if row['due_date']:
+        row['due_date'] = row['due_date'].strftime('%d/%m/%Y')
+    return JsonResponse({'success': True, 'data': row})
+
+
+@permission_required('Lập phiếu mượn sách', 'add')
+@require_http_methods(["POST"])
+def api_scan_checkout(request):
+    """
+    API cho mượn theo mã vạch (1 hoặc nhiều cuốn) trong 1 transaction
+    Body: reader_id, barcode hoặc barcodes
+    """
+    import time
+    from .services import scan_checkout
+    
+    started = time.perf_counter()
+    payload, barcodes, error = _scan_barcodes(request)
+    if error:
+        return JsonResponse({'success': False, 'error': error}, status=400)
+    try:
+        reader_id = int(payload.get('reader_id'))
+    except (TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Vui lòng chọn độc giả.'}, status=400)
+    
+    return _scan_response(scan_checkout(reader_id, barcodes), started)
+
+
+@permission_required('Lập phiếu trả sách', 'add')
+@require_http_methods(["POST"])
+def api_scan_checkin(request):
+    """
+    API nhận trả theo mã vạch (1 hoặc nhiều cuốn) trong 1 transaction
+    Body: barcode hoặc barcodes
+    """
+    import time
+    from .services import scan_checkin
+    
+    started = time.perf_counter()
+    _, barcodes, error = _scan_barcodes(request)
+    if error:
+        return JsonResponse({'success': False, 'error': error}, status=400)
+    
+    return _scan_response(scan_checkin(barcodes), started)
 """
 Views cho YC5: Nhận trả sách
 """
@@ -1862,6 +2067,7 @@ from .forms import ReturnBookForm
 
 @ratelimit(key='ip', rate='20/m', method='POST', block=False)
 @permission_required('Lập phiếu trả sách', 'add')
+@idempotent
 def return_book_view(request):
     """
     Trang nhận trả sách - YC5
@@ -1872,13 +2078,14 @@ def return_book_view(request):
         messages.error(request, 'Quá nhiều yêu cầu. Vui lòng thử lại sau.')
         return render(request, 'errors/429.html', status=429)
     
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     fine_rate = params.fine_rate if params else 1000
     
     context = {
         'page_title': 'Nhận trả sách',
         'params': params,
         'fine_rate': fine_rate,
+        'idempotency_key': new_idempotency_key(),
     }
     
     if request.method == 'POST':
@@ -1939,7 +2146,9 @@ def return_book_detail_view(request, receipt_id):
     Hiển thị: thông tin độc giả, sách trả, tiền phạt
     """
     receipt = get_object_or_404(BorrowReturnReceipt, id=receipt_id)
-    params = Parameter.objects.first()
+    # Nợ dự tính của độc giả tính trong SQL (template đọc nhiều lần)
+    receipt.reader = Reader.objects.with_pending_debt().get(id=receipt.reader_id)
+    params = Parameter.get_current()
     fine_rate = params.fine_rate if params else 1000
     
     # Tính tiền phạt
@@ -1988,7 +2197,7 @@ def return_cancel_view(request, receipt_id):
         return redirect('return_book_detail', receipt_id=receipt.id)
     
     # Kiểm tra thời gian: chỉ hủy trong vòng N giờ kể từ khi trả (N từ tham số hệ thống)
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     cancellation_hours = params.cancellation_time_limit if params else 24
     
     time_since_return = timezone.now() - receipt.return_date
@@ -2026,24 +2235,20 @@ def return_cancel_view(request, receipt_id):
             else:
                 receipt.notes += f"\n[{timezone.now().strftime('%d/%m/%Y %H:%M')}] Đã hủy hành động trả sách (trả lúc {old_return_date.strftime('%d/%m/%Y %H:%M')}): {cancel_reason}"
             
-            receipt.save(update_fields=['return_date', 'notes'])
-            
-            # Đánh dấu sách lại là đang mượn
-            receipt.book_item.is_borrowed = True
-            receipt.book_item.save(update_fields=['is_borrowed'])
-            
-            # Giảm remaining_quantity
-            receipt.book_item.book.remaining_quantity -= 1
-            receipt.book_item.book.save(update_fields=['remaining_quantity'])
-            
-            # HOÀN TIỀN PHẠT: Trừ fine_amount khỏi total_debt
-            # - Fine đã được cộng vào total_debt khi trả sách (BorrowReturnReceipt.save())
-            # - Khi hủy return, cần trừ fine_amount khỏi total_debt để nợ quay về trạng thái "dự tính"
-            # - Nợ dự tính sẽ được tự động tính lại qua pending_debt property
-            # - Phiếu quay lại trạng thái "đang mượn" nên fine sẽ được tính lại khi trả lần sau
-            if old_fine > 0:
-                receipt.reader.total_debt -= old_fine
-                receipt.reader.save(update_fields=['total_debt'])
+            from .services import record_checkout, adjust_reader_debt
+            with transaction.atomic():
+                receipt.save(update_fields=['return_date', 'notes'])
+                
+                # Đánh dấu sách lại là đang mượn, giảm remaining_quantity
+                record_checkout(receipt.book_item)
+                
+                # HOÀN TIỀN PHẠT: Trừ fine_amount khỏi total_debt
+                # - Fine đã được cộng vào total_debt khi trả sách (BorrowReturnReceipt.save())
+                # - Khi hủy return, cần trừ fine_amount khỏi total_debt để nợ quay về trạng thái "dự tính"
+                # - Nợ dự tính sẽ được tự động tính lại qua pending_debt property
+                # - Phiếu quay lại trạng thái "đang mượn" nên fine sẽ được tính lại khi trả lần sau
+                if old_fine > 0:
+                    adjust_reader_debt(receipt.reader_id, -old_fine)
             
             messages.success(
                 request,
@@ -2076,55 +2281,49 @@ def return_book_list_view(request):
     search = request.GET.get('search', '')
     
     # Base query: chỉ lấy phiếu đã trả (return_date != null)
-    receipts = BorrowReturnReceipt.objects.filter(
+    # Số ngày trễ / tiền phạt tính trong database
+    receipts = BorrowReturnReceipt.objects.with_overdue().filter(
         return_date__isnull=False
     ).select_related('reader', 'book_item__book__book_title')
     
     # Lọc theo loại
-    # Lọc theo loại
-    if filter_type != 'all':
-        from django.db.models import F as DjangoF
-        
-        if filter_type == 'overdue':
-             # Quá hạn: ngày trả > ngày phải trả
-            receipts = receipts.filter(return_date__gt=DjangoF('due_date'))
-        elif filter_type in ['ontime', 'returned']:
-             # Đúng hạn: ngày trả <= ngày phải trả
-            receipts = receipts.filter(return_date__lte=DjangoF('due_date'))
+    if filter_type == 'overdue':
+        # Quá hạn: ngày trả (giờ địa phương) > ngày phải trả
+        receipts = receipts.filter(days_overdue__gt=0)
+    elif filter_type in ['ontime', 'returned']:
+        # Đúng hạn: ngày trả <= ngày phải trả
+        receipts = receipts.filter(days_overdue=0)
     
     # Tìm kiếm theo tên độc giả hoặc tên sách
     if search:
         from django.db.models import Q
         receipts = receipts.filter(
-            Q(reader__reader_name__icontains=search) |
-            Q(book_item__book__book_title__book_title__icontains=search) |
+            Q(reader__search_key__contains=fold_text(search)) |
+            Q(book_item__book__book_title__search_key__contains=fold_text(search)) |
             Q(reader__email__icontains=search)
         )
     
-    # Sắp xếp
-    receipts = receipts.order_by('-return_date')
+    # Sắp xếp: mặc định mới trả nhất, hoặc trễ nhiều nhất (id cuối để thứ tự duy nhất cho cursor)
+    sort = request.GET.get('sort', '')
+    if sort == 'days_overdue':
+        ordering, types = ('-days_overdue', '-return_date', '-id'), (int, datetime, int)
+    else:
+        ordering, types = ('-return_date', '-id'), (datetime, int)
     
-    # Phân trang
-    from django.core.paginator import Paginator
-    paginator = Paginator(receipts, 20)
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
-    params = Parameter.objects.first()
-    fine_rate = params.fine_rate if params else 1000
-    # Tính tiền phạt cho mỗi receipt
-    for receipt in page_obj.object_list:
-        if hasattr(receipt, 'is_overdue') and receipt.is_overdue:
-            receipt.fine_amount = receipt.days_overdue * fine_rate
-        else:
-            receipt.fine_amount = 0
+    # Phân trang keyset (20 phiếu/trang), tổng số đếm có chặn trên
+    from .pagination import CursorPaginator
+    paginator = CursorPaginator(receipts, ordering, types)
+    page_obj = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
     
     context = {
         'page_title': 'Danh sách phiếu trả sách',
         'page_obj': page_obj,
         'receipts': page_obj.object_list,
         'filter_type': filter_type,
+        'current_sort': sort,
         'search': search,
         'total_results': paginator.count,
+        'total_capped': paginator.count_capped,
     }
     
     return render(request, 'app/borrowing/return_book_list.html', context)
@@ -2137,53 +2336,84 @@ def api_unreturned_receipts(request):
     """
     API: Lấy danh sách phiếu mượn chưa trả
     Dùng cho dropdown chọn phiếu trả sách
+    Query params: search, limit (mặc định 50), cursor (next_cursor của trang trước)
+    
+    Phân trang keyset theo (borrow_date, id) giảm dần, chỉ đọc các cột cần thiết
+    (values()) và trả JSON dạng stream: chi phí không tăng theo tổng số phiếu đang mượn.
     """
-    search = request.GET.get('search', '')
-    print(f'[API] Fetching unreturned receipts, search={search}')
+    import json
+    from django.http import StreamingHttpResponse
+    from .pagination import encode_cursor, decode_cursor, parse_limit
     
-    # Lấy phiếu chưa trả
-    receipts = BorrowReturnReceipt.objects.filter(
-        return_date__isnull=True
-    ).select_related('reader', 'book_item__book__book_title')
+    search = request.GET.get('search', '').strip()
+    limit = parse_limit(request.GET.get('limit'), default=50, maximum=100)
+    after = decode_cursor(request.GET.get('cursor'), datetime, int)
     
-    print(f'[API] Found {len(receipts)} unreturned receipts')
+    # Lấy phiếu chưa trả (loại trừ phiếu đã hủy)
+    receipts = BorrowReturnReceipt.objects.filter(
+        return_date__isnull=True,
+        is_cancelled=False
+    )
     
     # Tìm kiếm
     if search:
-        from django.db.models import Q
-        receipts = receipts.filter(
-            Q(reader__reader_name__icontains=search) |
-            Q(book_item__book__book_title__book_title__icontains=search) |
-            Q(reader__email__icontains=search) |
-            Q(id__icontains=search)
+        condition = (
+            Q(reader__search_key__contains=fold_text(search)) |
+            Q(book_item__book__book_title__search_key__contains=fold_text(search)) |
+            Q(reader__email__icontains=search)
         )
+        if search.strip().isdigit():
+            condition |= Q(id=int(search))
+        receipts = receipts.filter(condition)
     
-    # Giới hạn kết quả
-    receipts = receipts[:50]
+    if after:
+        last_borrow_date, last_id = after
+        receipts = receipts.filter(
+            Q(borrow_date__lt=last_borrow_date) |
+            Q(borrow_date=last_borrow_date, id__lt=last_id)
+        )
     
-    data = []
-    for receipt in receipts:
-        try:
-            days_borrowed = (timezone.now().date() - receipt.borrow_date.date()).days
-            book_title = receipt.book_item.book.book_title.book_title
-            reader_name = receipt.reader.reader_name
-            
-            data.append({
-                'id': receipt.id,
+    # Lấy dư 1 dòng để biết còn trang sau
+    rows = receipts.order_by('-borrow_date', '-id').values(
+        'id', 'borrow_date', 'due_date',
+        'reader__reader_name', 'reader__email',
+        'book_item__book__book_title__book_title',
+    )[:limit + 1]
+    
+    def stream():
+        today = timezone.localdate()
+        count = 0
+        last = None
+        has_next = False
+        yield '{"success": true, "data": ['
+        for row in rows.iterator():
+            if count == limit:
+                has_next = True
+                break
+            borrow_date = timezone.localtime(row['borrow_date'])
+            due_date = timezone.localtime(row['due_date'])
+            reader_name = row['reader__reader_name']
+            book_title = row['book_item__book__book_title__book_title']
+            item = {
+                'id': row['id'],
                 'reader_name': reader_name,
-                'reader_email': receipt.reader.email,
+                'reader_email': row['reader__email'],
                 'book_title': book_title,
-                'borrow_date': receipt.borrow_date.strftime('%d/%m/%Y'),
-                'due_date': receipt.due_date.strftime('%d/%m/%Y'),
-                'days_borrowed': days_borrowed,
-                'is_overdue': receipt.due_date.date() < timezone.now().date(),
-                'display': f"#{receipt.id} - {reader_name} ({book_title})"
-            })
-        except Exception as e:
-            print(f'Error processing receipt {receipt.id}: {e}')
-            continue
+                'borrow_date': borrow_date.strftime('%d/%m/%Y'),
+                'due_date': due_date.strftime('%d/%m/%Y'),
+                'days_borrowed': (today - borrow_date.date()).days,
+                'is_overdue': due_date.date() < today,
+                'display': f"#{row['id']} - {reader_name} ({book_title})"
+            }
+            yield (',' if count else '') + json.dumps(item, ensure_ascii=False)
+            count += 1
+            last = row
+        
+        next_cursor = encode_cursor(last['borrow_date'], last['id']) if has_next else None
+        logger.debug('Unreturned receipts: search=%r page_size=%d has_next=%s', search, count, bool(next_cursor))
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
     
-    return JsonResponse({'success': True, 'data': data})
+    return StreamingHttpResponse(stream(), content_type='application/json')
 
 
 @login_required
@@ -2199,42 +2429,30 @@ def api_reader_borrowed_books(request, reader_id):
         return JsonResponse({'success': False, 'data': [], 'error': 'Reader not found'}, status=404)
     
     # Lấy danh sách phiếu mượn chưa trả của độc giả (loại trừ phiếu đã hủy)
-    receipts = BorrowReturnReceipt.objects.filter(
+    # Số ngày trễ tính trong database theo ngày địa phương
+    receipts = BorrowReturnReceipt.objects.with_overdue().filter(
         reader=reader,
         return_date__isnull=True,
         is_cancelled=False  # Loại trừ phiếu đã hủy
     ).select_related('book_item__book__book_title')
     
+    today = timezone.localdate()
     data = []
     for receipt in receipts:
-        try:
-            today = timezone.localdate()
-            days_borrowed = (today - receipt.borrow_date.date()).days
-            book_title = receipt.book_item.book.book_title.book_title
-            
-            # Tính days_overdue từ due_date thực sự, converted sang localtime
-            due_date = receipt.due_date
-            if due_date:
-                due_date = timezone.localtime(due_date).date()
-            else:
-                due_date = timezone.localtime(receipt.borrow_date).date()
-            
-            days_overdue = max(0, (today - due_date).days)
-            
-            data.append({
-                'receipt_id': receipt.id,
-                'book_item_id': receipt.book_item.id,
-                'book_title': book_title,
-                'barcode': receipt.book_item.barcode,
-                'borrow_date': receipt.borrow_date.strftime('%d/%m/%Y'),
-                'due_date': receipt.due_date.strftime('%d/%m/%Y'),
-                'days_borrowed': days_borrowed,
-                'days_overdue': days_overdue,
-                'is_overdue': days_overdue > 0,
-            })
-        except Exception as e:
-            print(f'Error processing receipt {receipt.id}: {e}')
-            continue
+        days_borrowed = (today - timezone.localtime(receipt.borrow_date).date()).days
+        
+        data.append({
+            'receipt_id': receipt.id,
+            'book_item_id': receipt.book_item.id,
+            'book_title': receipt.book_item.book.book_title.book_title,
+            'barcode': receipt.book_item.barcode,
+            'borrow_date': receipt.borrow_date.strftime('%d/%m/%Y'),
+            'due_date': receipt.due_date.strftime('%d/%m/%Y'),
+            'days_borrowed': days_borrowed,
+            'days_overdue': receipt.days_overdue,
+            'is_overdue': receipt.days_overdue > 0,
+            'fine': receipt.fine,
+        })
     
     return JsonResponse({'success': True, 'data': data})
 
@@ -2243,6 +2461,7 @@ def api_reader_borrowed_books(request, reader_id):
 
 @ratelimit(key='ip', rate='10/m', method='POST', block=False)
 @permission_required('Lập phiếu thu tiền phạt', 'add')
+@idempotent
 def receipt_form_view(request):
     """
     Lập phiếu thu tiền phạt - YC6 (BM6)
@@ -2265,7 +2484,7 @@ def receipt_form_view(request):
     
     # Lấy tham số hệ thống
     try:
-        params = Parameter.objects.first()
+        params = Parameter.get_current()
     except:
         params = None
     
@@ -2319,6 +2538,7 @@ def receipt_form_view(request):
         'readers_json': readers_json,
         'params': params,
         'bank_config': json.dumps(bank_config),
+        'idempotency_key': new_idempotency_key(),
     }
     
     return render(request, 'app/receipts/receipt_form.html', context)
@@ -2331,10 +2551,10 @@ def receipt_list_view(request):
     """
     from .decorators import check_permission
     from django.db.models import Q
-    from django.core.paginator import Paginator
+    from .pagination import CursorPaginator
     
     # Get all receipts (including cancelled)
-    receipts = Receipt.objects.select_related('reader').all().order_by('-created_date')
+    receipts = Receipt.objects.select_related('reader').all()
     
     # Status filter
     status = request.GET.get('status', '')
@@ -2348,7 +2568,7 @@ def receipt_list_view(request):
     search = request.GET.get('search', '')
     if search:
         receipts = receipts.filter(
-            Q(reader__reader_name__icontains=search) | 
+            Q(reader__search_key__contains=fold_text(search)) |
             Q(reader__email__icontains=search)
         )
     
@@ -2364,15 +2584,15 @@ def receipt_list_view(request):
         to_date_end = to_date_obj.replace(hour=23, minute=59, second=59)
         receipts = receipts.filter(created_date__lte=to_date_end)
     
-    # Pagination
-    paginator = Paginator(receipts, 20)  # 20 items per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset pagination (20 items per page, newest first), capped total
+    paginator = CursorPaginator(receipts, ('-created_date', '-id'), (datetime, int))
+    page_obj = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
     
     context = {
         'receipts': page_obj,
         'page_obj': page_obj,
-        'total_results': receipts.count(),
+        'total_results': paginator.count,
+        'total_capped': paginator.count_capped,
         'search': search,
         'from_date': from_date,
         'to_date': to_date,
@@ -2423,7 +2643,7 @@ def receipt_cancel_view(request, receipt_id):
         return redirect('receipt_detail', receipt_id=receipt.id)
     
     # Kiểm tra thời gian: chỉ hủy trong vòng N giờ kể từ khi lập phiếu (N từ tham số hệ thống)
-    params = Parameter.objects.first()
+    params = Parameter.get_current()
     cancellation_hours = params.cancellation_time_limit if params else 24
     
     time_since_created = timezone.now() - receipt.created_date
@@ -2443,17 +2663,19 @@ def receipt_cancel_view(request, receipt_id):
             return render(request, 'app/receipts/receipt_cancel_confirm.html', context)
         
         try:
-            # QUAN TRỌNG: Hoàn tiền cho độc giả TRƯỚC khi save receipt
-            # Vì Receipt có validation check: collected_amount <= reader.total_debt
-            receipt.reader.total_debt += receipt.collected_amount
-            receipt.reader.save(update_fields=['total_debt'])
-            
-            # Sau đó mới đánh dấu phiếu đã hủy với audit trail
-            receipt.is_cancelled = True
-            receipt.cancelled_at = timezone.now()
-            receipt.cancelled_by = request.user
-            receipt.cancel_reason = cancel_reason
-            receipt.save(update_fields=['is_cancelled', 'cancelled_at', 'cancelled_by', 'cancel_reason'])
+            from .services import adjust_reader_debt
+            with transaction.atomic():
+                # QUAN TRỌNG: Hoàn tiền cho độc giả TRƯỚC khi save receipt
+                # Vì Receipt có validation check: collected_amount <= reader.total_debt
+                adjust_reader_debt(receipt.reader_id, receipt.collected_amount)
+                receipt.reader.total_debt += receipt.collected_amount
+                
+                # Sau đó mới đánh dấu phiếu đã hủy với audit trail
+                receipt.is_cancelled = True
+                receipt.cancelled_at = timezone.now()
+                receipt.cancelled_by = request.user
+                receipt.cancel_reason = cancel_reason
+                receipt.save(update_fields=['is_cancelled', 'cancelled_at', 'cancelled_by', 'cancel_reason'])
             
             messages.success(
                 request,
@@ -2482,7 +2704,7 @@ def api_reader_debt(request, reader_id):
     API: Lấy thông tin nợ tiền phạt của độc giả
     """
     try:
-        reader = Reader.objects.get(id=reader_id)
+        reader = Reader.objects.with_pending_debt().get(id=reader_id)
         
         return JsonResponse({
             'success': True,
@@ -2490,6 +2712,8 @@ def api_reader_debt(request, reader_id):
             'reader_name': reader.reader_name,
             'email': reader.email,
             'total_debt': reader.total_debt,
+            'pending_debt': reader.pending_fine,
+            'total_debt_with_pending': reader.debt_with_pending,
         })
     except Reader.DoesNotExist:
         return JsonResponse({
@@ -2517,44 +2741,9 @@ def report_borrow_by_category_view(request):
         month = int(month)
         year = int(year)
     
-    # Tính ngày đầu và cuối tháng
-    from calendar import monthrange
-    first_day = timezone.datetime(year, month, 1, tzinfo=timezone.get_current_timezone())
-    last_day_num = monthrange(year, month)[1]
-    last_day = timezone.datetime(year, month, last_day_num, 23, 59, 59, tzinfo=timezone.get_current_timezone())
-    
-    # Lấy danh sách phiếu mượn trong tháng (D3)
-    borrow_receipts = BorrowReturnReceipt.objects.filter(
-        borrow_date__gte=first_day,
-        borrow_date__lte=last_day
-    ).select_related('book_item__book__book_title__category')
-    
-    # Đếm số lượt mượn theo thể loại (D4)
-    category_stats = {}
-    total_borrows = 0
-    
-    for receipt in borrow_receipts:
-        # Lấy thể loại từ book_item -> book -> book_title -> category
-        if receipt.book_item and receipt.book_item.book:
-            category = receipt.book_item.book.book_title.category
-            category_name = category.category_name
-            
-            if category_name not in category_stats:
-                category_stats[category_name] = 0
-            
-            category_stats[category_name] += 1
-            total_borrows += 1
-    
-    # Tính tỉ lệ (%)
-    report_data = []
-    for idx, (category_name, borrow_count) in enumerate(sorted(category_stats.items()), start=1):
-        percentage = (borrow_count / total_borrows * 100) if total_borrows > 0 else 0
-        report_data.append({
-            'stt': idx,
-            'category_name': category_name,
-            'borrow_count': borrow_count,
-            'percentage': round(percentage, 2)
-        })
+    # Đếm theo thể loại trong database; tháng đã kết thúc đọc từ bản lưu (D3, D4)
+    from .reports import borrow_by_category
+    report_data, total_borrows = borrow_by_category(year, month)
     
     context = {
         'report_data': report_data,
@@ -2587,16 +2776,16 @@ def report_overdue_books_view(request):
     # Lấy danh sách phiếu mượn đã trả trễ VÀO NGÀY được chọn
     # return_date.date() == report_date (trả vào đúng ngày báo cáo)
     # return_date > due_date (đã trả nhưng trả trễ hơn hạn)
-    overdue_receipts = BorrowReturnReceipt.objects.filter(
+    overdue_receipts = BorrowReturnReceipt.objects.with_overdue().filter(
         return_date__date=report_date.date(),  # Trả vào đúng ngày báo cáo
-        return_date__gt=models.F('due_date')  # Trả sau hạn
-    ).select_related('book_item__book__book_title', 'reader')
+        days_overdue__gt=0  # Trả sau hạn (theo ngày địa phương)
+    ).select_related('book_item__book__book_title', 'reader').order_by('-days_overdue', 'return_date')
     
     # Tạo danh sách thống kê (D4)
     report_data = []
     for idx, receipt in enumerate(overdue_receipts, start=1):
-        # Tính số ngày trễ = return_date - due_date
-        overdue_days = (receipt.return_date.date() - receipt.due_date.date()).days
+        # Số ngày trễ = return_date - due_date (tính trong database)
+        overdue_days = receipt.days_overdue
         
         book_title = receipt.book_item.book.book_title.book_title if receipt.book_item else "N/A"
         
@@ -2627,31 +2816,14 @@ def report_borrow_by_category_excel(request):
     from openpyxl import Workbook
     from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
     from django.http import HttpResponse
-    from calendar import monthrange
+    from .reports import borrow_by_category
     
     # Lấy tháng/năm từ request
     month = int(request.GET.get('month', timezone.now().month))
     year = int(request.GET.get('year', timezone.now().year))
     
-    # Tính ngày đầu và cuối tháng
-    first_day = timezone.datetime(year, month, 1, tzinfo=timezone.get_current_timezone())
-    last_day_num = monthrange(year, month)[1]
-    last_day = timezone.datetime(year, month, last_day_num, 23, 59, 59, tzinfo=timezone.get_current_timezone())
-    
-    # Lấy dữ liệu
-    borrow_receipts = BorrowReturnReceipt.objects.filter(
-        borrow_date__gte=first_day,
-        borrow_date__lte=last_day
-    )
-    
-    category_stats = {}
-    total_borrows = 0
-    
-    for receipt in borrow_receipts:
-        if receipt.book_item and receipt.book_item.book:
-            category_name = receipt.book_item.book.book_title.category.category_name
-            category_stats[category_name] = category_stats.get(category_name, 0) + 1
-            total_borrows += 1
+    # Lấy dữ liệu (cùng nguồn với trang báo cáo)
+    report_data, total_borrows = borrow_by_category(year, month)
     
     # Tạo workbook
     wb = Workbook()
@@ -2683,12 +2855,11 @@ def report_borrow_by_category_excel(request):
     
     # Data
     row = 4
-    for idx, (category_name, borrow_count) in enumerate(sorted(category_stats.items()), 1):
-        percentage = round((borrow_count / total_borrows * 100), 2) if total_borrows > 0 else 0
-        ws.cell(row=row, column=1, value=idx).border = thin_border
-        ws.cell(row=row, column=2, value=category_name).border = thin_border
-        ws.cell(row=row, column=3, value=borrow_count).border = thin_border
-        ws.cell(row=row, column=4, value=f"{percentage}%").border = thin_border
+    for item in report_data:
+        ws.cell(row=row, column=1, value=item['stt']).border = thin_border
+        ws.cell(row=row, column=2, value=item['category_name']).border = thin_border
+        ws.cell(row=row, column=3, value=item['borrow_count']).border = thin_border
+        ws.cell(row=row, column=4, value=f"{item['percentage']}%").border = thin_border
         row += 1
     
     # Total
@@ -2730,10 +2901,10 @@ def report_overdue_books_excel(request):
         report_date = timezone.now()
     
     # Lấy dữ liệu - Đồng bộ với view: lọc phiếu trả trễ vào đúng ngày báo cáo
-    overdue_receipts = BorrowReturnReceipt.objects.filter(
+    overdue_receipts = BorrowReturnReceipt.objects.with_overdue().filter(
         return_date__date=report_date.date(),  # Trả vào đúng ngày báo cáo
-        return_date__gt=models.F('due_date')  # Trả sau hạn
-    ).select_related('book_item__book__book_title', 'reader')
+        days_overdue__gt=0  # Trả sau hạn (theo ngày địa phương)
+    ).select_related('book_item__book__book_title', 'reader').order_by('-days_overdue', 'return_date')
     
     # Tạo workbook
     wb = Workbook()
@@ -2766,8 +2937,8 @@ def report_overdue_books_excel(request):
     # Data
     row = 4
     for idx, receipt in enumerate(overdue_receipts, 1):
-        # Tính số ngày trễ = return_date - due_date (đồng bộ với view)
-        overdue_days = (receipt.return_date.date() - receipt.due_date.date()).days
+        # Số ngày trễ tính trong database (đồng bộ với view)
+        overdue_days = receipt.days_overdue
         book_title = receipt.book_item.book.book_title.book_title if receipt.book_item else "N/A"
         reader_info = f"{receipt.reader.reader_name} ({receipt.reader.email})"
         
@@ -2823,67 +2994,9 @@ def report_borrow_situation_view(request):
     else:
         to_date = now
     
-    # Lấy dữ liệu mượn trong khoảng thời gian
-    borrow_receipts = BorrowReturnReceipt.objects.filter(
-        borrow_date__gte=from_date,
-        borrow_date__lte=to_date
-    ).select_related('book_item__book__book_title__category')
-    
-    # Đếm theo thể loại
-    category_stats = {}
-    category_books = {}  # Lưu số sách từng thể loại
-    category_readers = {}  # Lưu danh sách reader_id
-    category_book_titles = {}  # Lưu tên sách được mượn
-    total_borrows = 0
-    
-    for receipt in borrow_receipts:
-        if receipt.book_item and receipt.book_item.book:
-            category_name = receipt.book_item.book.book_title.category.category_name
-            book_title_name = receipt.book_item.book.book_title.book_title
-            reader_id = receipt.reader_id
-            
-            category_stats[category_name] = category_stats.get(category_name, 0) + 1
-            total_borrows += 1
-            
-            # Đếm số sách (đầu sách) trong category
-            if category_name not in category_books:
-                category_books[category_name] = set()
-            category_books[category_name].add(receipt.book_item.book.book_title.id)
-            
-            # Đếm số độc giả duy nhất
-            if category_name not in category_readers:
-                category_readers[category_name] = set()
-            category_readers[category_name].add(reader_id)
-            
-            # Đếm sách được mượn nhiều nhất
-            if category_name not in category_book_titles:
-                category_book_titles[category_name] = {}
-            category_book_titles[category_name][book_title_name] = category_book_titles[category_name].get(book_title_name, 0) + 1
-    
-    # Tạo dữ liệu báo cáo
-    report_data = []
-    for idx, (category_name, borrow_count) in enumerate(sorted(category_stats.items(), key=lambda x: -x[1]), 1):
-        percentage = round((borrow_count / total_borrows * 100), 2) if total_borrows > 0 else 0
-        
-        # Tìm sách được mượn nhiều nhất trong thể loại
-        top_book = ""
-        top_book_count = 0
-        if category_name in category_book_titles:
-            for book, count in category_book_titles[category_name].items():
-                if count > top_book_count:
-                    top_book = book
-                    top_book_count = count
-        
-        report_data.append({
-            'stt': idx,
-            'category_name': category_name,
-            'borrow_count': borrow_count,
-            'percentage': percentage,
-            'book_count': len(category_books.get(category_name, set())),
-            'reader_count': len(category_readers.get(category_name, set())),
-            'top_book': top_book,
-            'top_book_count': top_book_count
-        })
+    # Cộng từ bảng tổng hợp theo ngày (thể loại, đầu sách), không quét từng phiếu mượn
+    from .reports import borrow_situation
+    report_data, total_borrows = borrow_situation(from_date, to_date)
     
     # Dữ liệu cho biểu đồ (JSON)
     import json
@@ -2936,42 +3049,9 @@ def report_borrow_situation_excel(request):
     else:
         to_date = now
     
-    # Lấy dữ liệu
-    borrow_receipts = BorrowReturnReceipt.objects.filter(
-        borrow_date__gte=from_date,
-        borrow_date__lte=to_date
-    ).select_related('book_item__book__book_title__category')
-    
-    # Đếm theo thể loại (giống logic trong view)
-    category_stats = {}
-    category_books = {}  # Lưu số sách từng thể loại
-    category_readers = {}  # Lưu danh sách reader_id
-    category_book_titles = {}  # Lưu tên sách được mượn
-    total_borrows = 0
-    
-    for receipt in borrow_receipts:
-        if receipt.book_item and receipt.book_item.book:
-            category_name = receipt.book_item.book.book_title.category.category_name
-            book_title_name = receipt.book_item.book.book_title.book_title
-            reader_id = receipt.reader_id
-            
-            category_stats[category_name] = category_stats.get(category_name, 0) + 1
-            total_borrows += 1
-            
-            # Đếm số sách (đầu sách) trong category
-            if category_name not in category_books:
-                category_books[category_name] = set()
-            category_books[category_name].add(receipt.book_item.book.book_title.id)
-            
-            # Đếm số độc giả duy nhất
-            if category_name not in category_readers:
-                category_readers[category_name] = set()
-            category_readers[category_name].add(reader_id)
-            
-            # Đếm sách được mượn nhiều nhất
-            if category_name not in category_book_titles:
-                category_book_titles[category_name] = {}
-            category_book_titles[category_name][book_title_name] = category_book_titles[category_name].get(book_title_name, 0) + 1
+    # Lấy dữ liệu (giống view)
+    from .reports import borrow_situation
+    report_data, total_borrows = borrow_situation(from_date, to_date)
     
     # Tạo workbook
     wb = Workbook()
@@ -3007,27 +3087,15 @@ def report_borrow_situation_excel(request):
     
     # Data
     row = 5
-    for idx, (category_name, borrow_count) in enumerate(sorted(category_stats.items(), key=lambda x: -x[1]), 1):
-        percentage = round((borrow_count / total_borrows * 100), 2) if total_borrows > 0 else 0
-        book_count = len(category_books.get(category_name, set()))
-        reader_count = len(category_readers.get(category_name, set()))
-        
-        # Tìm sách được mượn nhiều nhất trong thể loại
-        top_book = ""
-        top_book_count = 0
-        if category_name in category_book_titles:
-            for book, count in category_book_titles[category_name].items():
-                if count > top_book_count:
-                    top_book = book
-                    top_book_count = count
-        top_book_display = f"{top_book} ({top_book_count} lượt)" if top_book else "-"
+    for item in report_data:
+        top_book_display = f"{item['top_book']} ({item['top_book_count']} lượt)" if item['top_book'] else "-"
         
-        ws.cell(row=row, column=1, value=idx).border = thin_border
-        ws.cell(row=row, column=2, value=category_name).border = thin_border
-        ws.cell(row=row, column=3, value=book_count).border = thin_border
-        ws.cell(row=row, column=4, value=reader_count).border = thin_border
-        ws.cell(row=row, column=5, value=borrow_count).border = thin_border
-        ws.cell(row=row, column=6, value=f"{percentage}%").border = thin_border
+        ws.cell(row=row, column=1, value=item['stt']).border = thin_border
+        ws.cell(row=row, column=2, value=item['category_name']).border = thin_border
+        ws.cell(row=row, column=3, value=item['book_count']).border = thin_border
+        ws.cell(row=row, column=4, value=item['reader_count']).border = thin_border
+        ws.cell(row=row, column=5, value=item['borrow_count']).border = thin_border
+        ws.cell(row=row, column=6, value=f"{item['percentage']}%").border = thin_border
         ws.cell(row=row, column=7, value=top_book_display).border = thin_border
         row += 1
     
@@ -3059,7 +3127,6 @@ def report_fine_collection_view(request):
     Báo cáo tiền phạt được thu trong khoảng thời gian
     """
     from datetime import timedelta
-    from collections import defaultdict
     import json
     
     # Lấy ngày từ request
@@ -3086,18 +3153,20 @@ def report_fine_collection_view(request):
     else:
         to_date = now
     
-    # Lấy các phiếu thu trong khoảng thời gian (không tính phiếu đã hủy)
+    # Lấy các phiếu thu trong khoảng thời gian (không tính phiếu đã hủy).
+    # Khoảng được làm tròn theo ngày địa phương như bảng tổng hợp theo ngày
+    # -> danh sách, tổng tiền, biểu đồ và file Excel cùng 1 tập phiếu
+    from .reports import day_bounds
+    _, _, start, end = day_bounds(from_date, to_date)
     receipts = Receipt.objects.filter(
-        created_date__gte=from_date,
-        created_date__lte=to_date,
+        created_date__gte=start,
+        created_date__lt=end,
         is_cancelled=False
     ).select_related('reader').order_by('-created_date')
     
     # Tạo dữ liệu báo cáo
     report_data = []
-    total_collected = 0
     unique_readers = set()
-    daily_stats = defaultdict(int)
     
     for idx, receipt in enumerate(receipts, 1):
         report_data.append({
@@ -3110,16 +3179,13 @@ def report_fine_collection_view(request):
             'collected_amount': receipt.collected_amount,
             'is_cancelled': receipt.is_cancelled
         })
-        total_collected += receipt.collected_amount
         unique_readers.add(receipt.reader.id)
-        
-        # Thống kê theo ngày cho biểu đồ
-        date_key = receipt.created_date.strftime('%d/%m')
-        daily_stats[date_key] += receipt.collected_amount
     
-    # Dữ liệu cho biểu đồ
-    chart_labels = json.dumps(list(daily_stats.keys()))
-    chart_data = json.dumps(list(daily_stats.values()))
+    # Tổng tiền và thống kê theo ngày cho biểu đồ: cộng từ bảng tổng hợp theo ngày
+    from .reports import fine_collection
+    total_collected, daily_stats = fine_collection(from_date, to_date)
+    chart_labels = json.dumps([day.strftime('%d/%m') for day, _ in daily_stats])
+    chart_data = json.dumps([amount for _, amount in daily_stats])
     
     # Tính trung bình
     avg_per_receipt = total_collected / len(report_data) if report_data else 0
@@ -3172,10 +3238,12 @@ def report_fine_collection_excel(request):
     else:
         to_date = now
     
-    # Lấy dữ liệu
+    # Lấy dữ liệu (làm tròn theo ngày địa phương, cùng tập phiếu với trang báo cáo)
+    from .reports import day_bounds
+    _, _, start, end = day_bounds(from_date, to_date)
     receipts = Receipt.objects.filter(
-        created_date__gte=from_date,
-        created_date__lte=to_date,
+        created_date__gte=start,
+        created_date__lt=end,
         is_cancelled=False
     ).select_related('reader').order_by('-created_date')
     
@@ -4279,24 +4347,16 @@ def permission_matrix_view(request, group_id):
     functions = Function.objects.all().order_by('function_name')
     
     if request.method == 'POST':
-        # Xử lý cập nhật quyền
+        # Xây dựng toàn bộ ma trận quyền rồi ghi theo lô
+        matrix = {}
         for function in functions:
-            can_view = request.POST.get(f'view_{function.id}') == 'on'
-            can_add = request.POST.get(f'add_{function.id}') == 'on'
-            can_edit = request.POST.get(f'edit_{function.id}') == 'on'
-            can_delete = request.POST.get(f'delete_{function.id}') == 'on'
-            
-            # Cập nhật hoặc tạo mới permission
-            permission, created = Permission.objects.update_or_create(
-                user_group=user_group,
-                function=function,
-                defaults={
-                    'can_view': can_view,
-                    'can_add': can_add,
-                    'can_edit': can_edit,
-                    'can_delete': can_delete
-                }
-            )
+            matrix[function.id] = {
+                'view': request.POST.get(f'view_{function.id}') == 'on',
+                'add': request.POST.get(f'add_{function.id}') == 'on',
+                'edit': request.POST.get(f'edit_{function.id}') == 'on',
+                'delete': request.POST.get(f'delete_{function.id}') == 'on',
+            }
+        Permission.apply_matrix(user_group, matrix)
         
         messages.success(request, f'Đã cập nhật quyền cho nhóm "{user_group.user_group_name}" thành công!')
         return redirect('permission_matrix', group_id=group_id)
@@ -87,6 +87,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'LibraryApp.middleware.PermissionFlagStatsMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "django_browser_reload.middleware.BrowserReloadMiddleware",
@@ -142,6 +143,11 @@ DATABASES = {
     ) 
 }
 
+# SQLite: database test dạng file (mặc định là in-memory) để các test chạy nhiều luồng
+# (mượn/trả đồng thời) có nhiều kết nối thật tới cùng 1 database
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST', {}).setdefault('NAME', str(BASE_DIR / 'test_db.sqlite3'))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -196,10 +202,25 @@ CACHES = {
         'OPTIONS': {
             'MAX_ENTRIES': 1000
         }
+    },
+    # Kết quả / facet tra cứu sách công khai (1 key / bộ lọc, khách vãng lai cũng ghi được):
+    # tách khỏi 'default' để việc cull khi đầy không loại bỏ version counter, quyền, rate limit
+    'search': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/tmp/django_cache_search',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000
+        }
     }
 }
 
 
+# Bộ máy tra cứu sách công khai: 'database' (chỉ mục toàn văn trong database)
+# hoặc 'memory' (chỉ mục đảo ngược trong bộ nhớ của từng worker)
+CATALOG_SEARCH_ENGINE = os.getenv('CATALOG_SEARCH_ENGINE', 'database')
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
@@ -295,6 +316,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': False,
         },
+        'LibraryApp': {
+            'handlers': ['console'],
+            'level': os.getenv('LIBRARY_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
     },
 }
 
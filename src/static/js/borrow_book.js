@@ -15,6 +15,7 @@ function getConfig() {
         apiReadersUrl: config?.dataset.apiReadersUrl || '/api/readers/',
         apiBooksUrl: config?.dataset.apiBooksUrl || '/api/books/',
         apiBorrowingReadersUrl: config?.dataset.apiBorrowingReadersUrl || '/api/borrowing-readers/',
+        apiBorrowPrecheckUrl: config?.dataset.apiBorrowPrecheckUrl || '/api/borrow/precheck/',
         borrowBookListUrl: config?.dataset.borrowBookListUrl || '/books/borrow/',
         borrowDateInputId: config?.dataset.borrowDateInputId || 'id_borrow_date'
     };
@@ -218,18 +219,61 @@ function checkFormValid() {
     submitBtn.disabled = !isValid;
 }
 
+function showPrecheckErrors(errors) {
+    const container = document.getElementById('precheckErrors');
+    if (!container) return;
+    if (!errors.length) {
+        container.classList.add('hidden');
+        container.innerHTML = '';
+        return;
+    }
+    container.innerHTML = '';
+    errors.forEach(err => {
+        const line = document.createElement('div');
+        line.textContent = err;
+        container.appendChild(line);
+    });
+    container.classList.remove('hidden');
+}
+
+// Kiểm tra điều kiện mượn cho cả giỏ sách trước khi submit (QĐ4)
+// Lỗi mạng -> vẫn cho submit, server sẽ kiểm tra lại
+function precheckBorrow() {
+    const config = getConfig();
+    const url = new URL(config.apiBorrowPrecheckUrl, window.location.origin);
+    url.searchParams.set('reader_id', selectedReaderId);
+    url.searchParams.set('book_ids', selectedBooks.join(','));
+
+    return fetch(url)
+        .then(response => response.ok ? response.json() : Promise.reject(response))
+        .then(data => {
+            const errors = data.data?.errors || [];
+            showPrecheckErrors(errors);
+            return Boolean(data.data?.eligible);
+        })
+        .catch(() => {
+            showPrecheckErrors([]);
+            return true;
+        });
+}
+
 // ============ TAB 2: ĐỘC GIẢ ĐANG MƯỢN ============
 
-function loadBorrowingReaders() {
+// cursor = null: tải lại trang đầu; có cursor: nối thêm trang tiếp theo
+function loadBorrowingReaders(cursor = null) {
     const config = getConfig();
-    fetch(config.apiBorrowingReadersUrl)
+    const url = new URL(config.apiBorrowingReadersUrl, window.location.origin);
+    if (cursor) url.searchParams.set('cursor', cursor);
+
+    fetch(url)
         .then(response => response.ok ? response.json() : Promise.reject(response))
         .then(data => {
             const container = document.getElementById('borrowingReadersList');
-            if (!data.data?.length) {
+            container.querySelector('.load-more-readers')?.remove();
+            if (!data.data?.length && !cursor) {
                 container.innerHTML = '<div class="text-center text-gray-500 py-4"><em>Không có độc giả đang mượn sách</em></div>';
             } else {
-                container.innerHTML = data.data.map(reader => `
+                const html = data.data.map(reader => `
                     <div class="borrowing-reader-item p-4 border-l-4 ${reader.is_overdue ? 'border-red-500 bg-red-50' : 'border-yellow-500 bg-yellow-50'} mb-3 rounded cursor-pointer hover:shadow-md transition-all" 
                          data-reader-id="${reader.reader_id}"
                          data-reader-name="${reader.reader_name}"
@@ -251,8 +295,23 @@ function loadBorrowingReaders() {
                         </div>
                     </div>
                 `).join('');
-
-                document.querySelectorAll('.borrowing-reader-item').forEach(item => {
+                if (cursor) {
+                    container.insertAdjacentHTML('beforeend', html);
+                } else {
+                    container.innerHTML = html;
+                }
+
+                if (data.next_cursor) {
+                    container.insertAdjacentHTML('beforeend', `
+                        <button type="button" class="load-more-readers w-full py-2 text-sm text-blue-600 dark:text-blue-400 hover:underline">
+                            Tải thêm
+                        </button>
+                    `);
+                    container.querySelector('.load-more-readers').addEventListener('click', () => loadBorrowingReaders(data.next_cursor));
+                }
+
+                container.querySelectorAll('.borrowing-reader-item:not([data-bound])').forEach(item => {
+                    item.dataset.bound = '1';
                     item.addEventListener('click', function () {
                         const readerId = this.dataset.readerId;
                         const readerName = this.dataset.readerName;
@@ -411,8 +470,14 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     });
 
-    // Form submit loading
-    document.getElementById('borrowForm')?.addEventListener('submit', function () {
+    // Form submit: kiểm tra trước điều kiện mượn, sau đó mới gửi form
+    document.getElementById('borrowForm')?.addEventListener('submit', function (e) {
+        const form = this;
+        if (form.dataset.prechecked === '1') {
+            return;
+        }
+        e.preventDefault();
+
         const btn = document.getElementById('submitBtn');
         const btnText = document.getElementById('submitBtnText');
         const btnLoading = document.getElementById('submitBtnLoading');
@@ -422,11 +487,25 @@ document.addEventListener('DOMContentLoaded', function () {
             btnText.classList.add('hidden');
             btnLoading.classList.remove('hidden');
         }
+
+        precheckBorrow()
+            .then(ok => {
+                if (ok) {
+                    form.dataset.prechecked = '1';
+                    form.submit();
+                    return;
+                }
+                if (btn && btnText && btnLoading) {
+                    btnText.classList.remove('hidden');
+                    btnLoading.classList.add('hidden');
+                }
+                checkFormValid();
+            });
     });
 
     // Initial load
     loadReaders();
     loadBooks();
     loadBorrowingReaders();
-    setInterval(loadBorrowingReaders, 30000);
+    setInterval(() => loadBorrowingReaders(), 30000);
 });